@@ -0,0 +1,139 @@
+from collections import deque
+
+# Adaptive bitrate (ABR) decisions for the HTTP streaming emulator (client_Feng.py --abr).
+# Before every chunk the viewer asks its ABR for the encoding rate of the next chunk.
+# The choice is one of the ladder's rates, made from the viewer's throughput estimate and
+# its playback buffer level. Three algorithms are available:
+# - throughput: the highest rate under a safety share of the estimated throughput;
+# - buffer: BBA-0, which maps the buffer level linearly onto the ladder between a
+#   reservoir (lowest rate) and a cushion (highest rate), ignoring the throughput;
+# - mpc: a robust model predictive control. Each rate is held over a short horizon
+#   of chunks, and the buffer is simulated with the throughput estimate discounted
+#   by the recent prediction error. The rate with the best QoE wins: quality minus
+#   rebuffer time and quality switches.
+# The estimator keeps a fixed window of chunk throughputs with running sums, so every
+# update and estimate is O(1) and thousands of viewers can run it in one process.
+
+DEFAULT_WINDOW = 5  # Chunks in the throughput estimator's sliding window
+SAFETY = 0.9  # Share of the estimated throughput the throughput rule may use
+RESERVOIR = 0.25  # BBA: below this share of --max_buffer, the lowest rate
+CUSHION = 0.75  # BBA: above this share of --max_buffer, the highest rate
+HORIZON = 5  # MPC: chunks looked ahead
+SWITCH_PENALTY = 1.0  # MPC: QoE lost per Mbps of quality change
+
+
+class ThroughputEstimator:
+    # Harmonic mean of the last `window` chunk throughputs. The harmonic mean is not
+    # pulled up by a few fast chunks, which matters for the rate of the next chunk.
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.samples = deque(maxlen=window)  # Chunk throughputs in kbps
+        self.inverse_sum = 0.0  # Sum of 1 / sample over the window
+        self.errors = deque(maxlen=window)  # Relative prediction errors, for robust MPC
+        self.max_error = 0.0
+
+    def update(self, size, seconds):
+        # Record one chunk of `size` bytes downloaded in `seconds`; returns its throughput in kbps
+        kbps = max(size * 8 / 1024 / seconds, 1e-3)
+        predicted = self.estimate()
+        if predicted is not None:
+            self.errors.append(abs(predicted - kbps) / kbps)
+            self.max_error = max(self.errors)  # A fixed window of a few chunks: constant time
+        if len(self.samples) == self.samples.maxlen:
+            self.inverse_sum -= 1 / self.samples[0]
+        self.samples.append(kbps)
+        self.inverse_sum += 1 / kbps
+        return kbps
+
+    def estimate(self):
+        # Estimated throughput in kbps, None before the first chunk
+        if not self.samples:
+            return None
+        return len(self.samples) / self.inverse_sum
+
+
+class ThroughputABR:
+    # Rate-based: the highest rate that fits in a safety share of the estimate
+
+    name = 'throughput'
+
+    def __init__(self, rates, chunk_duration, max_buffer):
+        self.rates = rates  # Ladder rates in kbps, ascending
+
+    def choose(self, estimator, buffer_level, last_rate):
+        estimate = estimator.estimate()
+        if estimate is None:
+            return self.rates[0]
+        chosen = self.rates[0]
+        for rate in self.rates:
+            if rate <= estimate * SAFETY:
+                chosen = rate
+        return chosen
+
+
+class BufferABR:
+    # BBA-0: the buffer level alone picks the rate
+
+    name = 'buffer'
+
+    def __init__(self, rates, chunk_duration, max_buffer):
+        self.rates = rates
+        self.reservoir = max(chunk_duration, RESERVOIR * max_buffer)
+        self.cushion = max(self.reservoir + chunk_duration, CUSHION * max_buffer)
+
+    def choose(self, estimator, buffer_level, last_rate):
+        if buffer_level <= self.reservoir:
+            return self.rates[0]
+        if buffer_level >= self.cushion:
+            return self.rates[-1]
+        target = self.rates[0] + (self.rates[-1] - self.rates[0]) * (buffer_level - self.reservoir) / (self.cushion - self.reservoir)
+        chosen = self.rates[0]
+        for rate in self.rates:
+            if rate <= target:
+                chosen = rate
+        return chosen
+
+
+class MPCABR:
+    # Robust MPC: the rate maximizing the predicted QoE over the next HORIZON chunks
+
+    name = 'mpc'
+
+    def __init__(self, rates, chunk_duration, max_buffer):
+        self.rates = rates
+        self.chunk_duration = chunk_duration
+        self.max_buffer = max_buffer
+        # QoE lost per second of stall: the top rate in Mbps, so a second of stall costs
+        # as much as a second of video at the best quality earns
+        self.rebuffer_penalty = rates[-1] / 1024
+
+    def choose(self, estimator, buffer_level, last_rate):
+        estimate = estimator.estimate()
+        if estimate is None:
+            return self.rates[0]
+        throughput = estimate / (1 + estimator.max_error)
+        best, best_qoe = self.rates[0], None
+        for rate in self.rates:
+            qoe = self.qoe(rate, throughput, buffer_level, last_rate)
+            if best_qoe is None or qoe > best_qoe:
+                best, best_qoe = rate, qoe
+        return best
+
+    def qoe(self, rate, throughput, buffer_level, last_rate):
+        # Predicted QoE of holding `rate` for the horizon at `throughput` kbps
+        download = rate * self.chunk_duration / throughput
+        rebuffer = 0.0
+        buffer = buffer_level
+        for _ in range(HORIZON):
+            if download > buffer:
+                rebuffer += download - buffer
+                buffer = 0.0
+            else:
+                buffer -= download
+            buffer = min(buffer + self.chunk_duration, self.max_buffer + self.chunk_duration)
+        quality = HORIZON * rate / 1024
+        switch = abs(rate - last_rate) / 1024 if last_rate is not None else 0.0
+        return quality - self.rebuffer_penalty * rebuffer - SWITCH_PENALTY * switch
+
+
+ALGORITHMS = {abr.name: abr for abr in (ThroughputABR, BufferABR, MPCABR)}
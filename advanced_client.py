@@ -1,130 +1,605 @@
+import os
+import select
 import socket
+import threading
 import time
 import argparse
 from datetime import datetime
 
+from capacity import DEFAULT_START_RATE, REQUIRED_FIELDS, CapacitySearch, format_step, judge_step, missing_fields, run_step
+from churn import report_churn, run_churn
+from control import (CONTROL_CONNECTION, DATA_CONNECTION, MARKER_TYPES, PROTOCOL_VERSION, SESSION_HEADER, SPEC_KEYS,
+                     ControlChannel, IterationTracker, ProtocolError, StreamMarker, server_sends, stream_count, stream_tag)
+from pacer import make_pacer
+from profiler import DEFAULT_EVERY, CallProfile
+from histogram import Histogram
+from fastpump import make_pump, missing_note, new_counter
+from receiver import receive_all
+from rr import run_requests
+from sampler import IntervalSampler, report_histograms
+from sockopts import AUTO, TUNING_KEYS, apply_options, bdp_buffer, buffer_size_arg, format_options, handshake_rtt, read_options
+from sweep import congestion_list, format_table, run_metrics
+from tcp_info import iteration_summary, read_tcp_info, stream_stats, tcp_total_retrans
+from udp import DEFAULT_DATAGRAM_SIZE, DEFAULT_RATE, MAX_DATAGRAM_SIZE, UDP_HEADER, format_report, make_udp_receiver, make_udp_sender
+from zerocopy import open_payload_file, make_sender
+
 # Argument parsing
 parser = argparse.ArgumentParser(description="iperf3-like client")
 parser.add_argument('-s', '--server', type=str, required=True, help="Server IP address")
 parser.add_argument('-p', '--port', type=int, default=5201, help="Server port (default 5201)")
 parser.add_argument('-R', '--reverse', action='store_true', help="Enable reverse mode (server sends data to client)")
+parser.add_argument('-u', '--udp', action='store_true', help="UDP mode: paced datagrams at --target_rate, the receiver reports loss, jitter and reordering")
+parser.add_argument('--rr', action='store_true', help="Request/response mode: measure the round-trip latency of small transactions for --time seconds")
+parser.add_argument('--request_size', type=int, default=1, help="Request size in bytes in request/response mode (default 1)")
+parser.add_argument('--response_size', type=int, default=1, help="Response size in bytes in request/response mode (default 1)")
+parser.add_argument('--outstanding', type=int, default=1, help="Requests in flight per connection in request/response mode (default 1)")
+parser.add_argument('--bidir', action='store_true', help="Bidirectional mode: client and server send at the same time on separate streams")
+parser.add_argument('-P', '--parallel', type=int, default=1, help="Number of parallel data streams (default 1)")
 parser.add_argument('--iterations', type=int, default=1, help="Number of iterations for data transfer in normal mode")
 parser.add_argument('--sleep', type=int, default=0, help="Sleep duration in seconds between iterations")
 parser.add_argument('--constant_rate', action='store_true', help="Enable constant rate phase after normal transfer")
 parser.add_argument('--phase_time', type=int, default=5, help="Duration of constant rate phase in seconds")
 parser.add_argument('--target_rate', type=int, default=None, help="Target rate in Mbps for increasing phase")
+parser.add_argument('--reverse_target_rate', type=int, default=None, help="Target rate in Mbps for the server's increasing phase in reverse and bidirectional mode (default --target_rate)")
 parser.add_argument('--rate_based_phase', action='store_true', help="Increase data transfer based on reaching target rate")
 parser.add_argument('--time_based_phase', type=int, help="Increase data transfer for a specific time (in seconds)")
 parser.add_argument('--bytes', type=int, default=None, help="Transfer a specific amount of data in bytes in normal mode")
 parser.add_argument('--time', type=int, default=None, help="Duration of data transfer in seconds in normal mode")
-parser.add_argument('--buffer_size', type=int, default=128 * 1024, help="Buffer size for data transfer (default 128 KB)")
+parser.add_argument('--buffer_size', type=int, default=None, help="Buffer size for data transfer (default 128 KB), datagram size in UDP mode (default 1460 B)")
+parser.add_argument('--recv_batch', type=int, default=1, help="Number of buffer-sized reads gathered per receive call in reverse mode (default 1)")
+parser.add_argument('--kernel_pacing', action='store_true', help="Let the kernel pace constant rate phases (SO_MAX_PACING_RATE, Linux)")
+parser.add_argument('--zerocopy', action='store_true', help="Send from an in-memory file with os.sendfile instead of sendall")
+parser.add_argument('--pure_python', action='store_true', help="Run the bulk send/recv loops in Python even when libfastpump is built")
+parser.add_argument('--profile', type=int, nargs='?', const=DEFAULT_EVERY, default=None, help="Profile the TCP send/recv calls, timing one in N (default 64): short writes, EAGAIN and the time in calls, blocked on the socket and in Python")
+parser.add_argument('--interval', type=float, default=None, help="Sample every stream at this interval in seconds (e.g. 0.1)")
+parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl', help="Format of the interval samples (default jsonl)")
+parser.add_argument('--output', type=str, default='-', help="File the interval samples are appended to (default stdout)")
+parser.add_argument('--live', action='store_true', help="Write every interval sample as soon as it is taken")
+parser.add_argument('--tcp_info', action='store_true', help="Poll TCP_INFO (RTT, cwnd, retransmits, pacing and delivery rate) into samples and iteration summaries")
+parser.add_argument('--ring_size', type=int, default=10000, help="Number of interval samples kept in memory (default 10000)")
+parser.add_argument('--sndbuf', type=buffer_size_arg, default=None, help="SO_SNDBUF of the data sockets on both ends in bytes (K/M suffixes), or 'auto' to size it from the handshake RTT and --target_rate")
+parser.add_argument('--rcvbuf', type=buffer_size_arg, default=None, help="SO_RCVBUF of the data sockets on both ends in bytes (K/M suffixes), or 'auto' like --sndbuf")
+parser.add_argument('--nodelay', action='store_true', default=None, help="Set TCP_NODELAY on the data sockets on both ends")
+parser.add_argument('--notsent_lowat', type=int, default=None, help="TCP_NOTSENT_LOWAT in bytes on the data sockets on both ends (Linux)")
+parser.add_argument('--congestion', type=str, default=None, help="TCP congestion control of the data sockets on both ends, e.g. cubic or bbr (Linux)")
+parser.add_argument('--mss', type=int, default=None, help="TCP_MAXSEG of the data sockets; announced in the handshake, so it caps both directions")
+parser.add_argument('--capacity_search', action='store_true', help="Find the highest constant rate the path sustains: double the rate from --target_rate (default 10 Mbps) until a step fails, then bisect")
+parser.add_argument('--step_time', type=float, default=1.0, help="Duration of every capacity search step in seconds (default 1)")
+parser.add_argument('--precision', type=float, default=5, help="Stop the capacity search once the sustained and failed rates are within this many percent (default 5)")
+parser.add_argument('--max_loss', type=float, default=1, help="Largest share of retransmitted segments in percent a sustained step may show (default 1)")
+parser.add_argument('--max_rtt_inflation', type=float, default=2, help="Largest ratio of the step's RTT to the minimum RTT a sustained step may show (default 2)")
+parser.add_argument('--sweep_congestion', type=congestion_list, default=None, help="Run the test once per congestion control in this comma-separated list ('all': every one the kernel offers) and compare them; needs a --serve_forever server")
+parser.add_argument('--repeats', type=int, default=3, help="Runs per congestion control in a sweep, for the confidence intervals (default 3)")
+parser.add_argument('--churn', type=int, default=None, help="Connection churn test: open this many short connections (-P at a time) and report connections/s and latency percentiles")
 args = parser.parse_args()
 
+if args.parallel < 1:
+    parser.error("--parallel must be at least 1")
+if args.churn is not None and args.churn < args.parallel:
+    parser.error("--churn must be at least --parallel")
+if args.bidir and args.reverse:
+    parser.error("--bidir and -R are mutually exclusive")
+if args.buffer_size is None:
+    args.buffer_size = DEFAULT_DATAGRAM_SIZE if args.udp else 128 * 1024
+if args.udp:
+    if not (args.time or args.bytes):
+        parser.error("-u needs --time or --bytes")
+    if args.constant_rate:
+        parser.error("-u sends at --target_rate; --constant_rate is for TCP")
+    if not UDP_HEADER.size <= args.buffer_size <= MAX_DATAGRAM_SIZE:
+        parser.error(f"--buffer_size must be between {UDP_HEADER.size} and {MAX_DATAGRAM_SIZE} in UDP mode")
+if args.rr:
+    if not args.time:
+        parser.error("--rr needs --time")
+    if args.udp or args.reverse or args.bidir or args.constant_rate:
+        parser.error("--rr cannot be combined with -u, -R, --bidir or --constant_rate")
+    if args.request_size < 1 or args.response_size < 1 or args.outstanding < 1:
+        parser.error("--request_size, --response_size and --outstanding must be at least 1")
+if args.recv_batch < 1:
+    parser.error("--recv_batch must be at least 1")
+if args.profile is not None and args.profile < 1:
+    parser.error("--profile must be at least 1")
+if AUTO in (args.sndbuf, args.rcvbuf) and not (args.target_rate or args.reverse_target_rate):
+    parser.error("--sndbuf/--rcvbuf auto needs --target_rate to size the buffers for")
+if (args.notsent_lowat is not None and args.notsent_lowat < 1) or (args.mss is not None and args.mss < 1):
+    parser.error("--notsent_lowat and --mss must be at least 1")
+if args.interval is not None and args.interval <= 0:
+    parser.error("--interval must be positive")
+if not (args.pure_python or args.udp or args.rr) and missing_note():
+    print(f"Warning: {missing_note()}")
+if args.capacity_search:
+    if args.reverse or args.bidir or args.udp or args.rr or args.constant_rate or args.sweep_congestion or args.churn or args.parallel > 1:
+        parser.error("--capacity_search runs one sending TCP stream; it cannot be combined with -R, --bidir, -u, --rr, --constant_rate, --sweep_congestion, --churn or -P")
+    if args.step_time <= 0 or not 0 < args.precision < 100 or args.max_loss < 0 or args.max_rtt_inflation < 1:
+        parser.error("--step_time and --precision must be positive, --precision below 100, --max_loss at least 0 and --max_rtt_inflation at least 1")
+    args.nodelay = True  # Paced bursts must leave at once: Nagle would hold them and inflate the RTT
+if args.sweep_congestion:
+    if args.reverse or args.udp or args.rr or args.churn:
+        parser.error("--sweep_congestion compares the client's TCP sending streams; it cannot be combined with -R, -u, --rr or --churn")
+    if args.repeats < 1:
+        parser.error("--repeats must be at least 1")
+    args.tcp_info = True  # Retransmits and RTT come from the sampler's TCP_INFO polls
+    if args.interval is None:
+        args.interval = 0.1  # Enough RTT polls for percentiles from short runs
+    if args.output == '-':
+        args.output = None  # Keep the samples of the runs out of the comparison
+if args.tcp_info and args.interval is None:
+    args.interval = 1.0  # TCP_INFO is polled by the interval sampler
+
 SERVER_IP = args.server
 SERVER_PORT = args.port
 BUFFER_SIZE = args.buffer_size
 DATA = b'X' * BUFFER_SIZE  # Data to be sent
+PAYLOAD_FD = open_payload_file(DATA) if args.zerocopy else None  # Zero-copy source for os.sendfile
+
+RR_RESULTS = []  # (transactions, seconds, Histogram) per stream in request/response mode
+SWEEP_PAUSE = 1  # Seconds between the runs of a sweep, so queues drain and the server reaps the last session
+
+
+def socket_tuning():
+    # Options applied to every data socket; the ones in TUNING_KEYS also go to the server's end
+    options = {key: getattr(args, key) for key in TUNING_KEYS}
+    options['mss'] = args.mss
+    return options
+
+
+def size_auto_buffers(rtt):
+    # Replace 'auto' buffer sizes by twice the bandwidth-delay product of the faster direction
+    rate_mbps = max(args.target_rate or 0, args.reverse_target_rate or 0)
+    size = bdp_buffer(rate_mbps, rtt)
+    print(f"Auto-sized socket buffers: {size} B for {rate_mbps} Mbps over a handshake RTT of {rtt * 1e3:.3f} ms.")
+    for key in ('sndbuf', 'rcvbuf'):
+        if getattr(args, key) == AUTO:
+            setattr(args, key, size)
+
+
+def receive_data(index, client_socket, tag, results, counter, tracker):
+    start_time = time.time()
+    retrans_at_start = tcp_total_retrans(client_socket)
+    profile = CallProfile('recv', args.profile) if args.profile else None
 
-# Create a TCP socket
-client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    total_data_received, cpu_time, disconnected = receive_all(client_socket, BUFFER_SIZE, counter, args.recv_batch, profile=profile,
+                                                              native=not args.pure_python)
+    tracker.finished.set()
+    if disconnected:
+        print(f"{tag} Server disconnected unexpectedly.")
 
-try:
-    # Connect to the server
-    client_socket.connect((SERVER_IP, SERVER_PORT))
-    print(f"Connected to server at {SERVER_IP}:{SERVER_PORT}")
+    elapsed_time = time.time() - start_time
+    throughput_mbps = (total_data_received * 8 / (1024 * 1024)) / elapsed_time
+    print(f"{tag} Total data received: {total_data_received / (1024 * 1024):.2f} MB, Throughput: {throughput_mbps:.2f} Mbps")
+    print(f"{tag} Receiver CPU time: {cpu_time:.2f} s ({cpu_time / elapsed_time * 100:.1f}% of {elapsed_time:.2f} s)")
+    if profile is not None:
+        print(f"{tag} {profile.summary()}")
+    if args.tcp_info:
+        print(f"{tag} {iteration_summary(client_socket, stream_stats(counter), retrans_at_start)}")
+    results.append((None, total_data_received, elapsed_time, index))
 
-    # Send mode to the server ('N' for Normal, 'R' for Reverse)
-    mode = 'R' if args.reverse else 'N'
-    client_socket.sendall(mode.encode())
 
-    if args.reverse:  # Reverse Mode: Receive data from the server
-        print("Reverse Mode: Receiving data from the server.")
-        total_data_received = 0
+def send_iterations(index, client_socket, tag, results, counter, marker):
+    profile = CallProfile('send', args.profile) if args.profile else None
+    send = make_sender(client_socket, DATA, PAYLOAD_FD, counter, profile)
+    # Unpaced transfers run in libfastpump when it is built; a profile needs every call in Python
+    pump = make_pump(client_socket, DATA, PAYLOAD_FD, counter, send, native=not args.pure_python and profile is None)
+    max_throughput_mbps = 0  # To store max throughput during increasing phase
+
+    for i in range(args.iterations):
+        total_data_sent = 0
         start_time = time.time()
+        counter.iteration = i + 1
+        marker.iteration_start(i + 1)
+        retrans_at_start = tcp_total_retrans(client_socket)
+        if profile is not None:
+            profile.start()
 
-        try:
-            while True:
-                data = client_socket.recv(BUFFER_SIZE)
-                if not data:
-                    break
-                total_data_received += len(data)
+        print(f"{tag} Iteration {i+1} started at {datetime.now()}")
 
-        except (BrokenPipeError, ConnectionResetError):
-            print("Server disconnected unexpectedly.")
+        if args.constant_rate:
+            # Phase 1: Increasing Phase
+            if args.rate_based_phase and args.target_rate:
+                print(f"{tag} Increasing phase based on target rate.")
+                marker.phase_start(i + 1, 'increasing')
+                # Increase transfer until target rate is reached
+                while max_throughput_mbps < args.target_rate:
+                    send(len(DATA))
+                    total_data_sent += len(DATA)
+                    elapsed_time = time.time() - start_time
+                    max_throughput_mbps = (total_data_sent * 8 / (1024 * 1024)) / elapsed_time
 
-        elapsed_time = time.time() - start_time
-        throughput_mbps = (total_data_received * 8 / (1024 * 1024)) / elapsed_time
-        print(f"Total data received: {total_data_received / (1024 * 1024):.2f} MB, Throughput: {throughput_mbps:.2f} Mbps")
-
-    else:  # Normal Mode: Send data to the server
-        print("Normal Mode: Sending data to the server.")
-
-        max_throughput_mbps = 0  # To store max throughput during increasing phase
-
-        for i in range(args.iterations):
-            total_data_sent = 0
-            start_time = time.time()
-
-            print(f"[Client] Iteration {i+1} started at {datetime.now()}")
-
-            if args.constant_rate:
-                # Phase 1: Increasing Phase
-                if args.rate_based_phase and args.target_rate:
-                    print("[Client] Increasing phase based on target rate.")
-                    # Increase transfer until target rate is reached
-                    while max_throughput_mbps < args.target_rate:
-                        client_socket.sendall(DATA)
-                        total_data_sent += len(DATA)
-                        elapsed_time = time.time() - start_time
-                        max_throughput_mbps = (total_data_sent * 8 / (1024 * 1024)) / elapsed_time
-
-                elif args.time_based_phase:
-                    print("[Client] Increasing phase based on time.")
-                    # Increase transfer for the specified time
-                    phase_end_time = start_time + args.time_based_phase
-                    while time.time() < phase_end_time:
-                        client_socket.sendall(DATA)
-                        total_data_sent += len(DATA)
-
-                # Phase 2: Constant Rate Phase
-                constant_phase_end = time.time() + args.phase_time
-                bytes_per_second = max_throughput_mbps * 1024 * 1024 / 8
-
-                print(f"[Client] Constant rate phase started at {datetime.now()}")
+            elif args.time_based_phase:
+                print(f"{tag} Increasing phase based on time.")
+                marker.phase_start(i + 1, 'increasing')
+                # Increase transfer for the specified time
+                phase_end_time = start_time + args.time_based_phase
+                total_data_sent += pump(seconds=phase_end_time - time.time())
+                # The rate reached during the phase becomes the constant rate
+                max_throughput_mbps = (total_data_sent * 8 / (1024 * 1024)) / (time.time() - start_time)
+
+            # Phase 2: Constant Rate Phase
+            constant_phase_end = time.time() + args.phase_time
+            bytes_per_second = max_throughput_mbps * 1024 * 1024 / 8
+
+            if bytes_per_second <= 0:
+                print(f"{tag} No rate from an increasing phase, skipping constant rate phase.")
+            else:
+                print(f"{tag} Constant rate phase started at {datetime.now()}")
+                marker.phase_start(i + 1, 'constant')
+                pacer = make_pacer(client_socket, bytes_per_second, BUFFER_SIZE, args.kernel_pacing)
                 while time.time() < constant_phase_end:
-                    chunk_size = min(BUFFER_SIZE, int(bytes_per_second))
-                    client_socket.sendall(DATA[:chunk_size])
+                    chunk_size = pacer.acquire(BUFFER_SIZE)
+                    send(chunk_size)
                     total_data_sent += chunk_size
+                pacer.close()
+                print(f"{tag} {pacer.summary()}")
+
+        else:
+            # Non-constant rate, either bytes or time-based transfer
+            if args.bytes:
+                print(f"{tag} Sending {args.bytes} bytes.")
+                marker.phase_start(i + 1, 'transfer')
+                total_data_sent += pump(nbytes=args.bytes)
+
+            elif args.time:
+                print(f"{tag} Sending data for {args.time} seconds.")
+                marker.phase_start(i + 1, 'transfer')
+                total_data_sent += pump(seconds=args.time)
+
+        marker.iteration_end(i + 1)
+
+        # Log transfer progress
+        elapsed_time = time.time() - start_time
+        throughput_mbps = (total_data_sent * 8 / (1024 * 1024)) / elapsed_time
+        print(f"{tag} Iteration {i+1} completed, Data sent: {total_data_sent / (1024 * 1024):.2f} MB, Throughput: {throughput_mbps:.2f} Mbps")
+        if profile is not None:
+            print(f"{tag} {profile.summary()}")
+        if args.tcp_info:
+            print(f"{tag} {iteration_summary(client_socket, counter.tcp_stats.get(i + 1), retrans_at_start)}")
+        results.append((i, total_data_sent, elapsed_time, index))
+
+        # Sleep between iterations if iteration mode is enabled
+        if args.sleep:
+            print(f"{tag} Iteration {i+1}: Sleeping for {args.sleep} seconds.")
+            time.sleep(args.sleep)
+
+    # Signal end of data to the server
+    client_socket.shutdown(socket.SHUT_WR)
+
+
+def receive_udp(index, client_socket, tag, results, counter, stop):
+    receiver = make_udp_receiver(client_socket, counter, tag, args.interval or 1.0)
+    print(f"{tag} UDP receiver: {receiver.backend}")
+    report, cpu_time, elapsed_time = receiver.run(stop)
+    total_data_received = receiver.total.bytes
+
+    throughput_mbps = (total_data_received * 8 / (1024 * 1024)) / elapsed_time
+    print(f"{tag} Total data received: {total_data_received / (1024 * 1024):.2f} MB, Throughput: {throughput_mbps:.2f} Mbps, {report['packets'] / elapsed_time:.0f} pps")
+    print(f"{tag} UDP: {format_report(report)}")
+    print(f"{tag} Receiver CPU time: {cpu_time:.2f} s ({cpu_time / elapsed_time * 100:.1f}% of {elapsed_time:.2f} s)")
+    results.append((None, total_data_received, elapsed_time, index))
+
+
+def request_response(index, client_socket, tag, results, counter, marker):
+    print(f"{tag} Sending {args.request_size} B requests for {args.response_size} B responses, {args.outstanding} in flight, for {args.time} seconds.")
+    transactions, elapsed_time, histogram = run_requests(client_socket, args.request_size, args.response_size, args.outstanding, args.time, counter)
+    print(f"{tag} {transactions} transactions in {elapsed_time:.2f} s, {transactions / elapsed_time:.0f} transactions/s")
+    print(f"{tag} Round-trip latency: {histogram.summary()}")
+    RR_RESULTS.append((transactions, elapsed_time, histogram))
+    client_socket.shutdown(socket.SHUT_WR)
+
+
+def search_capacity(index, client_socket, tag, results, counter, marker):
+    send = make_sender(client_socket, DATA, PAYLOAD_FD, counter)
+    search = CapacitySearch(args.target_rate or DEFAULT_START_RATE, args.precision / 100)
+    missing = missing_fields(read_tcp_info(client_socket))
+    if missing:
+        print(f"{tag} Capacity search needs TCP_INFO with {', '.join(REQUIRED_FIELDS)} (Linux 4.6 or later); "
+              f"missing: {', '.join(missing)}.")
+        client_socket.shutdown(socket.SHUT_WR)
+        return
+    print(f"{tag} Capacity search from {search.rate} Mbps, {args.step_time} s steps, precision {args.precision}%, "
+          f"max loss {args.max_loss}%, max RTT inflation {args.max_rtt_inflation}x.")
+
+    start_time = time.time()
+    step_number = 0
+    while not search.done():
+        step_number += 1
+        counter.iteration = step_number
+        marker.iteration_start(step_number)
+        marker.phase_start(step_number, search.phase)
+        step = run_step(client_socket, send, search.rate, args.step_time, BUFFER_SIZE, args.kernel_pacing)
+        marker.iteration_end(step_number)
+        sustained, reason = judge_step(step, args.max_loss / 100, args.max_rtt_inflation)
+        print(f"{tag} {format_step(step_number, search.phase, step, sustained, reason)}")
+        results.append((step_number - 1, step['sent'], step['elapsed'], index))
+        search.record(sustained)
+
+    print(f"{tag} Capacity: {search.sustained:.2f} Mbps sustained, {search.failed:.2f} Mbps failed "
+          f"({step_number} steps in {time.time() - start_time:.1f} s)")
+    client_socket.shutdown(socket.SHUT_WR)
+
+
+def send_udp_iterations(index, client_socket, tag, results, counter, marker):
+    rate_mbps = args.target_rate or DEFAULT_RATE
+    sender = make_udp_sender(client_socket, BUFFER_SIZE, counter)
+    print(f"{tag} UDP sender: {sender.backend}")
+
+    for i in range(args.iterations):
+        counter.iteration = i + 1
+        marker.iteration_start(i + 1)
+        print(f"{tag} Iteration {i+1} started at {datetime.now()}")
+        if args.bytes:
+            print(f"{tag} Sending {args.bytes} bytes of UDP at {rate_mbps} Mbps.")
+        else:
+            print(f"{tag} Sending UDP at {rate_mbps} Mbps for {args.time} seconds.")
+        marker.phase_start(i + 1, 'transfer')
+
+        start_time = time.time()
+        datagrams, pacer = sender.send_paced(rate_mbps * 1024 * 1024 / 8, None if args.bytes else args.time, args.bytes)
+        marker.iteration_end(i + 1)
 
+        elapsed_time = time.time() - start_time
+        total_data_sent = datagrams * BUFFER_SIZE
+        throughput_mbps = (total_data_sent * 8 / (1024 * 1024)) / elapsed_time
+        print(f"{tag} Iteration {i+1} completed, Data sent: {total_data_sent / (1024 * 1024):.2f} MB, Throughput: {throughput_mbps:.2f} Mbps, {datagrams / elapsed_time:.0f} pps")
+        print(f"{tag} {pacer.summary()}")
+        results.append((i, total_data_sent, elapsed_time, index))
+
+        if args.sleep:
+            print(f"{tag} Iteration {i+1}: Sleeping for {args.sleep} seconds.")
+            time.sleep(args.sleep)
+
+    sender.finish()
+    if sender.errors:
+        print(f"{tag} {sender.errors} datagram(s) dropped by the local stack (ENOBUFS).")
+
+
+def report_aggregate(results, label, prefix="[Client]"):
+    # Sum the bytes of all streams per iteration (plus the receivers' totals);
+    # the slowest stream defines the elapsed time
+    for i in sorted(set(r[0] for r in results), key=lambda i: -1 if i is None else i):
+        iteration_results = [r for r in results if r[0] == i]
+        total_bytes = sum(r[1] for r in iteration_results)
+        elapsed_time = max(r[2] for r in iteration_results)
+        throughput_mbps = (total_bytes * 8 / (1024 * 1024)) / elapsed_time
+        name = f"Iteration {i+1}" if i is not None else "Total"
+        print(f"{prefix}[SUM] {name}, {label}: {total_bytes / (1024 * 1024):.2f} MB, Throughput: {throughput_mbps:.2f} Mbps")
+
+
+def report_directions(results, prefix, server):
+    # Aggregate per direction; `server` selects the labels of the server's side
+    for sending, label in ((False, "Data received"), (True, "Data sent")):
+        direction_results = [r for r in results if server_sends(args, r[3]) == (sending if server else not sending)]
+        if args.parallel > 1 and direction_results:
+            report_aggregate(direction_results, label, prefix)
+
+
+def report_rr():
+    # Transactions of all streams with one latency distribution merged from their histograms
+    histogram = Histogram()
+    for _, _, stream_histogram in RR_RESULTS:
+        histogram.add(stream_histogram)
+    transactions = sum(r[0] for r in RR_RESULTS)
+    elapsed_time = max(r[1] for r in RR_RESULTS)
+    print(f"[Client][SUM] {transactions} transactions in {elapsed_time:.2f} s, {transactions / elapsed_time:.0f} transactions/s")
+    print(f"[Client][SUM] Round-trip latency: {histogram.summary()}")
+
+
+def report_server_results(message):
+    # Print the results the server measured on its side of every stream
+    results = [tuple(r) for r in message.get('results', [])]
+    for i, total_bytes, elapsed_time, index in sorted(results, key=lambda r: (r[3], -1 if r[0] is None else r[0])):
+        sending = server_sends(args, index)
+        tag = stream_tag("[Server]", args, index, sending)
+        label = "Data sent" if sending else "Data received"
+        name = f"Iteration {i+1}" if i is not None else "Total"
+        throughput_mbps = (total_bytes * 8 / (1024 * 1024)) / elapsed_time
+        print(f"{tag} {name}, {label}: {total_bytes / (1024 * 1024):.2f} MB in {elapsed_time:.2f} s, Throughput: {throughput_mbps:.2f} Mbps")
+    for index, report in sorted(message.get('udp', {}).items(), key=lambda item: int(item[0])):
+        print(f"{stream_tag('[Server]', args, int(index), False)} UDP: {format_report(report)}")
+    for stream, values in sorted((message.get('socket_options') or {}).items(), key=lambda item: int(item[0])):
+        # The server names its streams index + 1
+        index = int(stream) - 1
+        tag = stream_tag('[Server]', args, index, server_sends(args, index))
+        print(f"{tag} {format_options(values)}")
+        for note in values.get('notes', []):
+            print(f"{tag} Warning: {note}")
+    report_directions(results, "[Server]", True)
+    if message.get('histograms'):
+        # The server's sampler names its streams index + 1
+        tags = {str(index + 1): stream_tag("[Server]", args, index, server_sends(args, index)) for index in range(stream_count(args))}
+        report_histograms(message['histograms'], "[Server]", tags)
+
+
+def run_test():
+    # One test session; returns (client results, server results message, sampler, effective socket options per stream)
+    # Control connection plus one TCP (or UDP) socket per stream
+    session_id = int.from_bytes(os.urandom(4), 'big')
+    control = None
+    client_sockets = []
+
+    try:
+        # Send the test spec over the control connection; the server accepts or rejects it
+        control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        connect_start = time.perf_counter()
+        control_socket.connect((SERVER_IP, SERVER_PORT))
+        if AUTO in (args.sndbuf, args.rcvbuf):
+            size_auto_buffers(handshake_rtt(control_socket, time.perf_counter() - connect_start))
+        control_socket.sendall(CONTROL_CONNECTION)
+        control = ControlChannel(control_socket)
+        control.send('hello', version=PROTOCOL_VERSION, session=session_id, spec={key: getattr(args, key) for key in SPEC_KEYS})
+        reply = control.recv()
+        if reply['type'] == 'reject':
+            print(f"Server rejected the test: {reply.get('reason')}")
+            exit(1)
+        if reply['type'] != 'accept':
+            raise ProtocolError(f"unexpected {reply['type']} message")
+
+        # Then open the data connections of the session; UDP streams go to the ports the server opened for them.
+        # The tuning is applied before connect(), so the MSS and the window scale are announced in the handshake.
+        tuning = socket_tuning()
+        tuned = any(value is not None for value in tuning.values())
+        socket_options = {}  # Stream index -> effective options, read back once connected
+        socket_notes = {}  # Stream index -> what the kernel refused or clamped
+        for index in range(stream_count(args)):
+            if args.udp:
+                client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                client_sockets.append(client_socket)
+                socket_notes[index] = apply_options(client_socket, tuning, tcp=False)
+                client_socket.connect((SERVER_IP, reply['udp_ports'][index]))
+                client_socket.send(DATA_CONNECTION + SESSION_HEADER.pack(session_id, index, stream_count(args)))
             else:
-                # Non-constant rate, either bytes or time-based transfer
-                if args.bytes:
-                    print(f"[Client] Sending {args.bytes} bytes.")
-                    bytes_to_send = args.bytes
-                    while bytes_to_send > 0:
-                        chunk_size = min(BUFFER_SIZE, bytes_to_send)
-                        client_socket.sendall(DATA[:chunk_size])
-                        total_data_sent += chunk_size
-                        bytes_to_send -= chunk_size
-
-                elif args.time:
-                    print(f"[Client] Sending data for {args.time} seconds.")
-                    phase_end_time = time.time() + args.time
-                    while time.time() < phase_end_time:
-                        client_socket.sendall(DATA)
-                        total_data_sent += len(DATA)
-
-            # Log transfer progress
-            elapsed_time = time.time() - start_time
-            throughput_mbps = (total_data_sent * 8 / (1024 * 1024)) / elapsed_time
-            print(f"[Client] Iteration {i+1} completed, Data sent: {total_data_sent / (1024 * 1024):.2f} MB, Throughput: {throughput_mbps:.2f} Mbps")
-
-            # Sleep between iterations if iteration mode is enabled
-            if args.sleep:
-                print(f"[Client] Iteration {i+1}: Sleeping for {args.sleep} seconds.")
-                time.sleep(args.sleep)
-
-finally:
-    # Close the client socket
-    client_socket.close()
-    print("Connection closed.")
+                client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                client_sockets.append(client_socket)
+                socket_notes[index] = apply_options(client_socket, tuning)
+                client_socket.connect((SERVER_IP, SERVER_PORT))
+                client_socket.sendall(DATA_CONNECTION + SESSION_HEADER.pack(session_id, index, stream_count(args)))
+        print(f"Connected to server at {SERVER_IP}:{SERVER_PORT} with {len(client_sockets)} stream(s), session {session_id:08x}")
+
+        if args.udp:
+            print(f"UDP Mode: {BUFFER_SIZE} byte datagrams.")
+        if args.rr:
+            print("Request/Response Mode: measuring transaction round trips.")
+        elif args.bidir:  # Bidirectional Mode: send and receive at the same time
+            print("Bidirectional Mode: Sending data to and receiving data from the server.")
+        elif args.reverse:  # Reverse Mode: Receive data from the server
+            print("Reverse Mode: Receiving data from the server.")
+        else:  # Normal Mode: Send data to the server
+            print("Normal Mode: Sending data to the server.")
+        if args.zerocopy and not args.reverse and not args.udp:
+            print("Zero-copy sender: os.sendfile." if PAYLOAD_FD is not None else "Zero-copy sender unavailable, using sendall.")
+
+        sampler = None
+        if args.interval:
+            sampler = IntervalSampler(args.interval, f"{session_id:08x}", args.ring_size, args.output, args.format, args.live, args.tcp_info)
+
+        results = []
+        senders = []
+        receivers = []
+        trackers = {}  # Stream index -> IterationTracker of every receiving TCP stream
+        server_done = threading.Event()  # The server has finished sending
+        for index, client_socket in enumerate(client_sockets):
+            sending = not server_sends(args, index)
+            tag = stream_tag("[Client]", args, index, sending)
+            if tuned:
+                socket_options[index] = read_options(client_socket, not args.udp)
+                print(f"{tag} {format_options(socket_options[index])}")
+                for note in socket_notes[index]:
+                    print(f"{tag} Warning: {note}")
+            counter = new_counter(not args.pure_python and not args.profile)
+            if sampler:
+                sampler.add_stream(index + 1, client_socket, counter, tag)
+            if sending:
+                target = request_response if args.rr else send_udp_iterations if args.udp else search_capacity if args.capacity_search else send_iterations
+                progress = StreamMarker(control, index, counter)
+            elif args.udp:
+                target, progress = receive_udp, server_done
+            else:
+                target = receive_data
+                progress = trackers[index] = IterationTracker(counter, tag, index)
+            thread = threading.Thread(target=target, args=(index, client_socket, tag, results, counter, progress))
+            (senders if sending else receivers).append(thread)
+
+        server_results = {}
+        results_received = threading.Event()
+
+        def handle(message):
+            if message['type'] in MARKER_TYPES and message.get('stream') in trackers:
+                trackers[message['stream']].put(message)
+            elif message['type'] == 'test_end':
+                server_done.set()
+            elif message['type'] == 'results':
+                server_results.update(message)
+                server_done.set()
+                results_received.set()
+            elif message['type'] == 'closed':
+                server_done.set()
+                results_received.set()
+
+        # The server starts its side of the test once every data connection has arrived;
+        # registration datagrams of UDP streams may be lost, so repeat them until it is ready
+        while args.udp and not select.select([control_socket], [], [], 0.2)[0]:
+            for index, client_socket in enumerate(client_sockets):
+                client_socket.send(DATA_CONNECTION + SESSION_HEADER.pack(session_id, index, stream_count(args)))
+
+        reply = control.recv()
+        if reply['type'] != 'ready':
+            raise ProtocolError(f"unexpected {reply['type']} message")
+        control.start_reader(handle)
+
+        if sampler:
+            sampler.start()
+        for thread in senders + receivers:
+            thread.start()
+
+        # Tell the server once our side is done sending, so its receivers need not wait any longer
+        for thread in senders:
+            thread.join()
+        if senders:
+            control.send('test_end')
+        for thread in receivers:
+            thread.join()
+        if sampler:
+            sampler.stop()
+        results_received.wait()
+
+        # The server sends its results after its last marker, so every tracker has its markers
+        for tracker in trackers.values():
+            tracker.close()
+            results.extend(tracker.results)
+
+        report_directions(results, "[Client]", False)
+        if args.rr and args.parallel > 1 and RR_RESULTS:
+            report_rr()
+        if sampler:
+            sampler.report("[Client]")
+
+        if server_results:
+            report_server_results(server_results)
+        else:
+            print("Server closed the control connection without results.")
+        return results, server_results, sampler, socket_options
+
+    finally:
+        # Close the control connection and the client sockets
+        if control:
+            control.close()
+        for client_socket in client_sockets:
+            client_socket.close()
+        print("Connection closed.")
+
+
+def run_sweep():
+    # Run the test once per congestion control and repeat, interleaved, and compare them in one table
+    sending = {index for index in range(stream_count(args)) if not server_sends(args, index)}
+    runs = {name: [] for name in args.sweep_congestion}
+    total = len(runs) * args.repeats
+    run = 0
+    for repeat in range(args.repeats):
+        for name in args.sweep_congestion:
+            run += 1
+            args.congestion = name
+            print(f"Sweep run {run}/{total}: congestion {name}, repeat {repeat + 1}/{args.repeats}")
+            results, server_results, sampler, socket_options = run_test()
+            # Both ends must have run the algorithm, or the run measures something else
+            effective = {options.get('congestion') for options in socket_options.values()}
+            effective |= {options.get('congestion') for options in (server_results.get('socket_options') or {}).values()}
+            if effective != {name}:
+                print(f"Sweep: {name} not in effect on every socket ({', '.join(sorted(map(str, effective)))}), run left out.")
+                continue
+            runs[name].append(run_metrics(sending, results, server_results, sampler))
+            time.sleep(SWEEP_PAUSE)
+    print(format_table(runs, args.repeats))
+
+
+def run_churn_test():
+    # No session: every connection is a bare handshake answered by the server (or its workers)
+    print(f"Connection churn test: {args.churn} connections to {SERVER_IP}:{SERVER_PORT}, {args.parallel} at a time.")
+    loops, elapsed_time = run_churn(SERVER_IP, SERVER_PORT, args.churn, args.parallel)
+    report_churn(loops, elapsed_time)
+
+
+if args.churn:
+    run_churn_test()
+elif args.sweep_congestion:
+    run_sweep()
+else:
+    run_test()
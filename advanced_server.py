@@ -1,11 +1,31 @@
+import os
+import selectors
 import socket
+import threading
 import time
 import argparse
 from datetime import datetime
 
+from churn import answer_churn
+from control import (CHURN_CONNECTION, CONTROL_CONNECTION, DATA_CONNECTION, MARKER_TIMEOUT, MARKER_TYPES, PROTOCOL_VERSION, SESSION_HEADER, SPEC_KEYS,
+                     ControlChannel, IterationTracker, ProtocolError, StreamMarker, recv_exact, server_sends, stream_count, stream_tag)
+from pacer import TokenBucket, make_pacer
+from profiler import DEFAULT_EVERY, CallProfile
+from fastpump import make_pump, missing_note, new_counter
+from receiver import receive_all
+from rr import answer_requests
+from sampler import IntervalSampler
+from sockopts import AUTO, CONGESTION_NAME_SIZE, TUNING_KEYS, apply_options, buffer_size_arg, format_options, read_options
+from tcp_info import iteration_summary, stream_stats, tcp_total_retrans
+from udp import DEFAULT_RATE, MAX_DATAGRAM_SIZE, UDP_HEADER, format_report, make_udp_receiver, make_udp_sender
+from workers import CounterSlots, WorkerPool
+from zerocopy import open_payload_file, make_sender
+
 # Argument parsing
 parser = argparse.ArgumentParser(description="iperf3-like server with previous constant rate carry-over")
 parser.add_argument('-p', '--port', type=int, default=5201, help="Server port (default 5201)")
+# Test options for legacy clients that only send the mode byte; clients with a control
+# channel send their own test spec, which overrides these
 parser.add_argument('-iter', '--iterations', type=int, default=1, help="Number of iterations for data transfer in reverse mode")
 parser.add_argument('--sleep', type=int, default=0, help="Sleep duration in seconds between iterations")
 parser.add_argument('--constant_rate', action='store_true', help="Enable constant rate phase after normal transfer")
@@ -15,170 +35,698 @@ parser.add_argument('--rate_based_phase', action='store_true', help="Increase da
 parser.add_argument('--time_based_phase', type=int, help="Increase data transfer for a specific time (in seconds)")
 parser.add_argument('--bytes', type=int, default=None, help="Transfer a specific amount of data in bytes in reverse mode")
 parser.add_argument('--time', type=int, default=None, help="Duration of data transfer in seconds in reverse mode")
+# Server options
+parser.add_argument('--recv_batch', type=int, default=1, help="Number of buffer-sized reads gathered per receive call in normal mode (default 1)")
+parser.add_argument('--kernel_pacing', action='store_true', help="Let the kernel pace constant rate phases (SO_MAX_PACING_RATE, Linux)")
+parser.add_argument('--zerocopy', action='store_true', help="Send from an in-memory file with os.sendfile instead of sendall")
+parser.add_argument('--pure_python', action='store_true', help="Run the bulk send/recv loops in Python even when libfastpump is built")
+parser.add_argument('--profile', type=int, nargs='?', const=DEFAULT_EVERY, default=None, help="Profile the TCP send/recv calls, timing one in N (default 64): short writes, EAGAIN and the time in calls, blocked on the socket and in Python")
+parser.add_argument('--interval', type=float, default=None, help="Sample every stream at this interval in seconds (e.g. 0.1)")
+parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl', help="Format of the interval samples (default jsonl)")
+parser.add_argument('--output', type=str, default='-', help="File the interval samples are appended to (default stdout)")
+parser.add_argument('--live', action='store_true', help="Write every interval sample as soon as it is taken")
+parser.add_argument('--tcp_info', action='store_true', help="Poll TCP_INFO (RTT, cwnd, retransmits, pacing and delivery rate) into samples and iteration summaries")
+parser.add_argument('--ring_size', type=int, default=10000, help="Number of interval samples kept in memory (default 10000)")
+parser.add_argument('--serve_forever', action='store_true', help="Keep running and serve many clients concurrently")
+parser.add_argument('--max_sessions', type=int, default=8, help="Maximum number of concurrent sessions with --serve_forever (default 8)")
+parser.add_argument('--max_bandwidth', type=int, default=None, help="Aggregate bandwidth cap in Mbps across all sessions and streams")
+parser.add_argument('--sndbuf', type=buffer_size_arg, default=None, help="SO_SNDBUF of the data sockets in bytes (K/M suffixes) unless the client asks for its own")
+parser.add_argument('--rcvbuf', type=buffer_size_arg, default=None, help="SO_RCVBUF of the listening and data sockets in bytes (K/M suffixes) unless the client asks for its own")
+parser.add_argument('--nodelay', action='store_true', default=None, help="Set TCP_NODELAY on the data sockets")
+parser.add_argument('--notsent_lowat', type=int, default=None, help="TCP_NOTSENT_LOWAT in bytes on the data sockets unless the client asks for its own (Linux)")
+parser.add_argument('--congestion', type=str, default=None, help="TCP congestion control of the data sockets unless the client asks for its own, e.g. cubic or bbr (Linux)")
+parser.add_argument('--mss', type=int, default=None, help="TCP_MAXSEG of the listening socket, announced to every client in the handshake")
+parser.add_argument('--workers', type=int, default=None, help="Run the data streams in this many worker processes instead of threads")
+parser.add_argument('--pin_workers', action='store_true', help="Pin every worker process to its own CPU (sched_setaffinity, Linux)")
+parser.add_argument('--reuseport', action='store_true', help="Give every worker its own SO_REUSEPORT listener on the server port (connection churn tests)")
 
 args = parser.parse_args()
 
+if args.recv_batch < 1:
+    parser.error("--recv_batch must be at least 1")
+if args.profile is not None and args.profile < 1:
+    parser.error("--profile must be at least 1")
+if args.max_sessions < 1:
+    parser.error("--max_sessions must be at least 1")
+if AUTO in (args.sndbuf, args.rcvbuf):
+    parser.error("--sndbuf/--rcvbuf auto is sized by the client, which knows the RTT and the target rate")
+if (args.notsent_lowat is not None and args.notsent_lowat < 1) or (args.mss is not None and args.mss < 1):
+    parser.error("--notsent_lowat and --mss must be at least 1")
+if args.interval is not None and args.interval <= 0:
+    parser.error("--interval must be positive")
+if args.workers is not None:
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.max_bandwidth:
+        parser.error("--max_bandwidth is shared by threads and cannot be combined with --workers")
+if args.pin_workers and (args.workers is None or not hasattr(os, 'sched_setaffinity')):
+    parser.error("--pin_workers needs --workers and sched_setaffinity")
+if args.reuseport and (args.workers is None or not hasattr(socket, 'SO_REUSEPORT')):
+    parser.error("--reuseport needs --workers and SO_REUSEPORT")
+if args.tcp_info and args.interval is None:
+    args.interval = 1.0  # TCP_INFO is polled by the interval sampler
+if not args.pure_python and missing_note():
+    print(f"Warning: {missing_note()}")
+
 SERVER_HOST = '0.0.0.0'
 SERVER_PORT = args.port
 BUFFER_SIZE = 128 * 1024  # 128 KB buffer size
-DATA = b'X' * BUFFER_SIZE  # The data to be sent
+HANDSHAKE_TIMEOUT = 5  # Seconds a new connection (or session) gets to complete its handshake
+MAX_STREAMS = 128  # Largest number of parallel streams a client may request
+MAX_BUFFER_SIZE = 64 * 1024 * 1024  # Largest send buffer a client may request
+
+# Aggregate cap shared by all sessions; the bucket holds at most 10 ms worth of data
+BANDWIDTH_CAP = None
+if args.max_bandwidth:
+    cap_rate = args.max_bandwidth * 1024 * 1024 / 8
+    BANDWIDTH_CAP = TokenBucket(cap_rate, max(BUFFER_SIZE, cap_rate * 0.01))
+
+# Payload and zero-copy source per send buffer size, shared by all sessions
+PAYLOADS = {}
+PAYLOADS_LOCK = threading.Lock()
+
+
+def get_payload(size):
+    # (data, payload file descriptor or None) to send `size`-byte buffers from
+    with PAYLOADS_LOCK:
+        if size not in PAYLOADS:
+            data = b'X' * size
+            PAYLOADS[size] = (data, open_payload_file(data) if args.zerocopy else None)
+        return PAYLOADS[size]
+
+
+def server_spec(mode):
+    # Test spec of a legacy client, taken from the server's own options
+    return argparse.Namespace(reverse=mode == 'R', bidir=False, udp=False, rr=False, parallel=1, iterations=args.iterations, sleep=args.sleep,
+                              constant_rate=args.constant_rate, phase_time=args.consphase_time, target_rate=args.target_rate, reverse_target_rate=None,
+                              rate_based_phase=args.rate_based_phase, time_based_phase=args.time_based_phase,
+                              bytes=args.bytes, time=args.time, buffer_size=BUFFER_SIZE, kernel_pacing=args.kernel_pacing,
+                              request_size=1, response_size=1, sndbuf=args.sndbuf, rcvbuf=args.rcvbuf, nodelay=args.nodelay,
+                              notsent_lowat=args.notsent_lowat, congestion=args.congestion)
+
+
+def negotiate_spec(client_spec):
+    # The client's spec on top of the server defaults; returns (spec, None) or (None, reason).
+    # Socket tuning the client leaves unset keeps the server's own.
+    spec = vars(server_spec('N'))
+    spec.update((key, client_spec[key]) for key in SPEC_KEYS if key in client_spec and not (key in TUNING_KEYS and client_spec[key] is None))
+    spec = argparse.Namespace(**spec)
 
-# Create a TCP socket
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.bind((SERVER_HOST, SERVER_PORT))
-server_socket.listen(1)
-print(f'Server is listening on {SERVER_HOST}:{SERVER_PORT}')
-
-# Accept client connection
-client_socket, client_address = server_socket.accept()
-print(f'Client {client_address} connected.')
-
-# Receive mode instruction from the client
-mode = client_socket.recv(1).decode()
-
-if mode not in ['N', 'R']:
-    print("Invalid mode received.")
+    try:
+        if spec.reverse and spec.bidir:
+            return None, "reverse and bidir are mutually exclusive"
+        if not 1 <= stream_count(spec) <= MAX_STREAMS:
+            return None, f"at most {MAX_STREAMS} streams"
+        if not 1 <= spec.buffer_size <= MAX_BUFFER_SIZE:
+            return None, f"buffer_size must be between 1 and {MAX_BUFFER_SIZE}"
+        if spec.iterations < 1:
+            return None, "iterations must be at least 1"
+        if spec.udp and not UDP_HEADER.size <= spec.buffer_size <= MAX_DATAGRAM_SIZE:
+            return None, f"UDP datagram size must be between {UDP_HEADER.size} and {MAX_DATAGRAM_SIZE}"
+        if spec.udp and not (spec.time or spec.bytes):
+            return None, "UDP tests need a time or a byte count"
+        if spec.rr and (spec.udp or spec.reverse or spec.bidir):
+            return None, "request/response tests run over TCP from the client"
+        if spec.rr and not (1 <= spec.request_size <= MAX_BUFFER_SIZE and 1 <= spec.response_size <= MAX_BUFFER_SIZE):
+            return None, f"request and response sizes must be between 1 and {MAX_BUFFER_SIZE}"
+        if spec.constant_rate and spec.phase_time <= 0:
+            return None, "phase_time must be positive"
+        for key in ('sndbuf', 'rcvbuf', 'notsent_lowat'):
+            if getattr(spec, key) is not None and not 1 <= getattr(spec, key) <= MAX_BUFFER_SIZE:
+                return None, f"{key} must be between 1 and {MAX_BUFFER_SIZE}"
+        if spec.congestion is not None and not 0 < len(spec.congestion) < CONGESTION_NAME_SIZE:
+            return None, "malformed congestion control name"
+    except TypeError:
+        return None, "malformed test spec"
+    return spec, None
+
+
+class Session:
+    # One test: its spec, its control channel (None for legacy clients) and its data connections
+
+    def __init__(self, session_id, spec, control=None):
+        self.id = session_id
+        self.spec = spec
+        self.control = control
+        self.streams = {}  # Stream index -> data socket
+        self.udp_sockets = {}  # Stream index -> UDP socket waiting for the client's registration datagram
+        self.udp_stats = {}  # Stream index -> UDP receiver report
+        self.created = time.monotonic()
+        self.test_end = threading.Event()  # The client has sent all its markers
+
+    def complete(self):
+        return len(self.streams) == stream_count(self.spec)
+
+
+def receive_data(session, index, client_socket, tag, results, counter, tracker):
+    start_time = time.time()
+    retrans_at_start = tcp_total_retrans(client_socket)
+
+    throttle = BANDWIDTH_CAP.consume if BANDWIDTH_CAP is not None else None
+    profile = CallProfile('recv', args.profile) if args.profile else None
+    total_data_received, cpu_time, disconnected = receive_all(client_socket, BUFFER_SIZE, counter, args.recv_batch, throttle, profile,
+                                                              native=not args.pure_python)
+    if tracker is not None:
+        tracker.finished.set()
+    if disconnected:
+        print(f"{tag} Client disconnected.")
+
+    elapsed_time = time.time() - start_time
+    throughput_mbps = (total_data_received * 8 / (1024 * 1024)) / elapsed_time
+    print(f"{tag} Total data received: {total_data_received / (1024 * 1024):.2f} MB, Throughput: {throughput_mbps:.2f} Mbps")
+    print(f"{tag} Receiver CPU time: {cpu_time:.2f} s ({cpu_time / elapsed_time * 100:.1f}% of {elapsed_time:.2f} s)")
+    if profile is not None:
+        print(f"{tag} {profile.summary()}")
+    if args.tcp_info:
+        print(f"{tag} {iteration_summary(client_socket, stream_stats(counter), retrans_at_start)}")
+    results.append((None, total_data_received, elapsed_time, index))
     client_socket.close()
-    server_socket.close()
-    exit(1)
 
-if mode == 'N':  # Normal mode: client sends data to server
-    total_data_received = 0
-    print("Normal mode: client is sending data to server.")
-    
-    try:
-        while True:
-            data = client_socket.recv(BUFFER_SIZE)
-            if not data:
-                break
-            total_data_received += len(data)
-
-    except (BrokenPipeError, ConnectionResetError):
-        print("Client disconnected.")
-    finally:
-        print(f"Total data received: {total_data_received / (1024 * 1024):.2f} MB")
-        client_socket.close()
-
-else:  # Reverse mode: server sends data to client
-    print("Reverse mode: server is sending data to client.")
-
-    for i in range(args.iterations):
+
+def send_iterations(session, index, client_socket, tag, results, counter, marker):
+    spec = session.spec
+    target_rate = spec.reverse_target_rate or spec.target_rate  # Rate of the server -> client direction
+    data, payload_fd = get_payload(spec.buffer_size)
+    profile = CallProfile('send', args.profile) if args.profile else None
+    send = make_sender(client_socket, data, payload_fd, counter, profile)
+    if BANDWIDTH_CAP is not None:
+        send = BANDWIDTH_CAP.wrap(send)
+    # Unpaced transfers run in libfastpump when it is built; a profile or the bandwidth cap needs every call in Python
+    pump = make_pump(client_socket, data, payload_fd, counter, send,
+                     native=not args.pure_python and profile is None and BANDWIDTH_CAP is None)
+
+    for i in range(spec.iterations):
+        counter.iteration = i + 1
+        marker.iteration_start(i + 1)
+        retrans_at_start = tcp_total_retrans(client_socket)
         total_data_sent = 0  # Reset total data sent for each iteration
-        avg_throughput_mbps = 0  # Reset avg throughput
+        if profile is not None:
+            profile.start()
 
-        print(f"[Server] Iteration {i+1} started at {datetime.now()}")
+        print(f"{tag} Iteration {i+1} started at {datetime.now()}")
 
         start_time = time.time()
+        iteration_start_time = start_time
 
-        if args.constant_rate:
+        if spec.constant_rate:
             # Phase 1: Increasing Phase
-            if args.rate_based_phase and args.target_rate:
-                print("[Server] Increasing phase based on target rate.")
+            if spec.rate_based_phase and target_rate:
+                print(f"{tag} Increasing phase based on target rate.")
+                marker.phase_start(i + 1, 'increasing')
 
                 # Set target rate for the current iteration
                 if i == 0:
-                    current_target_rate = args.target_rate
+                    current_target_rate = target_rate
                 else:
-                    current_target_rate = args.target_rate * (1 + 0.2 * i)  # Increase by 20% per iteration
+                    current_target_rate = target_rate * (1 + 0.2 * i)  # Increase by 20% per iteration
 
                 current_byte_send = current_target_rate * (1024 * 1024) / 8
 
                 # Increase transfer until target rate is reached
                 while total_data_sent < current_byte_send:
                     remaining_bytes = current_byte_send - total_data_sent
-                    chunk_size = min(len(DATA), int(remaining_bytes))
+                    chunk_size = min(len(data), int(remaining_bytes))
 
                     if chunk_size <= 0:
                         break
 
-                    client_socket.sendall(DATA[:chunk_size])
+                    send(chunk_size)
                     total_data_sent += chunk_size
 
-            elif args.time_based_phase:
-                print("[Server] Increasing phase based on time.")
-
-                increasing_phase_end = time.time() + args.time_based_phase
-
-                while time.time() < increasing_phase_end:
-                    client_socket.sendall(DATA)
-                    total_data_sent += len(DATA)
-                    elapsed_time = time.time() - start_time
-                    throughput_mbps = (total_data_sent * 8 / (1024 * 1024)) / elapsed_time
+            elif spec.time_based_phase:
+                print(f"{tag} Increasing phase based on time.")
+                marker.phase_start(i + 1, 'increasing')
 
+                total_data_sent += pump(seconds=spec.time_based_phase)
                 current_byte_send = total_data_sent
 
 
-            print(f"[Server] Increasing phase ended, total_data_sent = {total_data_sent / (1024 * 1024):.2f} MB")
+            print(f"{tag} Increasing phase ended, total_data_sent = {total_data_sent / (1024 * 1024):.2f} MB")
 
             # Phase 2: Constant Rate Phase
-            constant_phase_end = time.time() + args.consphase_time
+            constant_phase_end = time.time() + spec.phase_time
 
             # Target bytes for the constant phase
             bytes_in_constant_rate = current_byte_send  # Target bytes from the increasing phase
-            bytes_per_second = bytes_in_constant_rate / args.consphase_time  # Calculate bytes per second
+            bytes_per_second = bytes_in_constant_rate / spec.phase_time  # Calculate bytes per second
 
-            print(f"[Server] Constant rate phase started at {datetime.now()} with target bytes {bytes_in_constant_rate:.2f} B")
+            print(f"{tag} Constant rate phase started at {datetime.now()} with target bytes {bytes_in_constant_rate:.2f} B")
+            marker.phase_start(i + 1, 'constant')
 
-            interval = 0.01  # Interval in seconds (10 ms)
-            bytes_per_interval = bytes_per_second * interval  # Bytes to send per interval
+            # Pace the phase (kernel or userspace token bucket) to spread the target bytes evenly over it
+            pacer = make_pacer(client_socket, bytes_per_second, len(data), spec.kernel_pacing)
 
-            # Track start time for pacing
+            # The iteration throughput below is measured from the start of the constant phase
             start_time = time.time()
 
             # Reset constant phase-specific data sent
             constant_phase_data_sent = 0
 
             while time.time() < constant_phase_end:
-                # Calculate remaining bytes to send in this interval
+                # Calculate remaining bytes to send in this phase
                 remaining_bytes = bytes_in_constant_rate - constant_phase_data_sent
-                if remaining_bytes <= 0:
-                    print("remaining_bytes is less than zero")
+                if remaining_bytes < 1:
+                    print(f"{tag} Constant rate phase: target bytes sent before the phase ended.")
                     break
 
-                # Calculate how many bytes to send in this interval
-                chunk_size = min(int(bytes_per_interval), len(DATA))
-                chunk_size = min(chunk_size, int(remaining_bytes))  # Adjust chunk size
-
-                # Send the chunk
-                client_socket.sendall(DATA[:chunk_size])
+                # Wait for the next departure slot and send the chunk
+                chunk_size = pacer.acquire(int(remaining_bytes))
+                send(chunk_size)
                 constant_phase_data_sent += chunk_size
 
-                # Calculate elapsed time and sleep for pacing
-                elapsed_time = time.time() - start_time
-                sleep_time = interval - (elapsed_time % interval)
-                if sleep_time > 0:
-                    time.sleep(sleep_time)
-
             total_data_sent += constant_phase_data_sent  # Update total data sent
-            print(f"[Server] Constant rate ended: total_data_sent = {total_data_sent / (1024 * 1024):.2f} MB, time = {datetime.now()}.")
+            print(f"{tag} Constant rate ended: total_data_sent = {total_data_sent / (1024 * 1024):.2f} MB, time = {datetime.now()}.")
+            pacer.close()
+            print(f"{tag} {pacer.summary()}")
 
         else:
             # Non-constant rate, either bytes or time-based transfer
-            if args.bytes:
-                print(f"[Server] Sending {args.bytes} bytes.")
-                bytes_to_send = args.bytes
-                while bytes_to_send > 0:
-                    chunk_size = min(BUFFER_SIZE, bytes_to_send)
-                    client_socket.sendall(DATA[:chunk_size])
-                    total_data_sent += chunk_size
-                    bytes_to_send -= chunk_size
+            if spec.bytes:
+                print(f"{tag} Sending {spec.bytes} bytes.")
+                marker.phase_start(i + 1, 'transfer')
+                total_data_sent += pump(nbytes=spec.bytes)
+
+            elif spec.time:
+                print(f"{tag} Sending data for {spec.time} seconds.")
+                marker.phase_start(i + 1, 'transfer')
+                total_data_sent += pump(seconds=spec.time)
 
-            elif args.time:
-                print(f"[Server] Sending data for {args.time} seconds.")
-                phase_end_time = time.time() + args.time
-                while time.time() < phase_end_time:
-                    client_socket.sendall(DATA)
-                    total_data_sent += len(DATA)
+        marker.iteration_end(i + 1)
 
         # Log transfer progress
         elapsed_time = time.time() - start_time
         throughput_mbps = (total_data_sent * 8 / (1024 * 1024)) / elapsed_time
-        print(f"[Server] Iteration {i+1} completed, Data sent: {total_data_sent / (1024 * 1024):.2f} MB, Throughput: {throughput_mbps:.2f} Mbps")
+        print(f"{tag} Iteration {i+1} completed, Data sent: {total_data_sent / (1024 * 1024):.2f} MB, Throughput: {throughput_mbps:.2f} Mbps")
+        if profile is not None:
+            print(f"{tag} {profile.summary()}")
+        if args.tcp_info:
+            print(f"{tag} {iteration_summary(client_socket, counter.tcp_stats.get(i + 1), retrans_at_start)}")
+        results.append((i, total_data_sent, time.time() - iteration_start_time, index))
 
         # Sleep between iterations if iteration mode is enabled
-        if args.sleep:
-            print(f"[Server] Iteration {i+1}: Sleeping for {args.sleep} seconds.")
-            time.sleep(args.sleep)
+        if spec.sleep:
+            print(f"{tag} Iteration {i+1}: Sleeping for {spec.sleep} seconds.")
+            time.sleep(spec.sleep)
+
+    client_socket.close()
+
+
+def receive_udp(session, index, stream_socket, tag, results, counter, stop):
+    receiver = make_udp_receiver(stream_socket, counter, tag, args.interval or 1.0)
+    print(f"{tag} UDP receiver: {receiver.backend}")
+    report, cpu_time, elapsed_time = receiver.run(stop)
+    total_data_received = receiver.total.bytes
+
+    throughput_mbps = (total_data_received * 8 / (1024 * 1024)) / elapsed_time
+    print(f"{tag} Total data received: {total_data_received / (1024 * 1024):.2f} MB, Throughput: {throughput_mbps:.2f} Mbps, {report['packets'] / elapsed_time:.0f} pps")
+    print(f"{tag} UDP: {format_report(report)}")
+    print(f"{tag} Receiver CPU time: {cpu_time:.2f} s ({cpu_time / elapsed_time * 100:.1f}% of {elapsed_time:.2f} s)")
+    session.udp_stats[index] = report
+    results.append((None, total_data_received, elapsed_time, index))
+    stream_socket.close()
+
+
+def answer_rr(session, index, client_socket, tag, results, counter, tracker):
+    spec = session.spec
+    start_time = time.time()
+    transactions, total_data_received, cpu_time, disconnected = answer_requests(client_socket, spec.request_size, spec.response_size, counter)
+    if disconnected:
+        print(f"{tag} Client disconnected.")
+
+    elapsed_time = time.time() - start_time
+    print(f"{tag} Answered {transactions} requests of {spec.request_size} B with {spec.response_size} B in {elapsed_time:.2f} s, {transactions / elapsed_time:.0f} transactions/s")
+    print(f"{tag} Receiver CPU time: {cpu_time:.2f} s ({cpu_time / elapsed_time * 100:.1f}% of {elapsed_time:.2f} s)")
+    results.append((None, total_data_received, elapsed_time, index))
+    client_socket.close()
+
+
+def send_udp_iterations(session, index, stream_socket, tag, results, counter, marker):
+    spec = session.spec
+    rate_mbps = spec.reverse_target_rate or spec.target_rate or DEFAULT_RATE
+    sender = make_udp_sender(stream_socket, spec.buffer_size, counter)
+    print(f"{tag} UDP sender: {sender.backend}")
+
+    for i in range(spec.iterations):
+        counter.iteration = i + 1
+        marker.iteration_start(i + 1)
+        print(f"{tag} Iteration {i+1} started at {datetime.now()}")
+        if spec.bytes:
+            print(f"{tag} Sending {spec.bytes} bytes of UDP at {rate_mbps} Mbps.")
+        else:
+            print(f"{tag} Sending UDP at {rate_mbps} Mbps for {spec.time} seconds.")
+        marker.phase_start(i + 1, 'transfer')
+
+        start_time = time.time()
+        datagrams, pacer = sender.send_paced(rate_mbps * 1024 * 1024 / 8, None if spec.bytes else spec.time, spec.bytes)
+        marker.iteration_end(i + 1)
+
+        elapsed_time = time.time() - start_time
+        total_data_sent = datagrams * spec.buffer_size
+        throughput_mbps = (total_data_sent * 8 / (1024 * 1024)) / elapsed_time
+        print(f"{tag} Iteration {i+1} completed, Data sent: {total_data_sent / (1024 * 1024):.2f} MB, Throughput: {throughput_mbps:.2f} Mbps, {datagrams / elapsed_time:.0f} pps")
+        print(f"{tag} {pacer.summary()}")
+        results.append((i, total_data_sent, elapsed_time, index))
+
+        if spec.sleep:
+            print(f"{tag} Iteration {i+1}: Sleeping for {spec.sleep} seconds.")
+            time.sleep(spec.sleep)
+
+    sender.finish()
+    if sender.errors:
+        print(f"{tag} {sender.errors} datagram(s) dropped by the local stack (ENOBUFS).")
+    stream_socket.close()
+
+
+def stream_function(spec, sending):
+    if spec.rr:
+        return answer_rr
+    if sending:
+        return send_udp_iterations if spec.udp else send_iterations
+    return receive_udp if spec.udp else receive_data
+
+
+def run_worker_stream(job, stream_socket, counter, control, stop):
+    # One stream inside a worker process (see workers.py); returns (results, UDP report)
+    session = Session(job['session'], argparse.Namespace(**job['spec']))
+    index = job['index']
+    results = []
+    sending = server_sends(session.spec, index)
+    if sending:
+        progress = StreamMarker(control if job['control'] else None, index, counter)
+    else:
+        progress = stop if session.spec.udp else None  # The parent's IterationTracker reads the shared counter
+    stream_function(session.spec, sending)(session, index, stream_socket, job['tag'], results, counter, progress)
+    return results, session.udp_stats.get(index)
+
+
+def report_aggregate(results, label, prefix):
+    # Sum the bytes of all streams per iteration (plus the receivers' totals);
+    # the slowest stream defines the elapsed time
+    for i in sorted(set(r[0] for r in results), key=lambda i: -1 if i is None else i):
+        iteration_results = [r for r in results if r[0] == i]
+        total_bytes = sum(r[1] for r in iteration_results)
+        elapsed_time = max(r[2] for r in iteration_results)
+        throughput_mbps = (total_bytes * 8 / (1024 * 1024)) / elapsed_time
+        name = f"Iteration {i+1}" if i is not None else "Total"
+        print(f"{prefix}[SUM] {name}, {label}: {total_bytes / (1024 * 1024):.2f} MB, Throughput: {throughput_mbps:.2f} Mbps")
+
+
+def run_session(session, prefix):
+    spec = session.spec
+    control = session.control
+    results = []
+    senders = []
+    receivers = []
+    trackers = {}  # Stream index -> IterationTracker when receiving TCP over a control channel
+
+    if spec.udp:
+        print(f"Session {session.id:08x}: UDP, {spec.buffer_size} byte datagrams.")
+    if spec.rr:
+        print(f"Session {session.id:08x}: Request/response mode: {spec.request_size} B requests, {spec.response_size} B responses.")
+    elif spec.bidir:  # Bidirectional mode: both sides send and receive at the same time
+        print(f"Session {session.id:08x}: Bidirectional mode: client and server are sending data at the same time.")
+    elif not spec.reverse:  # Normal mode: client sends data to server
+        print(f"Session {session.id:08x}: Normal mode: client is sending data to server.")
+    else:  # Reverse mode: server sends data to client
+        print(f"Session {session.id:08x}: Reverse mode: server is sending data to client.")
+    if args.zerocopy and (spec.reverse or spec.bidir) and not spec.udp:
+        print("Zero-copy sender: os.sendfile." if get_payload(spec.buffer_size)[1] is not None else "Zero-copy sender unavailable, using sendall.")
+
+    sampler = None
+    if args.interval:
+        sampler = IntervalSampler(args.interval, f"{session.id:08x}", args.ring_size, args.output, args.format, args.live, args.tcp_info)
+
+    tuning = {key: getattr(spec, key) for key in TUNING_KEYS}
+    tuned = any(value is not None for value in tuning.values())
+    socket_options = {}  # Stream index + 1 -> effective options, sent back with the results
+
+    counters = []
+    for index, stream_socket in sorted(session.streams.items()):
+        sending = server_sends(spec, index)
+        tag = stream_tag(prefix, spec, index, sending)
+        if tuned:
+            notes = apply_options(stream_socket, tuning, not spec.udp)
+            values = socket_options[index + 1] = read_options(stream_socket, not spec.udp)
+            print(f"{tag} {format_options(values)}")
+            for note in notes:
+                print(f"{tag} Warning: {note}")
+            if notes:
+                values['notes'] = notes
+        counter = WORKERS.slots.allocate() if WORKERS else new_counter(not args.pure_python and not args.profile and BANDWIDTH_CAP is None)
+        counters.append(counter)
+        if sampler:
+            sampler.add_stream(index + 1, stream_socket, counter, tag)
+        if not sending and not spec.udp and not spec.rr and control:
+            trackers[index] = IterationTracker(counter, tag, index)
+
+        if WORKERS:
+            thread = WORKERS.stream(session, index, stream_socket, tag, results, counter, session.test_end if spec.udp and not sending else None)
+        else:
+            if sending:
+                progress = StreamMarker(control, index, counter)
+            else:
+                progress = session.test_end if spec.udp else trackers.get(index)
+            thread = threading.Thread(target=stream_function(spec, sending), args=(session, index, stream_socket, tag, results, counter, progress))
+        (senders if sending else receivers).append(thread)
+
+    def handle(message):
+        if message['type'] in MARKER_TYPES and message.get('stream') in trackers:
+            trackers[message['stream']].put(message)
+        elif message['type'] in ('test_end', 'closed'):
+            session.test_end.set()
+
+    if control:
+        control.send('ready')
+        control.start_reader(handle)
+    if sampler:
+        sampler.start()
+    for thread in senders + receivers:
+        thread.start()
+
+    # Tell the client once our side is done sending, so its receivers need not wait any longer
+    for thread in senders:
+        thread.join()
+    if control and senders:
+        control.send('test_end')
+    for thread in receivers:
+        thread.join()
+    if sampler:
+        sampler.stop()
+        sampler.report(prefix)
+
+    if control:
+        # The receivers' results are complete once every marker of the client is applied
+        if trackers:
+            session.test_end.wait(MARKER_TIMEOUT)
+        for tracker in trackers.values():
+            tracker.close()
+            results.extend(tracker.results)
+
+    # Per-direction totals
+    for sending, label in ((False, "Data received"), (True, "Data sent")):
+        direction_results = [r for r in results if server_sends(spec, r[3]) == sending]
+        if spec.parallel > 1 and direction_results:
+            report_aggregate(direction_results, label, prefix)
+
+    if control:
+        try:
+            control.send('results', results=results, udp=session.udp_stats, histograms=sampler.histograms() if sampler else None,
+                         socket_options=socket_options)
+        except OSError:
+            print(f"Session {session.id:08x}: could not send the results, client is gone.")
+        control.close()
+    if WORKERS:
+        for counter in counters:
+            WORKERS.slots.release(counter)
+
+
+def open_session(conn, reason, session_ids):
+    # Read the client's hello from a new control connection and accept or reject the test;
+    # `reason` is set when the server cannot take another session
+    control = ControlChannel(conn)
+    hello = control.recv()
+    if hello['type'] != 'hello' or not isinstance(hello.get('session'), int) or not isinstance(hello.get('spec'), dict):
+        raise ProtocolError("expected hello")
+
+    spec = None
+    if reason is None and hello['session'] in session_ids:
+        reason = "session ID already in use"
+    if reason is None:
+        spec, reason = negotiate_spec(hello['spec'])
+    if reason is not None:
+        print(f"Session {hello['session']:08x} rejected: {reason}.")
+        control.send('reject', reason=reason)
+        control.close()
+        return None
+
+    session = Session(hello['session'], spec, control)
+    if spec.udp:
+        # One UDP socket per stream; the client learns the ports from the accept message
+        for index in range(stream_count(spec)):
+            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp_socket.bind((SERVER_HOST, 0))
+            session.udp_sockets[index] = udp_socket
+
+    control.send('accept', version=PROTOCOL_VERSION, spec=vars(spec),
+                 udp_ports=[session.udp_sockets[index].getsockname()[1] for index in sorted(session.udp_sockets)])
+    print(f"Session {hello['session']:08x}: {stream_count(spec)} stream(s).")
+    return session
+
+
+def serve(server_socket, forever):
+    # Event loop: the selector accepts connections and completes handshakes while
+    # every complete session runs in its own thread. Without `forever` the server
+    # runs a single session and returns once it is over.
+    selector = selectors.DefaultSelector()
+    selector.register(server_socket, selectors.EVENT_READ)
+    if WORKERS:
+        selector.register(WORKERS.wakeup, selectors.EVENT_READ)  # Connections accepted by the workers' listeners
+    max_sessions = args.max_sessions if forever else 1
+    pending = {}  # Session ID -> Session still waiting for data connections
+    udp_pending = {}  # UDP socket -> (session, stream index) waiting for the registration datagram
+    active = {}  # Session ID -> session thread
+    served = 0
+
+    def start(session):
+        nonlocal served
+        del pending[session.id]
+        served += 1
+        thread = threading.Thread(target=run_session, args=(session, f"[Server][{session.id:08x}]" if forever else "[Server]"), daemon=True)
+        thread.start()
+        active[session.id] = thread
+
+    while forever or served < 1 or active:
+        for key, _ in selector.select(timeout=0.5):
+            if key.fileobj is server_socket:
+                conn, address = server_socket.accept()
+                selector.register(conn, selectors.EVENT_READ, address)
+                continue
+
+            if WORKERS and key.fileobj is WORKERS.wakeup:
+                for conn, address in WORKERS.take_connections():
+                    selector.register(conn, selectors.EVENT_READ, address)
+                continue
+
+            if key.fileobj in udp_pending:
+                # The client's registration datagram tells the address of a UDP stream
+                udp_socket = key.fileobj
+                session, index = udp_pending[udp_socket]
+                try:
+                    datagram, address = udp_socket.recvfrom(64)
+                except OSError:
+                    continue
+                if datagram != DATA_CONNECTION + SESSION_HEADER.pack(session.id, index, stream_count(session.spec)):
+                    continue
+                selector.unregister(udp_socket)
+                del udp_pending[udp_socket]
+                udp_socket.connect(address)
+                session.streams[index] = udp_socket
+                if session.complete():
+                    start(session)
+                continue
+
+            conn, address = key.fileobj, key.data
+            selector.unregister(conn)
+            session = None
+            busy = len(active) + len(pending) >= max_sessions or (not forever and served > 0)
+            try:
+                conn.settimeout(HANDSHAKE_TIMEOUT)
+                kind = recv_exact(conn, 1)
+                if kind == CHURN_CONNECTION:
+                    answer_churn(conn)
+                    continue
+                print(f'Client {address} connected.')
+
+                if kind == CONTROL_CONNECTION:
+                    session = open_session(conn, f"server busy, {max_sessions} session(s) already running" if busy else None, set(pending) | set(active))
+                    if session is None:
+                        continue
+                    pending[session.id] = session
+                    for index, udp_socket in session.udp_sockets.items():
+                        udp_pending[udp_socket] = (session, index)
+                        selector.register(udp_socket, selectors.EVENT_READ)
+
+                elif kind == DATA_CONNECTION:
+                    session_id, stream_index, streams_expected = SESSION_HEADER.unpack(recv_exact(conn, SESSION_HEADER.size))
+                    session = pending.get(session_id)
+                    if session is None or session.spec.udp or streams_expected != stream_count(session.spec) or stream_index >= streams_expected:
+                        print(f"Rejected data connection {address}: no matching session {session_id:08x}.")
+                        conn.close()
+                        continue
+                    session.streams[stream_index] = conn
+
+                elif kind in (b'N', b'R') and not busy:
+                    # Legacy client: the mode byte alone starts a single-stream test with the server's options
+                    session = Session(int.from_bytes(os.urandom(4), 'big'), server_spec(kind.decode()))
+                    session.streams[0] = conn
+                    pending[session.id] = session
+                    print(f"Session {session.id:08x}: legacy client, 1 stream(s).")
+
+                else:
+                    print(f"Invalid handshake from {address}." if kind not in (b'N', b'R') else f"Connection {address} rejected: server busy.")
+                    conn.close()
+                    continue
+
+                conn.settimeout(None)
+            except (OSError, ProtocolError) as e:
+                print(f"Invalid handshake from {address}: {e}")
+                conn.close()
+                continue
+
+            if session is not None and session.complete():
+                start(session)
+
+        # Drop sessions whose data connections never arrived
+        for session_id in [s for s, session in pending.items() if time.monotonic() - session.created > HANDSHAKE_TIMEOUT]:
+            session = pending.pop(session_id)
+            print(f"Session {session_id:08x} dropped: only {len(session.streams)} of {stream_count(session.spec)} stream(s) connected.")
+            for conn in session.streams.values():
+                conn.close()
+            for udp_socket in session.udp_sockets.values():
+                if udp_socket in udp_pending:
+                    selector.unregister(udp_socket)
+                    del udp_pending[udp_socket]
+                    udp_socket.close()
+            if session.control:
+                session.control.close()
+
+        # Reap finished sessions
+        for session_id in [s for s, thread in active.items() if not thread.is_alive()]:
+            del active[session_id]
+            if forever:
+                print(f"Session {session_id:08x} finished, {len(active)} session(s) running.")
+
+
+def tune_listener(listener):
+    # Accepted connections inherit the MSS and the receive buffer (hence the window scale) of their listener
+    for note in apply_options(listener, {'rcvbuf': args.rcvbuf, 'mss': args.mss}):
+        print(f"Warning: listening socket {note}")
+
+
+# Fork the workers before the first thread and the listening socket exist
+WORKERS = None
+if args.workers:
+    WORKERS = WorkerPool(args.workers, CounterSlots(args.max_sessions * MAX_STREAMS), run_worker_stream, args.pin_workers,
+                         (SERVER_HOST, SERVER_PORT) if args.reuseport else None, tune_listener)
+    WORKERS.describe()
+
+# Create a TCP socket
+server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+if args.reuseport:
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # Joins the workers' listeners
+tune_listener(server_socket)
+server_socket.bind((SERVER_HOST, SERVER_PORT))
+server_socket.listen(socket.SOMAXCONN)
+print(f'Server is listening on {SERVER_HOST}:{SERVER_PORT}')
+
+if args.serve_forever:
+    print(f"Serving up to {args.max_sessions} concurrent session(s)" + (f", capped at {args.max_bandwidth} Mbps in aggregate." if args.max_bandwidth else "."))
+try:
+    serve(server_socket, args.serve_forever)
+except KeyboardInterrupt:
+    print("Server stopped.")
 
 # Close the server socket
 server_socket.close()
+if WORKERS:
+    WORKERS.close()
@@ -0,0 +1,414 @@
+#!/usr/bin/python3
+
+import argparse
+import atexit
+import json
+import os
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import fastpump
+from pacer import make_pacer
+from receiver import receive_all
+from zerocopy import make_sender
+
+# Loopback regression benchmark for every implementation in the repository.
+# Two kinds of cases run under fixed configurations:
+# - process cases start a server and a client over loopback TCP. They cover the C
+#   binaries as shipped and as built from client_side.c/server_side.c, the basic scripts, the two archive/ generations and the advanced tools
+#   with native and pure Python loops, in normal and reverse mode and at each buffer
+#   size the implementation accepts. The advanced tools also run UDP at constant-rate
+#   targets, and TCP constant-rate phases (advanced_client.py -R --constant_rate, paced
+#   by the server). The transferred bytes are parsed from the total line of the
+#   receiving side (of the sender where the receiver prints none). The
+#   throughput is measured over the client's wall time, so it includes startup and
+#   is meant for comparing an implementation with its own baseline. CPU time comes
+#   from the rusage of both processes.
+# - loop cases run the send/recv engines in this process over a loopback TCP pair
+#   and an AF_UNIX socketpair: the Python and native bulk loops and the pacer at the
+#   constant-rate targets. None of the tools speaks AF_UNIX, so the engines are
+#   measured without them.
+# Every case reports throughput, CPU seconds per GB and, with a rate target, the
+# error of the achieved rate, as the median of --repeats runs. --save stores the
+# results as the baseline. Later runs compare against it and exit with status 1
+# when a metric regressed beyond --threshold percent.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PYTHON = sys.executable
+GB = 1024 * 1024 * 1024
+RECEIVED_TOTAL = re.compile(r'Total data received(?: from client)?: ([\d.]+) MB')  # Receiver totals of every generation
+SERVER_THROUGHPUT = re.compile(r'\[Server\] Total, Data received: [\d.]+ MB in [\d.]+ s, Throughput: ([\d.]+) Mbps')
+SERVER_RECEIVED = re.compile(r'\[Server\] Total, Data received: ([\d.]+) MB')
+PACING_ACHIEVED = re.compile(r'Pacing \([^)]*\): achieved ([\d.]+) Mbps')
+START_TIMEOUT = 5  # Seconds a server gets to start listening
+TIME_WAIT_TIMEOUT = 70  # Seconds a fixed server port may take to leave TIME_WAIT
+EXIT_TIMEOUT = 10  # Seconds a process may run past the test time
+C_SERVER_PORT = 5201  # Compiled into server_side.c
+
+
+class Implementation:
+    # How to run one server/client generation; argument templates take {port}, {time}, {rate},
+    # {rate_total} (rate * time) and {build} (the directory of the C build)
+
+    def __init__(self, name, server, client, reverse=('-R',), server_reverse=(), buffer_option=None,
+                 reverse_buffer=True, port=None, built=False, normal=(), totals=(RECEIVED_TOTAL, RECEIVED_TOTAL), achieved=None):
+        self.name = name
+        self.server = server
+        self.client = client
+        self.reverse = None if reverse is None else list(reverse)  # Client arguments of reverse mode, None: not run
+        self.server_reverse = list(server_reverse)  # Server arguments of reverse mode
+        self.buffer_option = buffer_option  # Client option setting the buffer size, None when fixed
+        self.reverse_buffer = reverse_buffer  # Whether the buffer size also applies to reverse mode
+        self.port = port  # Fixed server port, None when the server takes -p
+        self.built = built  # Runs the C build from source
+        self.normal = list(normal)  # Client arguments of normal mode
+        self.totals = totals  # (normal, reverse) pattern of the line(s) whose MB add up to the bytes transferred
+        self.achieved = achieved  # Pattern of the achieved Mbps in rate cases
+
+    def available(self):
+        if self.built:
+            return build_c() is not None
+        return all(os.path.exists(os.path.join(HERE, part)) for part in self.server[:2] + self.client[:2]
+                   if part.endswith('.py') or part.startswith('./'))
+
+
+def script(name, *arguments):
+    return [PYTHON, name] + list(arguments)
+
+
+CLIENT_ADDRESS = ['-s', '127.0.0.1', '-p', '{port}']
+
+IMPLEMENTATIONS = [
+    # The shipped binaries predate the sources: their reverse mode never completes
+    Implementation('c', ['./server'], ['./client'] + CLIENT_ADDRESS + ['--time', '{time}'], reverse=None,
+                   buffer_option='--buffer_size', port=C_SERVER_PORT),
+    # The C server's reverse mode sends a fixed amount with its own buffer size
+    Implementation('c-source', ['{build}/server_side', '-p', '{port}'], ['{build}/client_side'] + CLIENT_ADDRESS + ['--time', '{time}'],
+                   buffer_option='--buffer_size', reverse_buffer=False, built=True),
+    Implementation('basic', script('server_side.py', '-p', '{port}'), script('client_side.py', *CLIENT_ADDRESS, '-t', '{time}')),
+    # The archive clients print no total when receiving: count what their servers report sending, and
+    # let the server end the run so that it gets to print it
+    Implementation('archive-feature', script('archive/server_side_with_new_feature.py', '-p', '{port}'),
+                   script('archive/client_side_with_new_feature.py', *CLIENT_ADDRESS),
+                   server_reverse=['--time', '{time}'], normal=['-t', '{time}'],
+                   totals=(RECEIVED_TOTAL, re.compile(r'\[Server\] Iteration \d+ completed at [^,]*, Data sent: ([\d.]+) MB'))),
+    Implementation('archive-rate', script('archive/server_side_with_sleep_and_constant_rate.py', '-p', '{port}'),
+                   script('archive/client_side_with_sleep_and_constant_rate.py', *CLIENT_ADDRESS),
+                   server_reverse=['--time', '{time}'], normal=['-t', '{time}'],
+                   totals=(RECEIVED_TOTAL, re.compile(r'\[Server\] Iteration \d+, Total Data sent: ([\d.]+) MB'))),
+    Implementation('advanced', script('advanced_server.py', '-p', '{port}'),
+                   script('advanced_client.py', *CLIENT_ADDRESS, '--time', '{time}'), buffer_option='--buffer_size'),
+    Implementation('advanced-python', script('advanced_server.py', '-p', '{port}', '--pure_python'),
+                   script('advanced_client.py', *CLIENT_ADDRESS, '--time', '{time}', '--pure_python'), buffer_option='--buffer_size'),
+]
+UDP = Implementation('advanced-udp', script('advanced_server.py', '-p', '{port}'),
+                     script('advanced_client.py', *CLIENT_ADDRESS, '-u', '--time', '{time}', '--target_rate', '{rate}'),
+                     totals=(SERVER_RECEIVED, None),
+                     achieved=SERVER_THROUGHPUT)
+# The server paces a reverse constant rate phase: its rate-based increasing phase sends
+# target_rate Mbit, which the constant phase spreads over phase_time seconds
+CONSTANT_RATE = Implementation('advanced-constant', script('advanced_server.py', '-p', '{port}'),
+                               script('advanced_client.py', *CLIENT_ADDRESS, '--iterations', '1'),
+                               reverse=('-R', '--constant_rate', '--rate_based_phase', '--target_rate', '{rate_total}', '--phase_time', '{time}'),
+                               achieved=PACING_ACHIEVED)
+
+parser = argparse.ArgumentParser(description="Loopback regression benchmark of the C and Python implementations")
+parser.add_argument('--time', type=int, default=3, help="Seconds per run (default 3)")
+parser.add_argument('--repeats', type=int, default=3, help="Runs per case; the median counts (default 3)")
+parser.add_argument('--buffer_sizes', type=str, default="4096,131072", help="Comma-separated buffer sizes in bytes (default 4096,131072)")
+parser.add_argument('--rates', type=str, default="100,1000", help="Comma-separated constant-rate targets in Mbps (default 100,1000)")
+parser.add_argument('--only', type=str, default=None, help="Run only the cases whose name matches this regular expression")
+parser.add_argument('--port', type=int, default=5590, help="First server port; every run takes the next one (default 5590)")
+parser.add_argument('--baseline', type=str, default="benchmark_baseline.json", help="Baseline file (default benchmark_baseline.json)")
+parser.add_argument('--save', action='store_true', help="Store the results as the new baseline instead of comparing")
+parser.add_argument('--threshold', type=float, default=10, help="Regression threshold in percent (default 10)")
+parser.add_argument('--output', type=str, default=None, help="Also write the results to this JSON file")
+args = parser.parse_args()
+
+if args.time < 1 or args.repeats < 1:
+    parser.error("--time and --repeats must be at least 1")
+try:
+    BUFFER_SIZES = [int(size) for size in args.buffer_sizes.split(',')]
+    RATES = [float(rate) for rate in args.rates.split(',')]
+except ValueError:
+    parser.error("--buffer_sizes and --rates take comma-separated numbers")
+
+next_port = args.port
+C_BUILD = None  # Directory of the C build from source, once built
+
+
+def build_c():
+    # Compile client_side.c and server_side.c into a temporary directory; returns it, None when impossible
+    global C_BUILD
+    if C_BUILD is None:
+        compiler = shutil.which('cc') or shutil.which('gcc')
+        if compiler is None:
+            return None
+        directory = tempfile.mkdtemp(prefix='netperf-benchmark-')
+        atexit.register(shutil.rmtree, directory, True)
+        try:
+            for name in ('client_side', 'server_side'):
+                subprocess.run([compiler, '-O2', '-o', os.path.join(directory, name), os.path.join(HERE, name + '.c')],
+                               check=True, capture_output=True)
+        except subprocess.CalledProcessError as e:
+            print(f"C build failed: {e.stderr.decode().strip()[-200:]}")
+            return None
+        C_BUILD = directory
+    return C_BUILD
+
+
+def take_port():
+    global next_port
+    port = next_port
+    next_port += 1  # A fresh port per run: the servers do not set SO_REUSEADDR and TIME_WAIT blocks a rebind
+    return port
+
+
+def port_states(port):
+    # TCP states (hex, 0A = LISTEN) of the sockets bound locally to `port`, from /proc/net/tcp; None when unknown
+    try:
+        with open('/proc/net/tcp') as f:
+            lines = f.readlines()[1:]
+    except OSError:
+        return None
+    return [fields[3] for fields in (line.split() for line in lines) if fields[1].endswith(f':{port:04X}')]
+
+
+def listening(port):
+    # Whether a TCP socket listens on `port`; None when unknown
+    states = port_states(port)
+    return None if states is None else '0A' in states
+
+
+def wait_port_free(port):
+    # A fixed server port left in TIME_WAIT by the previous run cannot be bound again until it expires
+    deadline = time.monotonic() + TIME_WAIT_TIMEOUT
+    while port_states(port) and time.monotonic() < deadline:
+        time.sleep(0.5)
+
+
+def wait_exit(process, timeout):
+    # Wait for `process` (killed after `timeout` seconds); returns (exit status, CPU seconds)
+    deadline = time.monotonic() + timeout
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            return process.returncode, usage.ru_utime + usage.ru_stime
+        if time.monotonic() >= deadline:
+            process.kill()
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            return process.returncode, usage.ru_utime + usage.ru_stime
+        time.sleep(0.02)
+
+
+def run_process_case(implementation, reverse, buffer_size, rate=None):
+    # One server/client run; returns the metrics or raises RuntimeError
+    port = implementation.port or take_port()
+    if implementation.port:
+        wait_port_free(port)
+    values = {'port': port, 'time': args.time, 'rate': f"{rate:g}" if rate else '', 'rate_total': round(rate * args.time) if rate else '',
+              'build': C_BUILD}
+    server = [part.format(**values) for part in implementation.server + (implementation.server_reverse if reverse else [])]
+    client = [part.format(**values) for part in implementation.client + (implementation.reverse if reverse else implementation.normal)]
+    if buffer_size is not None:
+        client += [implementation.buffer_option, str(buffer_size)]
+
+    with tempfile.TemporaryFile('w+') as server_out, tempfile.TemporaryFile('w+') as client_out:
+        server_process = subprocess.Popen(server, cwd=HERE, stdout=server_out, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + START_TIMEOUT
+        while not listening(port):
+            if server_process.poll() is not None or time.monotonic() >= deadline or listening(port) is None:
+                break
+            time.sleep(0.02)
+        if listening(port) is None:
+            time.sleep(0.5)  # No /proc: give the server a moment
+        if server_process.poll() is not None:
+            server_out.seek(0)
+            raise RuntimeError(f"server exited: {server_out.read().strip()[-200:]}")
+
+        start = time.perf_counter()
+        client_process = subprocess.Popen(client, cwd=HERE, stdout=client_out, stderr=subprocess.STDOUT)
+        client_status, client_cpu = wait_exit(client_process, args.time + EXIT_TIMEOUT)
+        elapsed = time.perf_counter() - start
+        server_status, server_cpu = wait_exit(server_process, EXIT_TIMEOUT)
+        server_out.seek(0)
+        client_out.seek(0)
+        output = server_out.read() + client_out.read()
+
+    if client_status != 0:
+        raise RuntimeError(f"client exited with {client_status}: {output.strip()[-200:]}")
+    transferred = sum(float(mb) for mb in implementation.totals[reverse].findall(output)) * 1024 * 1024
+    if not transferred:
+        raise RuntimeError("no total of the transferred bytes reported")
+    metrics = {'throughput_mbps': transferred * 8 / (1024 * 1024) / elapsed,
+               'cpu_s_per_gb': (client_cpu + server_cpu) / (transferred / GB)}
+    if rate:
+        match = implementation.achieved.search(output)
+        if match is None:
+            raise RuntimeError("no achieved rate reported")
+        achieved = float(match.group(1))
+        metrics['throughput_mbps'] = achieved
+        metrics['rate_error_pct'] = abs(achieved - rate) / rate * 100
+    return metrics
+
+
+def socket_pair(transport):
+    # Connected (sender, receiver) stream sockets over loopback TCP or AF_UNIX
+    if transport == 'unix':
+        return socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    sender = socket.create_connection(listener.getsockname())
+    receiver, _ = listener.accept()
+    listener.close()
+    return sender, receiver
+
+
+def run_loop_case(transport, engine, buffer_size, rate=None):
+    # The send/recv engines in this process: `engine` is 'python', 'native' or 'paced'
+    sender, receiver = socket_pair(transport)
+    native = engine == 'native'
+    data = b'X' * buffer_size
+    counter, received = fastpump.new_counter(native), []
+    thread = threading.Thread(target=lambda: received.append(receive_all(receiver, buffer_size, fastpump.new_counter(native), native=native)))
+
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    thread.start()
+    send = make_sender(sender, data, None, counter)
+    if engine == 'paced':
+        pacer = make_pacer(sender, rate * 1024 * 1024 / 8, buffer_size)
+        end = time.perf_counter() + args.time
+        while time.perf_counter() < end:
+            send(pacer.acquire(buffer_size))
+        pacer.close()
+    else:
+        fastpump.make_pump(sender, data, None, counter, send, native)(seconds=args.time)
+    sender.shutdown(socket.SHUT_WR)
+    thread.join()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    sender.close()
+    receiver.close()
+
+    transferred = received[0][0]
+    metrics = {'throughput_mbps': transferred * 8 / (1024 * 1024) / elapsed, 'cpu_s_per_gb': cpu / (transferred / GB)}
+    if rate:
+        metrics['rate_error_pct'] = abs(metrics['throughput_mbps'] - rate) / rate * 100
+    return metrics
+
+
+def cases():
+    # (name, function, arguments) of every case, in run order
+    for implementation in IMPLEMENTATIONS:
+        if not implementation.available():
+            continue
+        for reverse in (False, True) if implementation.reverse is not None else (False,):
+            sized = implementation.buffer_option and (implementation.reverse_buffer or not reverse)
+            for buffer_size in BUFFER_SIZES if sized else [None]:
+                name = f"{implementation.name}/tcp/{'reverse' if reverse else 'normal'}" + (f"/{buffer_size}" if buffer_size else "")
+                yield name, run_process_case, (implementation, reverse, buffer_size)
+    for rate in RATES:
+        yield f"{UDP.name}/udp/normal/rate{rate:g}", run_process_case, (UDP, False, None, rate)
+    for rate in RATES:
+        yield f"{CONSTANT_RATE.name}/tcp/reverse/rate{rate:g}", run_process_case, (CONSTANT_RATE, True, None, rate)
+    for transport in ('tcp', 'unix'):
+        for engine in ('python', 'native') if fastpump.available() else ('python',):
+            for buffer_size in BUFFER_SIZES:
+                yield f"loop-{engine}/{transport}/normal/{buffer_size}", run_loop_case, (transport, engine, buffer_size)
+        for rate in RATES:
+            yield f"loop-paced/{transport}/normal/rate{rate:g}", run_loop_case, (transport, 'paced', max(BUFFER_SIZES), rate)
+
+
+def run_case(name, function, arguments):
+    # Median metrics of the case's repeats, None when every run failed
+    runs = []
+    for repeat in range(args.repeats):
+        try:
+            runs.append(function(*arguments))
+        except (RuntimeError, OSError) as e:
+            print(f"{name}: run {repeat + 1} failed: {e}")
+    if not runs:
+        return None
+    return {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+
+
+def compare(name, metrics, baseline):
+    # Regressions of `metrics` against the baseline's, as text
+    regressions = []
+    threshold = args.threshold / 100
+    if metrics['throughput_mbps'] < baseline['throughput_mbps'] * (1 - threshold):
+        regressions.append(f"throughput {baseline['throughput_mbps']:.2f} -> {metrics['throughput_mbps']:.2f} Mbps")
+    if metrics['cpu_s_per_gb'] > baseline['cpu_s_per_gb'] * (1 + threshold):
+        regressions.append(f"CPU {baseline['cpu_s_per_gb']:.3f} -> {metrics['cpu_s_per_gb']:.3f} s/GB")
+    if 'rate_error_pct' in metrics and metrics['rate_error_pct'] > baseline.get('rate_error_pct', 0) + args.threshold:
+        regressions.append(f"rate error {baseline.get('rate_error_pct', 0):.2f} -> {metrics['rate_error_pct']:.2f}%")
+    return regressions
+
+
+def format_row(name, metrics, note):
+    rate_error = f"{metrics['rate_error_pct']:.2f}" if 'rate_error_pct' in metrics else "-"
+    return f"{name:<44} {metrics['throughput_mbps']:>12.2f} {metrics['cpu_s_per_gb']:>10.3f} {rate_error:>8}  {note}"
+
+
+baseline = {}
+if not args.save:
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    except FileNotFoundError:
+        print(f"No baseline {args.baseline}: run with --save to store one.")
+
+selected = [case for case in cases() if args.only is None or re.search(args.only, case[0])]
+print(f"{len(selected)} case(s), {args.repeats} run(s) of {args.time} s each; native loops {'built' if fastpump.available() else 'not built'}")
+print(f"{'Case':<44} {'Mbps':>12} {'CPU s/GB':>10} {'Rate err%':>8}  vs baseline")
+results, regressed, failed = {}, [], []
+for name, function, arguments in selected:
+    metrics = run_case(name, function, arguments)
+    if metrics is None:
+        failed.append(name)
+        if name in baseline:
+            regressed.append(name)  # Worked in the baseline
+        print(f"{name:<44} failed")
+        continue
+    results[name] = metrics
+    if name not in baseline:
+        note = "new" if baseline else ""
+    else:
+        regressions = compare(name, metrics, baseline[name])
+        change = (metrics['throughput_mbps'] / baseline[name]['throughput_mbps'] - 1) * 100
+        note = f"{change:+.1f}% throughput" + (": REGRESSION " + ", ".join(regressions) if regressions else "")
+        if regressions:
+            regressed.append(name)
+    print(format_row(name, metrics, note))
+
+document = {'time': args.time, 'repeats': args.repeats, 'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump(document, f, indent=2)
+if args.save:
+    if args.only and os.path.exists(args.baseline):
+        # A partial run updates its cases and keeps the others
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        stored['results'].update(results)
+        document['results'] = stored['results']
+    with open(args.baseline, 'w') as f:
+        json.dump(document, f, indent=2)
+    print(f"Baseline of {len(results)} case(s) saved to {args.baseline}.")
+
+if failed:
+    print(f"{len(failed)} case(s) failed: {', '.join(failed)}")
+if regressed:
+    print(f"{len(regressed)} case(s) regressed beyond {args.threshold:g}%: {', '.join(regressed)}")
+    sys.exit(1)
@@ -0,0 +1,162 @@
+import socket
+import statistics
+import time
+
+from pacer import drain_send_queue, make_pacer
+from tcp_info import read_tcp_info
+
+# Capacity search for advanced_client.py (--capacity_search).
+# The client sends a series of short constant-rate steps over one stream and
+# finds the highest rate the path sustains. The search doubles the rate until a
+# step fails (exponential probe), then bisects between the highest sustained
+# and the lowest failed rate until the two are within the requested precision.
+# A step is sustained when four conditions hold:
+# - the pacer could offer (nearly) the whole rate;
+# - TCP_INFO's bytes_acked shows that (nearly) all of it was acknowledged within
+#   a grace period after the step, so no backlog built up in the send queue;
+# - the retransmitted share of the step's segments stays under the loss limit;
+# - the median smoothed RTT of the polls that saw new ACKs during the step stays
+#   under the inflation limit, relative to the connection's minimum RTT (polls
+#   before the step's first ACKs still show the previous step's RTT).
+# The search socket always runs with TCP_NODELAY and bursts of at least one MSS,
+# so paced bursts never wait for Nagle or a delayed ACK and inflate the RTT.
+# Every step is one iteration, so the server reports what it received in each.
+
+POLL_NS = 10_000_000  # Poll TCP_INFO every 10 ms during a step
+GRACE_MIN = 0.05  # Seconds the last data of a step gets to be acknowledged at least
+GRACE_RTTS = 4  # ... or this many minimum RTTs, whichever is longer
+DRAIN_TIMEOUT = 5  # Seconds the leftovers of a failed step get to leave before the next one
+DELIVERY_TOLERANCE = 0.05  # A step may offer and deliver 5% less than its rate
+RTT_SLACK_US = 1000  # RTT inflation below 1 ms always passes (LAN and loopback jitter)
+MIN_RATE = 0.1  # Mbps; the search gives up below this
+DEFAULT_START_RATE = 10  # Mbps, without --target_rate
+# TCP_INFO fields a step is judged by; bytes_acked needs Linux 4.1, min_rtt and data_segs_out 4.6
+REQUIRED_FIELDS = ['rtt', 'total_retrans', 'bytes_acked', 'min_rtt', 'data_segs_out']
+
+
+class CapacitySearch:
+    # Rates to try: doubling until the first failure, then bisection
+
+    def __init__(self, start_rate, precision):
+        self.rate = start_rate
+        self.precision = precision  # Relative width of the final interval, e.g. 0.05
+        self.sustained = 0.0  # Highest sustained rate
+        self.failed = None  # Lowest failed rate
+
+    @property
+    def phase(self):
+        return 'probe' if self.failed is None else 'bisect'
+
+    def done(self):
+        if self.failed is None:
+            return False
+        return self.failed - self.sustained <= self.precision * self.failed or self.failed < MIN_RATE
+
+    def record(self, sustained):
+        if sustained:
+            self.sustained = max(self.sustained, self.rate)
+        else:
+            self.failed = self.rate if self.failed is None else min(self.failed, self.rate)
+        self.rate = self.rate * 2 if self.failed is None else (self.sustained + self.failed) / 2
+
+
+def missing_fields(info):
+    # REQUIRED_FIELDS absent from `info` (a shorter struct from an older kernel), all of them without TCP_INFO
+    if info is None:
+        return list(REQUIRED_FIELDS)
+    return [name for name in REQUIRED_FIELDS if name not in info]
+
+
+def read_step_info(sock):
+    # TCP_INFO during a step; the search checked the fields before its first step, so
+    # only a broken connection makes it unavailable here
+    info = read_tcp_info(sock)
+    if info is None:
+        raise ConnectionError("TCP_INFO unavailable during the capacity search")
+    return info
+
+
+def wait_acknowledged(sock, acked_target, timeout):
+    # Wait until TCP_INFO's bytes_acked reaches `acked_target` or `timeout` seconds pass; returns the last TCP_INFO
+    deadline = time.perf_counter() + timeout
+    while True:
+        info = read_step_info(sock)
+        if info['bytes_acked'] >= acked_target or time.perf_counter() >= deadline:
+            return info
+        time.sleep(0.001)
+
+
+def segment_size(sock):
+    # The connection's MSS, 1460 B where it cannot be read
+    try:
+        return sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_MAXSEG)
+    except (OSError, AttributeError):
+        return 1460
+
+
+def run_step(sock, send, rate_mbps, duration, max_chunk, kernel_pacing):
+    # Send at `rate_mbps` for `duration` seconds in bursts of at least one MSS, each
+    # written in sends of up to `max_chunk` bytes; returns the step's measurements
+    drain_send_queue(sock, DRAIN_TIMEOUT)  # Whatever a failed step left behind must not count for this one
+    start = read_step_info(sock)
+    mss = segment_size(sock)
+    burst_limit = max(max_chunk, mss)
+    pacer = make_pacer(sock, rate_mbps * 1024 * 1024 / 8, burst_limit, kernel_pacing, mss)
+    perf_counter_ns = time.perf_counter_ns
+    sent = 0
+    rtts = []  # Smoothed RTT of every poll that saw new ACKs
+    acked = start['bytes_acked']
+
+    start_ns = now = perf_counter_ns()
+    end_ns = start_ns + int(duration * 1e9)
+    next_poll = start_ns + POLL_NS
+    while now < end_ns:
+        burst = pacer.acquire(burst_limit)
+        while burst:
+            chunk_size = min(burst, max_chunk)
+            send(chunk_size)
+            sent += chunk_size
+            burst -= chunk_size
+        now = perf_counter_ns()
+        if now >= next_poll:
+            info = read_step_info(sock)
+            if info['bytes_acked'] > acked:
+                rtts.append(info['rtt'])
+                acked = info['bytes_acked']
+            next_poll = now + POLL_NS
+    pacer.close()
+    elapsed = (now - start_ns) / 1e9
+
+    grace = max(GRACE_MIN, GRACE_RTTS * start['min_rtt'] / 1e6)
+    end = wait_acknowledged(sock, start['bytes_acked'] + sent, grace)
+    segments = max(end['data_segs_out'] - start['data_segs_out'], 1)
+    return {
+        'rate_mbps': rate_mbps,
+        'sent': sent,
+        'elapsed': elapsed,
+        'offered_mbps': sent * 8 / (1024 * 1024) / elapsed,
+        'delivered': min(1.0, (end['bytes_acked'] - start['bytes_acked']) / sent) if sent else 0.0,
+        'loss': (end['total_retrans'] - start['total_retrans']) / segments,
+        'rtt_us': statistics.median(rtts) if rtts else end['rtt'],
+        'min_rtt_us': end['min_rtt'],
+    }
+
+
+def judge_step(step, max_loss, max_inflation):
+    # (sustained, reason the step failed or None)
+    if step['offered_mbps'] < step['rate_mbps'] * (1 - DELIVERY_TOLERANCE):
+        return False, "sender could not keep the rate"
+    if step['delivered'] < 1 - DELIVERY_TOLERANCE:
+        return False, "backlog in the send queue"
+    if step['loss'] > max_loss:
+        return False, "loss"
+    if step['rtt_us'] > step['min_rtt_us'] * max_inflation + RTT_SLACK_US:
+        return False, "RTT inflation"
+    return True, None
+
+
+def format_step(number, phase, step, sustained, reason):
+    return (f"Step {number} ({phase}) at {step['rate_mbps']:.2f} Mbps: offered {step['offered_mbps']:.2f} Mbps, "
+            f"{step['delivered'] * 100:.1f}% acknowledged, loss {step['loss'] * 100:.2f}%, "
+            f"RTT {step['rtt_us'] / 1000:.3f} ms (min {step['min_rtt_us'] / 1000:.3f} ms): "
+            + ("sustained" if sustained else f"failed ({reason})"))
@@ -0,0 +1,82 @@
+import socket
+import threading
+import time
+
+from control import CHURN_CONNECTION
+from histogram import Histogram
+
+# Connection churn test shared by advanced_client.py and advanced_server.py.
+# The client opens many short connections, each announcing itself with the churn
+# byte; the server answers with the same byte and closes first, so the TIME_WAIT
+# state stays on the server and the client's ephemeral ports are freed at once.
+# The connect latency covers the TCP handshake, which the kernel completes
+# before accept(); the response latency also covers the server's accept loop.
+
+CONNECT_TIMEOUT = 5
+
+
+def answer_churn(conn):
+    # Server side of one churn connection whose churn byte has been read
+    try:
+        conn.sendall(CHURN_CONNECTION)
+    except OSError:
+        pass
+    conn.close()
+
+
+class ChurnLoop:
+    # One client thread opening `count` connections back to back
+
+    def __init__(self, address, count):
+        self.address = address
+        self.count = count
+        self.connect_ns = Histogram()
+        self.response_ns = Histogram()
+        self.failed = 0
+
+    def run(self):
+        perf_counter_ns = time.perf_counter_ns
+        for _ in range(self.count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(CONNECT_TIMEOUT)
+            start = perf_counter_ns()
+            try:
+                sock.connect(self.address)
+                connected = perf_counter_ns()
+                sock.sendall(CHURN_CONNECTION)
+                if sock.recv(1) != CHURN_CONNECTION:
+                    raise ConnectionError("unexpected reply")
+                answered = perf_counter_ns()
+                sock.recv(1)  # Wait for the server's FIN
+            except OSError:
+                self.failed += 1
+                sock.close()
+                continue
+            sock.close()
+            self.connect_ns.record(connected - start)
+            self.response_ns.record(answered - start)
+
+
+def run_churn(host, port, count, concurrency):
+    # Open `count` connections, `concurrency` at a time; returns (loops, elapsed seconds)
+    address = (host, port)
+    loops = [ChurnLoop(address, count // concurrency + (i < count % concurrency)) for i in range(concurrency)]
+    threads = [threading.Thread(target=loop.run) for loop in loops]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return loops, time.perf_counter() - start
+
+
+def report_churn(loops, elapsed_time, prefix="[Client]"):
+    connect_ns, response_ns = Histogram(), Histogram()
+    for loop in loops:
+        connect_ns.add(loop.connect_ns)
+        response_ns.add(loop.response_ns)
+    failed = sum(loop.failed for loop in loops)
+    print(f"{prefix} Connection churn: {connect_ns.count} connections in {elapsed_time:.2f} s, "
+          f"{connect_ns.count / elapsed_time:.0f} conn/s with {len(loops)} loop(s), {failed} failed")
+    print(f"{prefix} Connect latency: {connect_ns.summary(1e6, 'ms', 3)}")
+    print(f"{prefix} Response latency: {response_ns.summary(1e6, 'ms', 3)}")
@@ -1,93 +1,61 @@
 #!/bin/python3
 
- 
-
-import http.client
-
-import time
-
- 
-
- 
-
-path = "/dummy_video"
-
-http_cmd = "GET"
-
- 
-
-video_chunk_duration = 4
-
- 
-
-video_segment_encodings = [ {"Encoding-Rate-kbps" : 5000,
-
-                            "Start-Time" : 0,
-
-                            "Stop-Time"  : 12},
-
-                           {"Encoding-Rate-kbps" : 10000,
-
-                            "Start-Time" : 12,
-
-                            "Stop-Time"  : 24}
-
-                          ]
-
- 
-
-host = "172.31.42.18"
-
-port = 5201
-
-conn = http.client.HTTPConnection(host, port)
-
-conn.connect()
-
- 
-
-cnt = 0
-
-begin_time = time.time()
-
-for seg in video_segment_encodings :
-
-    now = seg["Start-Time"]
-
-    headers = {}
-
-    while now < seg["Stop-Time"]:
-
-        headers["Start-Time"] = now
-
-        headers["Stop-Time"] = min(now + video_chunk_duration, seg["Stop-Time"])
-
-        now = headers["Stop-Time"]
-
-        headers["Encoding-Rate-kbps"] = encoding_rate = seg["Encoding-Rate-kbps"]
-
-        cnt += 1
-
- 
-
-        startTime = time.time()
-
-        conn.request(http_cmd, path, headers = headers)
-
-        res = conn.getresponse()
-
-        data = res.read()
-
-        endTime = time.time()
-
-        elapsedTime = endTime - startTime
-
-        wall_clock_time = time.time() - begin_time
-
-        print(f"Time: {wall_clock_time:.6f}, received: #{cnt} chunk, {len(data)} bytes, encoding-rate-kbps: " +
-
-              f"{encoding_rate}, in {elapsedTime:.6f} sec, thrput-mbps: {len(data) * 8 / (1024 * 1024 * elapsedTime):.6}.")
-
-        time.sleep(max(1, now - headers["Start-Time"] - elapsedTime))
-
-    #next video segment
\ No newline at end of file
+import argparse
+import asyncio
+import sys
+
+from abr import ALGORITHMS, DEFAULT_WINDOW
+from viewers import DEFAULT_LADDER, ladder_arg, raise_open_files, run_viewers
+
+# Client of the HTTP streaming emulator: emulates video viewers fetching chunks
+# from server_Feng.py. Every viewer walks an encoding ladder of RATE:SECONDS steps
+# (by default 12 s at 5 Mbps, then 12 s at 10 Mbps) in chunks of --chunk_duration
+# seconds, with a playback buffer deciding when the next chunk is due. A single
+# viewer prints a line per chunk; many viewers (--viewers N) run in one asyncio
+# event loop and are summarized as histograms at the end. With --abr the ladder's
+# rates are the renditions an adaptive bitrate algorithm chooses from per chunk.
+
+parser = argparse.ArgumentParser(description="HTTP video streaming client")
+parser.add_argument('-s', '--server', type=str, default="172.31.42.18", help="Server IP address (default 172.31.42.18)")
+parser.add_argument('-p', '--port', type=int, default=5201, help="Server port (default 5201)")
+parser.add_argument('--path', type=str, default="/dummy_video", help="Path of the video to request (default /dummy_video)")
+parser.add_argument('--chunk_duration', type=float, default=4, help="Video chunk duration in seconds (default 4)")
+parser.add_argument('--ladder', type=ladder_arg, action='append', default=None,
+                    help="Encoding ladder as comma-separated RATE:SECONDS steps, RATE in kbps (default 5000:12,10000:12); "
+                         "repeat to spread viewers over several ladders")
+parser.add_argument('--viewers', type=int, default=1, help="Number of concurrent emulated viewers (default 1)")
+parser.add_argument('--stagger', type=float, default=0, help="Seconds between the starts of consecutive viewers (default 0)")
+parser.add_argument('--max_buffer', type=float, default=12, help="Seconds of video a viewer buffers before it waits to request more (default 12)")
+parser.add_argument('--abr', choices=sorted(ALGORITHMS), default=None,
+                    help="Adaptive bitrate algorithm choosing each chunk's rate among the ladder's rates (default: follow the ladder)")
+parser.add_argument('--video_length', type=float, default=None, help="Seconds of video a viewer plays with --abr (default: the ladder's total seconds)")
+parser.add_argument('--window', type=int, default=DEFAULT_WINDOW, help=f"Chunks in the ABR throughput estimator's window (default {DEFAULT_WINDOW})")
+parser.add_argument('--timeline', type=str, default=None, help="File the per-chunk bitrate, buffer and stall timeline is written to as JSON Lines ('-' for stdout)")
+parser.add_argument('--verbose', action='store_true', help="Print a line per chunk of every viewer (always on with a single viewer)")
+args = parser.parse_args()
+
+if args.viewers < 1:
+    parser.error("--viewers must be at least 1")
+if args.chunk_duration <= 0:
+    parser.error("--chunk_duration must be positive")
+if args.max_buffer < args.chunk_duration:
+    parser.error("--max_buffer must hold at least one chunk")
+if args.video_length is not None and (args.abr is None or args.video_length <= 0):
+    parser.error("--video_length must be positive and needs --abr")
+if args.window < 1:
+    parser.error("--window must be at least 1")
+
+raise_open_files(args.viewers + 64)
+timeline = None if args.timeline is None else sys.stdout if args.timeline == '-' else open(args.timeline, 'w')
+try:
+    stats, elapsed = asyncio.run(run_viewers(args.viewers, (args.server, args.port), args.path, args.ladder or [DEFAULT_LADDER],
+                                             args.chunk_duration, args.max_buffer, args.stagger,
+                                             args.verbose or args.viewers == 1,
+                                             ALGORITHMS.get(args.abr), args.window, timeline, args.video_length))
+except KeyboardInterrupt:
+    print("Client stopped.")
+else:
+    stats.report(elapsed)
+finally:
+    if timeline not in (None, sys.stdout):
+        timeline.close()
@@ -15,6 +15,7 @@ SERVER_HOST = args.server
 SERVER_PORT = args.port
 BUFFER_SIZE = 128 * 1024  # 128 KB buffer size
 DATA = b'X' * BUFFER_SIZE  # Data to be sent in normal mode
+RECV_BUFFER = memoryview(bytearray(BUFFER_SIZE))  # Preallocated receive buffer reused by recv_into
 DOWNLOAD_DURATION = args.time
 LOG_INTERVAL = 1  # Log every 1 second
 
@@ -37,10 +38,10 @@ if args.reverse:
     try:
         # Receive data for the specified duration
         while time.time() - start_time < DOWNLOAD_DURATION:
-            data = client_socket.recv(BUFFER_SIZE)
-            if not data:
+            received = client_socket.recv_into(RECV_BUFFER)
+            if not received:
                 break
-            total_data_received += len(data)
+            total_data_received += received
             
             # Log transfer progress
             if time.time() - log_time >= LOG_INTERVAL:
@@ -56,6 +57,7 @@ if args.reverse:
     
     # Report the total data received
     print(f'Total data received: {total_data_received / (1024 * 1024):.2f} MB')
+    print(f'Receiver CPU time: {time.process_time():.2f} s')
 
 else:
     client_socket.sendall(b'N')
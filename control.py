@@ -0,0 +1,195 @@
+import json
+import queue
+import struct
+import threading
+import time
+
+# Control channel shared by advanced_client.py and advanced_server.py.
+# Every test opens one control connection next to its data connections. The
+# client sends the full test spec over it, the sending side announces every
+# iteration and phase together with the stream offset it starts at, and the
+# server returns its own results once the test is over. Messages are JSON
+# objects framed by the protocol version and the payload length.
+
+PROTOCOL_VERSION = 1
+CONTROL_CONNECTION = b'C'  # First byte of the control connection
+DATA_CONNECTION = b'D'  # First byte of every data connection, followed by SESSION_HEADER
+CHURN_CONNECTION = b'K'  # First byte of a connection churn test connection (see churn.py)
+FRAME_HEADER = struct.Struct('!BI')  # Protocol version, payload length
+SESSION_HEADER = struct.Struct('!IHH')  # Session ID, stream index, number of streams
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+MARKER_TIMEOUT = 10  # Seconds a receiver waits for the data a marker points at
+
+# Test spec sent by the client; the server runs the test with exactly these values
+SPEC_KEYS = ['reverse', 'bidir', 'udp', 'rr', 'parallel', 'iterations', 'sleep', 'constant_rate', 'phase_time', 'target_rate',
+             'reverse_target_rate', 'rate_based_phase', 'time_based_phase', 'bytes', 'time', 'buffer_size', 'kernel_pacing',
+             'request_size', 'response_size', 'sndbuf', 'rcvbuf', 'nodelay', 'notsent_lowat', 'congestion']
+
+MARKER_TYPES = ('iteration_start', 'phase_start', 'iteration_end')
+
+
+def stream_count(spec):
+    # Data connections of a test: bidirectional tests run `parallel` streams per direction
+    return spec.parallel * 2 if spec.bidir else spec.parallel
+
+
+def server_sends(spec, index):
+    # True if the server sends on stream `index`; in bidirectional tests the first
+    # `parallel` streams carry client -> server data and the rest server -> client data
+    return index >= spec.parallel if spec.bidir else spec.reverse
+
+
+def stream_tag(prefix, spec, index, sending):
+    if not spec.bidir:
+        return prefix if spec.parallel == 1 else f"{prefix}[Stream {index+1}]"
+    direction = "TX" if sending else "RX"
+    return f"{prefix}[{direction}]" if spec.parallel == 1 else f"{prefix}[{direction} Stream {index % spec.parallel + 1}]"
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def recv_exact(sock, size):
+    # Read exactly `size` bytes (handshake and control messages only, never in the data path)
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionResetError("Connection closed during handshake")
+        data += chunk
+    return data
+
+
+class ControlChannel:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()  # Stream threads send their markers concurrently
+        self.thread = None
+
+    def send(self, msg_type, **fields):
+        fields['type'] = msg_type
+        payload = json.dumps(fields).encode()
+        with self.lock:
+            self.sock.sendall(FRAME_HEADER.pack(PROTOCOL_VERSION, len(payload)) + payload)
+
+    def recv(self):
+        version, length = FRAME_HEADER.unpack(recv_exact(self.sock, FRAME_HEADER.size))
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError(f"unsupported protocol version {version} (expected {PROTOCOL_VERSION})")
+        if length > MAX_MESSAGE_SIZE:
+            raise ProtocolError(f"control message of {length} bytes is too large")
+        try:
+            message = json.loads(recv_exact(self.sock, length))
+        except ValueError:
+            raise ProtocolError("malformed control message")
+        if not isinstance(message, dict) or 'type' not in message:
+            raise ProtocolError("malformed control message")
+        return message
+
+    def start_reader(self, handle):
+        # Pass every incoming message to handle(message) from a background thread;
+        # handle({'type': 'closed'}) is called once when the connection ends
+        def read():
+            while True:
+                try:
+                    message = self.recv()
+                except (OSError, ProtocolError):
+                    handle({'type': 'closed'})
+                    return
+                handle(message)
+
+        self.thread = threading.Thread(target=read, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.sock.close()
+
+
+class StreamMarker:
+    # Sender side of one stream: announces iteration and phase boundaries with the
+    # number of bytes sent so far. Without a control channel (legacy clients that
+    # only send the mode byte) every call is a no-op.
+
+    def __init__(self, control, stream, counter):
+        self.control = control
+        self.stream = stream
+        self.counter = counter
+
+    def mark(self, event, iteration, phase=None):
+        if self.control is not None:
+            self.control.send(event, stream=self.stream, iteration=iteration, phase=phase, offset=self.counter.bytes)
+
+    def iteration_start(self, iteration):
+        self.mark('iteration_start', iteration)
+
+    def phase_start(self, iteration, phase):
+        self.mark('phase_start', iteration, phase)
+
+    def iteration_end(self, iteration):
+        self.mark('iteration_end', iteration)
+
+
+class IterationTracker:
+    # Receiver side of one stream: applies every marker once the receiver has read up
+    # to its offset, so both sides attribute exactly the same bytes to each iteration
+    # and phase while the durations are measured at the receiver. Markers are handled
+    # on the tracker's own thread, the receive loop only bumps counter.bytes.
+
+    def __init__(self, counter, tag, stream):
+        self.counter = counter
+        self.tag = tag
+        self.stream = stream
+        self.results = []  # (iteration index, bytes, seconds, stream) like the sender's results
+        self.finished = threading.Event()  # Set by the receiver once the data connection is closed
+        self.queue = queue.Queue()
+        self.iteration = None  # (offset, time) of the iteration in progress
+        self.phase = None  # (iteration, phase, offset, time) of the phase in progress
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, message):
+        self.queue.put(message)
+
+    def close(self):
+        # Apply the markers still queued and stop the tracker thread
+        self.finished.set()
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                return
+
+            offset = message['offset']
+            deadline = time.monotonic() + MARKER_TIMEOUT
+            while self.counter.bytes < offset and not self.finished.is_set() and time.monotonic() < deadline:
+                time.sleep(0.0005)
+            now = time.time()
+
+            if self.phase is not None:
+                self.end_phase(offset, now)
+
+            iteration = message['iteration']
+            if message['type'] == 'iteration_start':
+                self.counter.iteration = iteration
+                self.iteration = (offset, now)
+            elif message['type'] == 'phase_start':
+                self.phase = (iteration, message['phase'], offset, now)
+            elif message['type'] == 'iteration_end' and self.iteration is not None:
+                start_offset, start_time = self.iteration
+                self.iteration = None
+                total_bytes, elapsed_time = offset - start_offset, max(now - start_time, 1e-9)
+                self.results.append((iteration - 1, total_bytes, elapsed_time, self.stream))
+                throughput_mbps = (total_bytes * 8 / (1024 * 1024)) / elapsed_time
+                print(f"{self.tag} Iteration {iteration} completed, Data received: {total_bytes / (1024 * 1024):.2f} MB in {elapsed_time:.2f} s, Throughput: {throughput_mbps:.2f} Mbps")
+
+    def end_phase(self, offset, now):
+        iteration, phase, start_offset, start_time = self.phase
+        self.phase = None
+        total_bytes, elapsed_time = offset - start_offset, max(now - start_time, 1e-9)
+        throughput_mbps = (total_bytes * 8 / (1024 * 1024)) / elapsed_time
+        print(f"{self.tag} Iteration {iteration} {phase} phase: received {total_bytes / (1024 * 1024):.2f} MB in {elapsed_time:.2f} s, Throughput: {throughput_mbps:.2f} Mbps")
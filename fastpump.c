@@ -0,0 +1,153 @@
+/*
+ * Native send/recv loops for advanced_client.py and advanced_server.py (fastpump.py).
+ * The loops of client_side.c/server_side.c, with a monotonic clock deadline instead
+ * of clock() (which counts CPU time) and the error handling the Python tools need.
+ * The Python side calls them through ctypes, which releases the GIL for the call,
+ * so the sampler thread and the other streams keep running meanwhile. Every call
+ * adds its bytes to *progress (the stream's counter, when it lives in memory C can
+ * write), so readers on other threads or processes see each send and recv.
+ *
+ * Build next to fastpump.py:
+ *     cc -O2 -shared -fPIC -o libfastpump.so fastpump.c
+ */
+#define _GNU_SOURCE
+#include <errno.h>
+#include <poll.h>
+#include <stddef.h>
+#include <sys/socket.h>
+#include <sys/types.h>
+#include <time.h>
+#ifdef __linux__
+#include <sys/sendfile.h>
+#endif
+
+#ifndef MSG_NOSIGNAL
+#define MSG_NOSIGNAL 0
+#endif
+
+/* The cell is read concurrently by the sampler thread; the add is atomic so that a
+ * cell never loses bytes, also when shared by more than one writer. */
+static void add_progress(long long *progress, long long n)
+{
+    if (progress)
+        __atomic_fetch_add(progress, n, __ATOMIC_RELAXED);
+}
+
+static double now(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+/* Wait until fd is ready for `events` (sockets with a Python timeout are non-blocking);
+ * deadline < 0 waits without a limit. Returns 0 when the deadline passed first. */
+static int wait_ready(int fd, short events, double deadline)
+{
+    struct pollfd pfd = {fd, events, 0};
+    int timeout = -1;
+    if (deadline >= 0) {
+        double left = deadline - now();
+        if (left <= 0)
+            return 0;
+        timeout = (int)(left * 1000) + 1;
+    }
+    int ready = poll(&pfd, 1, timeout);
+    return ready < 0 && errno == EINTR ? 1 : ready;
+}
+
+/*
+ * Send the first `len` bytes of `buf` over and over until `max_bytes` bytes are
+ * sent (max_bytes < 0: no limit) or `seconds` pass; the deadline is checked after
+ * every complete chunk, like the Python loops. With payload_fd >= 0 the chunks are
+ * sent with sendfile from offset 0 of that file, which holds the same bytes.
+ * The bytes sent go to *sent, also on error, and are added to *progress (if not
+ * NULL) as every call returns. Returns 0 or an errno value.
+ */
+int pump_send(int fd, const char *buf, size_t len, int payload_fd, long long max_bytes, double seconds,
+              long long *sent, long long *progress)
+{
+    double deadline = now() + seconds;
+    long long total = 0;
+
+    *sent = 0;
+    while (max_bytes < 0 || total < max_bytes) {
+        size_t chunk = len;
+        if (max_bytes >= 0 && (long long)chunk > max_bytes - total)
+            chunk = (size_t)(max_bytes - total);
+
+        size_t offset = 0;
+        while (offset < chunk) {
+            ssize_t n;
+#ifdef __linux__
+            if (payload_fd >= 0) {
+                off_t file_offset = (off_t)offset;
+                n = sendfile(fd, payload_fd, &file_offset, chunk - offset);
+            } else
+#endif
+                n = send(fd, buf + offset, chunk - offset, MSG_NOSIGNAL);
+            if (n < 0) {
+                if (errno == EINTR)
+                    continue;
+                if (errno == EAGAIN || errno == EWOULDBLOCK) {
+                    if (wait_ready(fd, POLLOUT, -1) < 0) {
+                        *sent = total + offset;
+                        return errno;
+                    }
+                    continue;
+                }
+                *sent = total + offset;
+                return errno;
+            }
+            offset += (size_t)n;
+            add_progress(progress, n);
+        }
+        total += chunk;
+        *sent = total;
+        if (now() >= deadline)
+            break;
+    }
+    return 0;
+}
+
+/*
+ * Receive into `buf` (`len` bytes, overwritten by every read) until end of stream
+ * or until `seconds` pass. Reads never block: when nothing is queued the loop polls
+ * for the time left, so the call returns on time while the peer is idle. MSG_WAITALL
+ * in `flags` therefore only takes what is queued, up to `len` bytes. The bytes
+ * received go to *received and are added to *progress (if not NULL) per read, and
+ * *eof is set when the peer has closed its side. Returns 0 or an errno value.
+ */
+int pump_recv(int fd, char *buf, size_t len, int flags, double seconds, long long *received, int *eof,
+              long long *progress)
+{
+    double deadline = now() + seconds;
+
+    *received = 0;
+    *eof = 0;
+    for (;;) {
+        ssize_t n = recv(fd, buf, len, flags | MSG_DONTWAIT);
+        if (n > 0) {
+            *received += n;
+            add_progress(progress, n);
+            if (now() >= deadline)
+                return 0;
+            continue;
+        }
+        if (n == 0) {
+            *eof = 1;
+            return 0;
+        }
+        if (errno == EINTR)
+            continue;
+        if (errno == EAGAIN || errno == EWOULDBLOCK) {
+            int ready = wait_ready(fd, POLLIN, deadline);
+            if (ready < 0)
+                return errno;
+            if (ready == 0)
+                return 0;
+            continue;
+        }
+        return errno;
+    }
+}
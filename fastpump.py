@@ -0,0 +1,172 @@
+import ctypes
+import os
+import sys
+import time
+
+from sampler import StreamCounter
+
+# Optional native send/recv loops shared by advanced_client.py and advanced_server.py.
+# libfastpump (built from fastpump.c next to this file) runs the bulk send and receive
+# loops in C. ctypes releases the GIL for the duration of a call, so the sampler and the
+# other streams keep running while a stream pumps. A call runs for at most SLICE seconds:
+# between slices Ctrl-C is seen and the Python loop checks the stop condition. The C
+# loops add every send and recv to the stream's counter themselves when its bytes live
+# in memory they can write (a NativeCounter, or a workers.SharedCounter), so the
+# sampler and the iteration markers see the same progress as with the Python loops.
+# When the library is not built (or --pure_python is given) the tools run the same
+# loops in Python; without --pure_python they warn about it at startup.
+
+SLICE = 0.05  # Seconds per native call
+LIBRARY_NAME = 'libfastpump.dylib' if sys.platform == 'darwin' else 'libfastpump.so'
+LIBRARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), LIBRARY_NAME)
+
+
+def load_library():
+    # The ctypes handle of libfastpump next to this file, None when it is not built
+    try:
+        library = ctypes.CDLL(LIBRARY_PATH)
+    except OSError:
+        return None
+    library.pump_send.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int,
+                                  ctypes.c_longlong, ctypes.c_double, ctypes.POINTER(ctypes.c_longlong),
+                                  ctypes.POINTER(ctypes.c_longlong)]
+    library.pump_send.restype = ctypes.c_int
+    library.pump_recv.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                                  ctypes.c_double, ctypes.POINTER(ctypes.c_longlong), ctypes.POINTER(ctypes.c_int),
+                                  ctypes.POINTER(ctypes.c_longlong)]
+    library.pump_recv.restype = ctypes.c_int
+    return library
+
+
+LIBRARY = load_library()
+
+
+def available():
+    return LIBRARY is not None
+
+
+def missing_note():
+    # Why the native loops fall back to Python, None when the library is loaded
+    if LIBRARY is not None:
+        return None
+    problem = "could not be loaded" if os.path.exists(LIBRARY_PATH) else "is not built"
+    return (f"{LIBRARY_NAME} {problem}, the send/recv loops run in Python; "
+            f"build it with: cc -O2 -shared -fPIC -o {LIBRARY_NAME} fastpump.c")
+
+
+class NativeCounter:
+    # sampler.StreamCounter whose bytes live in a ctypes cell, which the native loops
+    # add to on every call while the sampler and the IterationTracker read it
+    __slots__ = ('cell', 'iteration', 'tcp_stats')
+
+    def __init__(self):
+        self.cell = ctypes.c_longlong()
+        self.iteration = 0
+        self.tcp_stats = {}
+
+    @property
+    def bytes(self):
+        return self.cell.value
+
+    @bytes.setter
+    def bytes(self, value):
+        self.cell.value = value
+
+
+def new_counter(native):
+    # A counter for a stream whose loops may run in libfastpump
+    return NativeCounter() if native and LIBRARY is not None else StreamCounter()
+
+
+def pump_send(fd, data, duration, payload_fd=None, max_bytes=None, progress=None):
+    # Send `data` over and over on `fd` for `duration` seconds or until `max_bytes` are sent;
+    # returns the bytes sent, which are also added to the `progress` cell (if given) per call.
+    # An error raises OSError (e.g. BrokenPipeError) after `sent` bytes.
+    sent = ctypes.c_longlong()
+    error = LIBRARY.pump_send(fd, data, len(data), -1 if payload_fd is None else payload_fd,
+                              -1 if max_bytes is None else max_bytes, duration, ctypes.byref(sent), progress)
+    if error:
+        raise OSError(error, os.strerror(error))
+    return sent.value
+
+
+def pump_recv(fd, buffer, duration, flags=0, progress=None):
+    # Receive into `buffer` (a ctypes char array, overwritten) until end of stream or for
+    # `duration` seconds, adding every read to the `progress` cell (if given); returns
+    # (bytes received, end of stream)
+    received = ctypes.c_longlong()
+    eof = ctypes.c_int()
+    error = LIBRARY.pump_recv(fd, ctypes.addressof(buffer), len(buffer), flags, duration,
+                              ctypes.byref(received), ctypes.byref(eof), progress)
+    if error:
+        raise OSError(error, os.strerror(error))
+    return received.value, bool(eof.value)
+
+
+def make_pump(sock, data, payload_fd, counter, send, native):
+    # Return pump(seconds=None, nbytes=None), which sends the payload on `sock` for
+    # `seconds` or until `nbytes` are sent, adds it to counter.bytes and returns the bytes
+    # sent. The loop runs in libfastpump when `native` and the library is loaded, else
+    # it calls send(size) (a zerocopy.make_sender function) once per buffer.
+    chunk = len(data)
+
+    if not native or LIBRARY is None:
+        def pump(seconds=None, nbytes=None):
+            total = 0
+            if nbytes is not None:
+                while total < nbytes:
+                    size = min(chunk, nbytes - total)
+                    send(size)
+                    total += size
+                return total
+            end = time.time() + seconds
+            while time.time() < end:
+                send(chunk)
+                total += chunk
+            return total
+
+        return pump
+
+    fd = sock.fileno()
+    progress = getattr(counter, 'cell', None)
+
+    def pump_native(seconds=None, nbytes=None):
+        total = 0
+        end = None if seconds is None else time.time() + seconds
+        while True:
+            if nbytes is not None:
+                if total >= nbytes:
+                    return total
+                sent = pump_send(fd, data, SLICE, payload_fd, nbytes - total, progress)
+            else:
+                left = end - time.time()
+                if left <= 0:
+                    return total
+                sent = pump_send(fd, data, min(SLICE, left), payload_fd, progress=progress)
+            total += sent
+            if progress is None:
+                counter.bytes += sent
+
+    return pump_native
+
+
+def receive_all_native(sock, buffer_size, counter, flags):
+    # receiver.receive_all with the reads made in libfastpump
+    buffer = (ctypes.c_char * buffer_size)()
+    fd = sock.fileno()
+    progress = getattr(counter, 'cell', None)
+    start_bytes = counter.bytes
+    disconnected = False
+    cpu_start = time.thread_time()
+
+    try:
+        while True:
+            received, eof = pump_recv(fd, buffer, SLICE, flags, progress)
+            if progress is None:
+                counter.bytes += received
+            if eof:
+                break
+    except (BrokenPipeError, ConnectionResetError):
+        disconnected = True
+
+    return counter.bytes - start_bytes, time.thread_time() - cpu_start, disconnected
@@ -0,0 +1,117 @@
+from array import array
+
+# Log-bucketed (HDR-style) histogram used for every distribution the tool reports:
+# transaction and connect latencies, pacing lateness, TCP_INFO RTT polls and
+# per-interval throughput. Values are non-negative integers in the caller's unit
+# (nanoseconds for times, bits per second for rates). Values below SUB_BUCKETS are
+# counted exactly; above that every power of two is split into SUB_BUCKETS / 2
+# linear steps, so any value is kept within 1 / (SUB_BUCKETS / 2) of its true
+# size. The counts live in one fixed array sized by the largest trackable value,
+# so a soak test of millions of samples takes the same memory as ten. Histograms
+# with the same layout merge exactly (add) and travel as JSON (to_dict/from_dict).
+
+SUB_BUCKET_BITS = 8  # 256 sub-buckets: values are kept within 1/128 (0.8%)
+MAX_VALUE = 1 << 40  # ~18 minutes in ns, ~1000 Gbps in bits/s; larger values are counted as MAX_VALUE
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Histogram:
+
+    def __init__(self, max_value=MAX_VALUE, sub_bucket_bits=SUB_BUCKET_BITS):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_buckets = 1 << sub_bucket_bits
+        self.half = self.sub_buckets >> 1
+        self.max_value = max_value
+        self.counts = array('Q', [0]) * (self.index(max_value) + 1)
+        self.count = 0
+        self.total = 0  # Sum of the recorded values, for the exact mean
+        self.min = None
+        self.max = 0
+
+    def index(self, value):
+        if value < self.sub_buckets:
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits
+        return shift * self.half + (value >> shift)
+
+    def highest_equivalent(self, index):
+        # Largest value counted in slot `index`
+        if index < self.sub_buckets:
+            return index
+        shift = index // self.half - 1
+        return ((index - shift * self.half + 1) << shift) - 1
+
+    def record(self, value, count=1):
+        if value < 0:
+            value = 0
+        if value > self.max_value:
+            value = self.max_value
+        if value < self.sub_buckets:
+            self.counts[value] += count
+        else:
+            shift = value.bit_length() - self.sub_bucket_bits
+            self.counts[shift * self.half + (value >> shift)] += count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def add(self, other):
+        # Merge another histogram with the same layout (e.g. another stream's)
+        if len(other.counts) != len(self.counts) or other.sub_bucket_bits != self.sub_bucket_bits:
+            raise ValueError("histograms have different layouts")
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        # Smallest recorded value (within the precision) that `p` percent of the samples do not exceed
+        if not self.count:
+            return 0
+        target = max(1, -(-self.count * p // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.highest_equivalent(index), self.max)
+        return self.max
+
+    def to_dict(self):
+        # JSON-ready form: the layout, the exact totals and the non-empty slots as [index, count, ...]
+        counts = []
+        for index, count in enumerate(self.counts):
+            if count:
+                counts += (index, count)
+        return {'sub_bucket_bits': self.sub_bucket_bits, 'max_value': self.max_value, 'count': self.count,
+                'total': self.total, 'min': self.min, 'max': self.max, 'counts': counts}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data['max_value'], data['sub_bucket_bits'])
+        counts = data['counts']
+        for i in range(0, len(counts), 2):
+            histogram.counts[counts[i]] = counts[i + 1]
+        histogram.count = data['count']
+        histogram.total = data['total']
+        histogram.min = data['min']
+        histogram.max = data['max']
+        return histogram
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self, scale=1e3, unit="us", digits=1):
+        # "min .., p50 .., p90 .., p99 .., p99.9 .., max .., mean .. unit" with values divided by `scale`
+        if not self.count:
+            return "no samples"
+        parts = [f"min {self.min / scale:.{digits}f}"] + [f"p{p:g} {self.percentile(p) / scale:.{digits}f}" for p in PERCENTILES]
+        return f"{', '.join(parts)}, max {self.max / scale:.{digits}f}, mean {self.mean / scale:.{digits}f} {unit} ({self.count} samples)"
@@ -0,0 +1,215 @@
+import socket
+import struct
+import sys
+import threading
+import time
+
+from histogram import Histogram
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+# Pacing engine shared by advanced_client.py and advanced_server.py.
+# All timing runs on time.perf_counter_ns. A wait sleeps for the bulk of the
+# delay and busy-waits only for the last SPIN_NS, so departures stay within a
+# few microseconds of their schedule without burning a core at low rates.
+
+SPIN_NS = 200_000  # Busy-wait the last 200 us of every wait
+BURST_NS = 1_000_000  # Initial burst size: 1 ms worth of data per send
+CREDIT_NS = 50_000_000  # A flow that falls behind may catch up at most 50 ms of data
+MIN_CHUNK = 1024  # Smallest burst, so very low rates do not degrade into tiny writes
+
+# Linux per-socket pacing cap in bytes per second, enforced by the fq qdisc or by
+# TCP's internal pacing; ~0 removes the cap
+SO_MAX_PACING_RATE = getattr(socket, 'SO_MAX_PACING_RATE', 47)
+UNLIMITED_PACING_RATE = 0xFFFFFFFFFFFFFFFF
+SIOCOUTQNSD = 0x894B  # Linux ioctl: bytes in the send queue not yet handed to the device
+
+
+def wait_until(deadline_ns):
+    remaining = deadline_ns - time.perf_counter_ns()
+    if remaining > SPIN_NS:
+        time.sleep((remaining - SPIN_NS) / 1e9)
+    while time.perf_counter_ns() < deadline_ns:
+        pass
+
+
+def set_max_pacing_rate(sock, rate):
+    # Ask the kernel to pace `sock` at `rate` bytes per second; False if unsupported
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_MAX_PACING_RATE, struct.pack('Q', min(int(rate), UNLIMITED_PACING_RATE)))
+    except OSError:
+        return False
+    return True
+
+
+def unsent_bytes(sock):
+    if fcntl is None:
+        return 0
+    try:
+        return struct.unpack('i', fcntl.ioctl(sock.fileno(), SIOCOUTQNSD, b'\0' * 4))[0]
+    except OSError:
+        return 0
+
+
+def drain_send_queue(sock, timeout):
+    # Wait (up to `timeout` seconds) until everything written to `sock` has been sent
+    deadline = time.perf_counter() + timeout
+    while unsent_bytes(sock) > 0 and time.perf_counter() < deadline:
+        time.sleep(0.001)
+
+
+def make_pacer(sock, rate, max_chunk, kernel=False, min_chunk=MIN_CHUNK):
+    # Kernel pacing when requested and available, otherwise the userspace token bucket
+    # whose bursts are at least `min_chunk` bytes (if max_chunk allows)
+    if kernel:
+        # Data queued by the previous phase must leave unpaced before the cap applies
+        drain_send_queue(sock, 1)
+        if set_max_pacing_rate(sock, rate):
+            return KernelPacer(sock, rate, max_chunk)
+    return Pacer(rate, max_chunk, min_chunk)
+
+
+class Pacer:
+    # Token bucket for one flow. acquire() blocks until the next burst is due and
+    # returns its size; the bucket depth (burst size) starts at BURST_NS worth of
+    # data and doubles, up to max_chunk, whenever the sender lags on average more
+    # than two bursts behind its schedule, so high rates need fewer sends per second.
+
+    backend = 'userspace'
+
+    def __init__(self, rate, max_chunk, min_chunk=MIN_CHUNK):
+        self.rate = rate  # Bytes per second
+        self.ns_per_byte = 1e9 / rate
+        self.max_chunk = max_chunk
+        self.chunk = max(min(min_chunk, max_chunk), min(max_chunk, int(rate * BURST_NS / 1e9)))
+        self.start_ns = time.perf_counter_ns()
+        self.next_ns = self.start_ns  # Departure time of the next burst
+        self.bytes = 0
+        self.sends = 0
+        self.late_sum = 0
+        self.late_sq_sum = 0
+        self.late_max = 0
+        self.lateness = Histogram()  # Lateness of every departure in ns
+        self.late_avg = 0  # Moving average of the lateness, drives the burst growth
+        self.end_ns = None
+
+    def acquire(self, limit):
+        # Wait for the next departure slot and return the burst size (at most `limit` bytes)
+        wait_until(self.next_ns)
+        now = time.perf_counter_ns()
+
+        late = now - self.next_ns
+        self.sends += 1
+        self.late_sum += late
+        self.late_sq_sum += late * late
+        if late > self.late_max:
+            self.late_max = late
+        self.lateness.record(int(late))
+
+        if late > CREDIT_NS:
+            # The socket blocked for a while: forfeit credit beyond CREDIT_NS instead of bursting
+            self.next_ns = now - CREDIT_NS
+        self.late_avg += (late - self.late_avg) / 16
+        if self.late_avg > 2 * self.chunk * self.ns_per_byte and self.chunk < self.max_chunk:
+            self.chunk = min(self.chunk * 2, self.max_chunk)
+
+        size = min(self.chunk, limit)
+        self.next_ns += size * self.ns_per_byte
+        self.bytes += size
+        return size
+
+    def close(self):
+        # End of the phase: freeze the elapsed time used by report()
+        self.end_ns = time.perf_counter_ns()
+
+    def report(self):
+        # Achieved rate over the phase and the spread of departure times
+        elapsed_ns = max(1, (self.end_ns or time.perf_counter_ns()) - self.start_ns)
+        achieved = self.bytes * 1e9 / elapsed_ns
+        sends = max(1, self.sends)
+        mean_late = self.late_sum / sends
+        jitter_ns = max(0, self.late_sq_sum / sends - mean_late * mean_late) ** 0.5
+        return {
+            'backend': self.backend,
+            'target_mbps': self.rate * 8 / (1024 * 1024),
+            'achieved_mbps': achieved * 8 / (1024 * 1024),
+            'error_pct': (achieved - self.rate) / self.rate * 100,
+            'jitter_us': jitter_ns / 1000,
+            'max_late_us': self.late_max / 1000,
+            'p50_late_us': self.lateness.percentile(50) / 1000,
+            'p99_late_us': self.lateness.percentile(99) / 1000,
+            'chunk': self.chunk,
+        }
+
+    def summary(self):
+        r = self.report()
+        if r['jitter_us'] is None:
+            timing = "departures timed by the kernel"
+        else:
+            timing = (f"jitter {r['jitter_us']:.1f} us, lateness p50/p99/max {r['p50_late_us']:.1f}/{r['p99_late_us']:.1f}/"
+                      f"{r['max_late_us']:.1f} us")
+        return (f"Pacing ({r['backend']}): achieved {r['achieved_mbps']:.2f} Mbps (target {r['target_mbps']:.2f} Mbps, "
+                f"error {r['error_pct']:+.2f}%), {timing}, burst {r['chunk']} B")
+
+
+class KernelPacer(Pacer):
+    # The kernel paces the socket (SO_MAX_PACING_RATE), so acquire() never waits and
+    # the sender just keeps the socket buffer full; close() lifts the cap again
+
+    backend = 'kernel SO_MAX_PACING_RATE'
+
+    def __init__(self, sock, rate, max_chunk):
+        super().__init__(rate, max_chunk)
+        self.sock = sock
+        self.chunk = max_chunk
+
+    def acquire(self, limit):
+        size = min(self.chunk, limit)
+        self.bytes += size
+        return size
+
+    def report(self):
+        r = super().report()
+        r['jitter_us'] = r['max_late_us'] = r['p50_late_us'] = r['p99_late_us'] = None
+        return r
+
+    def close(self):
+        # Let the kernel pace out what is still queued so the phase ends once its data
+        # has left, as with the userspace pacer, then lift the cap
+        drain_send_queue(self.sock, unsent_bytes(self.sock) * self.ns_per_byte / 1e9 + 0.1)
+        super().close()
+        set_max_pacing_rate(self.sock, UNLIMITED_PACING_RATE)
+
+
+class TokenBucket:
+    # Thread-safe token bucket shared by several flows. Callers that overdraw the
+    # bucket wait off their debt outside the lock.
+
+    def __init__(self, rate, burst):
+        self.rate = rate  # Bytes per second
+        self.burst = burst
+        self.tokens = burst
+        self.last_ns = time.perf_counter_ns()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        with self.lock:
+            now = time.perf_counter_ns()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_ns) * self.rate / 1e9)
+            self.last_ns = now
+            self.tokens -= nbytes
+            debt = -self.tokens
+        if debt > 0:
+            wait_until(now + int(debt * 1e9 / self.rate))
+
+    def wrap(self, send):
+        # Return send(size) that takes `size` tokens before every send
+        def capped_send(size):
+            self.consume(size)
+            send(size)
+        return capped_send
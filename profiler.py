@@ -0,0 +1,153 @@
+import os
+import select
+import socket
+import time
+
+from histogram import Histogram
+
+# Opt-in profiling of the TCP send/recv hot loops (--profile N), shared by
+# advanced_client.py and advanced_server.py. A profiled stream makes every socket
+# call without blocking (MSG_DONTWAIT, or a non-blocking socket for os.sendfile):
+# a call that finds the send buffer full or the receive queue empty fails with
+# EAGAIN and the loop waits for the socket in poll() instead. So the time spent
+# blocked on the socket is measured apart from the time the kernel spends in the
+# calls that move data, and whatever is left of the wall time is spent outside
+# the socket calls: the Python loop itself, pacing and bandwidth cap waits.
+# Waits happen only when the stream would have blocked anyway, so every one of
+# them is timed; the data calls are timed one in `every` with perf_counter_ns and
+# scaled up by the number of calls, which keeps the cost of an untimed call to
+# a countdown. Short writes and reads and EAGAIN results are counted on every call.
+
+DEFAULT_EVERY = 64  # Time one socket call in 64 by default
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+
+class CallProfile:
+    # Socket call statistics of one stream, from start() until summary()
+
+    def __init__(self, name, every=DEFAULT_EVERY):
+        self.name = name  # 'send' or 'recv', for the report
+        self.every = every
+        self.start()
+
+    def start(self):
+        self.countdown = self.every
+        self.calls = 0  # Calls that moved data
+        self.bytes = 0
+        self.short = 0  # Calls that moved less than asked for
+        self.eagain = 0  # Calls that would have blocked
+        self.timed = 0
+        self.timed_ns = 0
+        self.call_ns = Histogram()  # Duration of the timed calls
+        self.blocked_ns = 0  # Time spent waiting in poll() after EAGAIN
+        self.start_ns = time.perf_counter_ns()
+
+    def call(self, function, size, wait, *call_args):
+        # function(*call_args) moves at most `size` bytes without blocking and returns the
+        # number moved; after EAGAIN wait() blocks until the socket is ready and it is retried
+        perf_counter_ns = time.perf_counter_ns
+        while True:
+            self.countdown -= 1
+            try:
+                if self.countdown:
+                    moved = function(*call_args)
+                else:
+                    self.countdown = self.every
+                    start = perf_counter_ns()
+                    moved = function(*call_args)
+                    elapsed = perf_counter_ns() - start
+                    self.timed += 1
+                    self.timed_ns += elapsed
+                    self.call_ns.record(elapsed)
+            except BlockingIOError:
+                self.eagain += 1
+                start = perf_counter_ns()
+                wait()
+                self.blocked_ns += perf_counter_ns() - start
+                continue
+            self.calls += 1
+            self.bytes += moved
+            if moved < size:
+                self.short += 1
+            return moved
+
+    def breakdown(self):
+        # (wall, in calls, blocked, outside the calls) in ns since start(); the time in
+        # calls is extrapolated from the timed ones
+        wall = time.perf_counter_ns() - self.start_ns
+        in_calls = self.timed_ns * self.calls // self.timed if self.timed else 0
+        return wall, in_calls, self.blocked_ns, max(0, wall - in_calls - self.blocked_ns)
+
+    def summary(self):
+        wall, in_calls, blocked, outside = self.breakdown()
+        if not self.calls or not wall:
+            return f"{self.name} profile: no calls"
+        in_calls, blocked, outside = (ns / wall * 100 for ns in (in_calls, blocked, outside))
+        return (f"{self.name} profile: {self.calls} calls (1 in {self.every} timed), {self.bytes / self.calls / 1024:.1f} KB/call, "
+                f"{self.short} short, {self.eagain} EAGAIN; of {wall / 1e9:.2f} s wall {in_calls:.1f}% in {self.name} calls, "
+                f"{blocked:.1f}% blocked on the socket, {outside:.1f}% outside (Python loop, pacing); "
+                f"{self.name} call time {self.call_ns.summary()}")
+
+
+def socket_waiter(sock, events):
+    # wait() for CallProfile.call: block until `sock` is ready for `events`
+    poller = select.poll()
+    poller.register(sock.fileno(), events)
+    return poller.poll
+
+
+def make_profiled_sender(sock, data, payload_fd, counter, profile):
+    # zerocopy.make_sender with every socket call made through `profile`
+    wait = socket_waiter(sock, select.POLLOUT)
+    call = profile.call
+
+    if payload_fd is None:
+        view = memoryview(data)
+        send = sock.send
+
+        def send_profiled(size):
+            offset = 0
+            while offset < size:
+                offset += call(send, size - offset, wait, view[offset:size], MSG_DONTWAIT)
+            counter.bytes += size
+
+        return send_profiled
+
+    sock.setblocking(False)  # os.sendfile has no per-call flag
+    out_fd = sock.fileno()
+    sendfile = os.sendfile
+
+    def sendfile_profiled(size):
+        offset = 0
+        while offset < size:
+            offset += call(sendfile, size - offset, wait, out_fd, payload_fd, offset, size - offset)
+        counter.bytes += size
+
+    return sendfile_profiled
+
+
+def receive_all_profiled(sock, buffer_size, counter, batch, throttle, profile):
+    # receiver.receive_all with every socket call made through `profile`. A read takes
+    # whatever has arrived, so with batch > 1 the reads are not gathered with MSG_WAITALL
+    # but the short read count shows how full they are.
+    view = memoryview(bytearray(buffer_size * batch))
+    size = len(view)
+    wait = socket_waiter(sock, select.POLLIN)
+    call, recv_into = profile.call, sock.recv_into
+    start_bytes = counter.bytes
+    disconnected = False
+    cpu_start = time.thread_time()
+    profile.start()
+
+    try:
+        while True:
+            received = call(recv_into, size, wait, view, 0, MSG_DONTWAIT)
+            if not received:
+                break
+            counter.bytes += received
+            if throttle is not None:
+                throttle(received)
+    except (BrokenPipeError, ConnectionResetError):
+        disconnected = True
+
+    return counter.bytes - start_bytes, time.thread_time() - cpu_start, disconnected
@@ -0,0 +1,43 @@
+import socket
+import time
+
+import fastpump
+from profiler import receive_all_profiled
+
+# Receiver engine shared by advanced_client.py and advanced_server.py.
+# Data is read with recv_into() into one preallocated buffer, so the hot loop
+# never allocates a bytes object per read. With batch > 1 the buffer holds
+# `batch` reads and MSG_WAITALL lets the kernel fill all of it in one call.
+
+MSG_WAITALL = getattr(socket, 'MSG_WAITALL', 0)
+
+
+def receive_all(sock, buffer_size, counter, batch=1, throttle=None, profile=None, native=False):
+    # Read until EOF, adding every read to counter.bytes; return (bytes received,
+    # receiver thread CPU seconds, peer disconnected abruptly).
+    # throttle(nbytes), if given, is called after every read (e.g. an aggregate bandwidth cap);
+    # with a profiler.CallProfile every read goes through it. With `native` the reads run
+    # in libfastpump when it is built and neither a throttle nor a profile needs every read.
+    if profile is not None:
+        return receive_all_profiled(sock, buffer_size, counter, batch, throttle, profile)
+    flags = MSG_WAITALL if batch > 1 else 0
+    if native and throttle is None and fastpump.available():
+        return fastpump.receive_all_native(sock, buffer_size * batch, counter, flags)
+    view = memoryview(bytearray(buffer_size * batch))
+    recv_into = sock.recv_into
+    start_bytes = counter.bytes
+    disconnected = False
+    cpu_start = time.thread_time()
+
+    try:
+        while True:
+            received = recv_into(view, 0, flags)
+            if not received:
+                break
+            counter.bytes += received
+            if throttle is not None:
+                throttle(received)
+    except (BrokenPipeError, ConnectionResetError):
+        disconnected = True
+
+    return counter.bytes - start_bytes, time.thread_time() - cpu_start, disconnected
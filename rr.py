@@ -0,0 +1,131 @@
+import selectors
+import socket
+import time
+from collections import deque
+
+from histogram import Histogram
+
+# Request/response (TCP_RR-style) engine shared by advanced_client.py and advanced_server.py.
+# The client keeps `outstanding` requests in flight on every connection and records
+# the round-trip time of each transaction in a Histogram; the server answers every
+# complete request with one response. Both sides read into preallocated buffers and
+# answer or refill a whole batch of transactions with one send call. Sends never
+# block: what does not fit in the socket buffer stays owed while the reads go on, so
+# large or many outstanding transactions cannot fill both directions and deadlock.
+
+REQUEST_BYTE = b'Q'
+RESPONSE_BYTE = b'A'
+ANSWER_BATCH = 64  # Requests the server reads (and answers) per call at most
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0x40)
+
+
+def set_nodelay(sock):
+    # Small requests must leave at once instead of waiting for Nagle or delayed ACKs
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
+
+def send_some(sock, selector, data):
+    # Send what fits of `data` without blocking and return the bytes sent; when nothing
+    # fits, wait until the socket takes more or has something to read and return 0
+    try:
+        return sock.send(data, MSG_DONTWAIT)
+    except BlockingIOError:
+        pass
+    selector.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+    selector.select()
+    selector.modify(sock, selectors.EVENT_READ)
+    return 0
+
+
+def answer_requests(sock, request_size, response_size, counter):
+    # Server side: answer every `request_size` bytes with `response_size` bytes until EOF;
+    # returns (transactions, bytes received, thread CPU seconds, peer disconnected abruptly)
+    set_nodelay(sock)
+    view = memoryview(bytearray(request_size * ANSWER_BATCH))
+    responses = memoryview(RESPONSE_BYTE * (response_size * ANSWER_BATCH))
+    recv_into = sock.recv_into
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    pending = owed = transactions = received_total = 0  # owed: response bytes not sent yet
+    disconnected = False
+    cpu_start = time.thread_time()
+
+    try:
+        while True:
+            if owed:
+                owed -= send_some(sock, selector, responses[:min(owed, len(responses))])
+            if owed:
+                try:
+                    received = recv_into(view, 0, MSG_DONTWAIT)
+                except BlockingIOError:
+                    continue
+            else:
+                received = recv_into(view)
+            if not received:
+                break
+            counter.bytes += received
+            received_total += received
+            # Less than one request stays pending, so a read never holds more than ANSWER_BATCH requests
+            answers, pending = divmod(pending + received, request_size)
+            owed += answers * response_size
+            transactions += answers
+    except (BrokenPipeError, ConnectionResetError):
+        disconnected = True
+    finally:
+        selector.close()
+
+    return transactions, received_total, time.thread_time() - cpu_start, disconnected
+
+
+def run_requests(sock, request_size, response_size, outstanding, duration, counter):
+    # Client side: keep `outstanding` requests in flight for `duration` seconds, then
+    # collect the last responses; returns (transactions, elapsed seconds, Histogram of RTTs in ns)
+    set_nodelay(sock)
+    requests = memoryview(REQUEST_BYTE * (request_size * outstanding))
+    view = memoryview(bytearray(response_size * outstanding))
+    recv_into, perf_counter_ns = sock.recv_into, time.perf_counter_ns
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    histogram = Histogram()
+    record = histogram.record
+    sent_at = deque()  # Send time of every request in flight, oldest first
+    pending = transactions = 0
+
+    start = perf_counter_ns()
+    end = start + int(duration * 1e9)
+    sent_at.extend([start] * outstanding)
+    owed = len(requests)  # Request bytes not sent yet, never more than the whole window
+    now = start
+
+    try:
+        while sent_at:
+            if owed:
+                owed -= send_some(sock, selector, requests[:owed])
+            if owed:
+                try:
+                    received = recv_into(view, 0, MSG_DONTWAIT)
+                except BlockingIOError:
+                    continue
+            else:
+                received = recv_into(view)
+            if not received:
+                raise ConnectionError("server closed the connection during the test")
+            counter.bytes += received
+            answers, pending = divmod(pending + received, response_size)
+            if not answers:
+                continue
+            now = perf_counter_ns()
+            for _ in range(answers):
+                record(now - sent_at.popleft())
+            transactions += answers
+            if now < end:
+                # Refill the window: one new request per answered one
+                sent_at.extend([now] * answers)
+                owed += answers * request_size
+    finally:
+        selector.close()
+
+    return transactions, (now - start) / 1e9, histogram
@@ -0,0 +1,217 @@
+import csv
+import json
+import sys
+import threading
+import time
+from collections import deque
+
+from histogram import Histogram
+from tcp_info import SAMPLE_FIELDS, IterationStats, read_tcp_info, sample_fields, stream_stats, tcp_total_retrans
+
+# Interval sampler shared by advanced_client.py and advanced_server.py.
+# The send/recv hot loops only bump StreamCounter.bytes; a side thread snapshots
+# every stream at a fixed interval into a fixed-size ring buffer and writes the
+# samples as JSON Lines or CSV, either live or once the test is over. The interval
+# throughput of every stream (and of all streams together) also goes into a
+# Histogram, so a soak test reports its stalls and tails in fixed memory.
+
+MBPS = 1024 * 1024  # Throughput histograms count bits per second
+
+FIELDS = ['timestamp', 'session', 'stream', 'iteration', 'bytes', 'interval_bytes', 'throughput_mbps', 'retransmits']
+
+
+class StreamCounter:
+    # Progress published by one stream; only the stream's own thread writes bytes, the
+    # stream's thread (sender) or its IterationTracker (receiver) writes iteration, and
+    # only the sampler thread writes the per-iteration TCP_INFO stats
+    __slots__ = ('bytes', 'iteration', 'tcp_stats')
+
+    def __init__(self):
+        self.bytes = 0
+        self.iteration = 0
+        self.tcp_stats = {}  # Iteration -> tcp_info.IterationStats
+
+
+class SampledStream:
+    # One stream of an IntervalSampler: what it reads, and its readings at the last sample
+
+    __slots__ = ('name', 'counter', 'sock', 'tag', 'last_bytes', 'first_retransmits', 'last_retransmits', 'throughput')
+
+    def __init__(self, name, counter, sock, tag):
+        self.name = name
+        self.counter = counter
+        self.sock = sock
+        self.tag = tag  # Label in report()
+        self.last_bytes = 0
+        self.first_retransmits = self.last_retransmits = tcp_total_retrans(sock)  # TCP_INFO total_retrans
+        self.throughput = ThroughputHistogram()
+
+
+class ThroughputHistogram:
+    # Interval throughput of one stream. Empty intervals count once the stream has
+    # carried data and only if more data follows, so the idle time before the first
+    # and after the last byte does not show up as a stall.
+
+    def __init__(self):
+        self.histogram = Histogram()
+        self.idle = None  # Empty intervals since the last data, None before the first data
+
+    def record(self, bits_per_second):
+        if not bits_per_second:
+            if self.idle is not None:
+                self.idle += 1
+            return
+        if self.idle:
+            self.histogram.record(0, self.idle)
+        self.idle = 0
+        self.histogram.record(int(bits_per_second))
+
+
+class IntervalSampler:
+
+    def __init__(self, interval, session, ring_size=10000, output='-', fmt='jsonl', live=False, tcp_info=False):
+        self.interval = interval
+        self.tcp_info = tcp_info  # Add RTT, cwnd and rates from TCP_INFO to every sample
+        self.fields = FIELDS + SAMPLE_FIELDS if tcp_info else FIELDS
+        self.session = session
+        self.samples = deque(maxlen=ring_size)  # Ring buffer: the oldest samples drop out first
+        self.taken = 0
+        self.live = live
+        self.fmt = fmt
+        self.out = None if output is None else sys.stdout if output == '-' else open(output, 'a', newline='')  # None: keep in memory only
+        self.csv_writer = None
+        self.streams = []  # SampledStream per stream
+        self.total_throughput = ThroughputHistogram()  # All streams together
+        self.lock = threading.Lock()
+        self.last_time = time.monotonic()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def add_stream(self, name, sock, counter=None, tag=None):
+        # Sample `sock` and `counter` (a new StreamCounter unless given) under `name`;
+        # `tag` labels the stream in report()
+        counter = counter if counter is not None else StreamCounter()
+        stream = SampledStream(name, counter, sock, tag or f"[Stream {name}]")
+        with self.lock:
+            self.streams.append(stream)
+        return counter
+
+    def retransmits(self, name):
+        # Segments stream `name` retransmitted between add_stream() and the latest sample,
+        # from TCP_INFO's cumulative total_retrans (the ring may have dropped samples since)
+        with self.lock:
+            for stream in self.streams:
+                if stream.name == name:
+                    return stream.last_retransmits - stream.first_retransmits
+        return 0
+
+    def start(self):
+        self.last_time = time.monotonic()
+        self.thread.start()
+
+    def run(self):
+        next_time = self.last_time + self.interval
+        while not self.stop_event.wait(max(0, next_time - time.monotonic())):
+            self.take()
+            next_time += self.interval
+
+    def take(self):
+        now = time.monotonic()
+        elapsed = max(now - self.last_time, 1e-9)
+        self.last_time = now
+        timestamp = time.time()
+        taken = []
+        interval_total = 0
+
+        with self.lock:
+            for stream in self.streams:
+                counter, last_bytes, last_retransmits = stream.counter, stream.last_bytes, stream.last_retransmits
+                total = counter.bytes
+                interval_total += total - last_bytes
+                stream.throughput.record((total - last_bytes) * 8 / elapsed)
+                info = read_tcp_info(stream.sock)
+                retransmits = info['total_retrans'] if info else last_retransmits  # Closed socket: keep the last reading
+                sample = {
+                    'timestamp': round(timestamp, 6),
+                    'session': self.session,
+                    'stream': stream.name,
+                    'iteration': counter.iteration,
+                    'bytes': total,
+                    'interval_bytes': total - last_bytes,
+                    'throughput_mbps': round((total - last_bytes) * 8 / (1024 * 1024) / elapsed, 3),
+                    'retransmits': retransmits - last_retransmits,
+                }
+                if self.tcp_info and info:
+                    sample.update(sample_fields(info))
+                    stats = counter.tcp_stats.get(counter.iteration)
+                    if stats is None:
+                        stats = counter.tcp_stats[counter.iteration] = IterationStats()
+                    stats.add(info)
+                taken.append(sample)
+                stream.last_bytes = total
+                stream.last_retransmits = retransmits
+            self.total_throughput.record(interval_total * 8 / elapsed)
+
+        self.samples.extend(taken)
+        self.taken += len(taken)
+        if self.live:
+            self.write(taken)
+
+    def write(self, samples):
+        if self.out is None:
+            return
+        if self.fmt == 'csv':
+            if self.csv_writer is None:
+                self.csv_writer = csv.DictWriter(self.out, self.fields, restval='')
+                if self.out is sys.stdout or self.out.tell() == 0:
+                    self.csv_writer.writeheader()
+            self.csv_writer.writerows(samples)
+        else:
+            for sample in samples:
+                self.out.write(json.dumps(sample) + '\n')
+        self.out.flush()
+
+    def stop(self):
+        # Take the final (partial) interval and flush whatever has not been written yet
+        self.stop_event.set()
+        self.thread.join()
+        self.take()
+        if not self.live:
+            self.write(self.samples)
+            dropped = self.taken - len(self.samples)
+            if dropped:
+                print(f"Sampler: ring buffer full, the oldest {dropped} sample(s) were dropped.")
+        if self.out is not None and self.out is not sys.stdout:
+            self.out.close()
+
+    def histograms(self):
+        # JSON-ready histograms per stream name plus 'sum' for all streams together
+        data = {}
+        for stream in self.streams:
+            data[stream.name] = {'throughput': stream.throughput.histogram.to_dict()}
+            if self.tcp_info:
+                data[stream.name]['rtt'] = stream_stats(stream.counter).rtt.to_dict()
+        data['sum'] = {'throughput': self.total_throughput.histogram.to_dict()}
+        return data
+
+    def report(self, prefix):
+        report_histograms(self.histograms(), prefix, {stream.name: stream.tag for stream in self.streams})
+
+
+def report_histograms(data, prefix, tags):
+    # Print the histograms of histograms(); the RTTs of all streams are merged into the [SUM] line
+    rtt = None
+    for name, histograms in data.items():
+        tag = f"{prefix}[SUM]" if name == 'sum' else tags.get(name, f"{prefix}[Stream {name}]")
+        if name == 'sum' and len(data) <= 2:
+            continue  # A single stream: the sum repeats its numbers
+        print(f"{tag} Interval throughput: {Histogram.from_dict(histograms['throughput']).summary(MBPS, 'Mbps', 2)}")
+        if 'rtt' in histograms:
+            stream_rtt = Histogram.from_dict(histograms['rtt'])
+            print(f"{tag} RTT: {stream_rtt.summary(1e6, 'ms', 3)}")
+            if rtt is None:
+                rtt = stream_rtt
+            else:
+                rtt.add(stream_rtt)
+    if rtt is not None and len(data) > 2:
+        print(f"{prefix}[SUM] RTT: {rtt.summary(1e6, 'ms', 3)}")
@@ -1,95 +1,160 @@
 #!/usr/bin/python3
 
- 
-
- 
-
-from http.server import HTTPServer, BaseHTTPRequestHandler
-
+import argparse
+import math
+import re
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from random import randbytes
 
-import socketserver
-
-import time
-
- 
-
-port = 5201
-
- 
-
- 
-
- 
-
-class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
-
-    def __init__(self, request, client_address, server):
-
-        self.protocol_version = "HTTP/1.1"
-
-        super().__init__(request, client_address, server)
-
- 
-
-    def get_random_data(l: int):
-
-        return randbytes(l)
-
- 
+from zerocopy import open_payload_file
+
+# Video chunk server of the HTTP streaming emulator (client_Feng.py).
+# Every GET returns one chunk of duration * Encoding-Rate-kbps bits, with the
+# duration taken from the Start-Time/Stop-Time headers (default 5 s at 1 Mbps).
+# Each viewer connection gets its own thread, so hundreds of emulated viewers
+# are served at once. Chunk payloads are never generated per request: they are
+# cut from one pregenerated pool of random (incompressible) bytes. The pool lives
+# in an in-memory file, which is pushed to the socket with os.sendfile. A chunk
+# starts at a pool offset derived from the request (path, rate, start and stop
+# time), so the same chunk always has the same bytes and Range requests for
+# parts of it line up. Chunks larger than the pool wrap around it.
+
+parser = argparse.ArgumentParser(description="HTTP video chunk server")
+parser.add_argument('-p', '--port', type=int, default=5201, help="Server port (default 5201)")
+parser.add_argument('--pool_size', type=int, default=64, help="Size of the pregenerated random payload pool in MB (default 64)")
+parser.add_argument('--verbose', action='store_true', help="Print the headers and a log line of every request")
+args = parser.parse_args()
+
+if args.pool_size < 1:
+    parser.error("--pool_size must be at least 1")
+
+DEFAULT_DURATION = 5  # Default video chunk duration in seconds
+DEFAULT_ENCODING_RATE = 1 * 1024 * 1024  # Default encoding rate: 1 Mbps
+MAX_CHUNK_SIZE = 1024 * 1024 * 1024  # Largest chunk a request may ask for
+IDLE_TIMEOUT = 120  # Seconds a keep-alive connection may stay idle between requests
+LISTEN_BACKLOG = 1024  # Viewers connecting at the same moment
+RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+POOL_SIZE = args.pool_size * 1024 * 1024
+POOL = randbytes(POOL_SIZE)
+POOL_FD = open_payload_file(POOL)  # None: no sendfile, write slices of POOL instead
+# socket.sendfile takes a file object; it only uses the descriptor with explicit offsets
+POOL_FILE = open(POOL_FD, 'rb', buffering=0, closefd=False) if POOL_FD is not None else None
+POOL_VIEW = memoryview(POOL)
+
+
+def chunk_size(headers):
+    # Size in bytes of the chunk a request asks for
+    duration = DEFAULT_DURATION
+    encoding_rate = DEFAULT_ENCODING_RATE
+    if "Encoding-Rate-kbps" in headers:
+        encoding_rate = int(headers["Encoding-Rate-kbps"]) * 1024
+    if "Start-Time" in headers and "Stop-Time" in headers:
+        duration = float(headers["Stop-Time"]) - float(headers["Start-Time"])
+        if not math.isfinite(duration):
+            raise ValueError("non-finite Start-Time or Stop-Time")  # inf/nan, or times too far apart
+        duration = max(1, duration)
+    return int(duration * encoding_rate) // 8
+
+
+def chunk_offset(path, headers):
+    # Pool offset of the chunk's first byte, the same for every request of the chunk
+    key = "\0".join([path] + [headers.get(name, "") for name in ("Encoding-Rate-kbps", "Start-Time", "Stop-Time")])
+    return zlib.crc32(key.encode()) % POOL_SIZE
+
+
+def parse_range(header, size):
+    # (first, last) byte of a single "bytes=" range, None to serve the whole chunk
+    # (no header, several ranges, other units) and ValueError when unsatisfiable
+    match = RANGE.match(header or "")
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+    if first == "":
+        # Suffix range: the last N bytes
+        if int(last) == 0:
+            raise ValueError("unsatisfiable range")
+        first, last = max(0, size - int(last)), size - 1
+    else:
+        first, last = int(first), min(int(last), size - 1) if last else size - 1
+        if match.group(2) and int(match.group(2)) < first:
+            return None  # Invalid range: ignored
+    if first >= size:
+        raise ValueError("unsatisfiable range")
+    return first, last
+
+
+class ChunkRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = IDLE_TIMEOUT
+
+    def do_HEAD(self):
+        self.serve_chunk(send_body=False)
 
     def do_GET(self):
-
-        duration = 5                           #default video chunk duration 5
-
-        encoding_rate = 1 * 1024 * 1024        #default encoding rate 1Mbps
-
- 
-
-        print(self.headers)
-
- 
-
-        if "Encoding-Rate-kbps" in self.headers:
-
-            encoding_rate = int(self.headers["Encoding-Rate-kbps"]) * 1024
-
- 
-
-        if "Start-Time" in self.headers and "Stop-Time" in self.headers:
-
-            start_tm = float(self.headers["Start-Time"])
-
-            stop_tm = float(self.headers["Stop-Time"])
-
-            duration = max(1, stop_tm - start_tm)
-
- 
-
-        size = int((duration * encoding_rate)) // 8
-
- 
-
-        self.send_response(200)
-
+        self.serve_chunk(send_body=True)
+
+    def serve_chunk(self, send_body):
+        if args.verbose:
+            print(self.headers)
+        try:
+            size = chunk_size(self.headers)
+        except (ValueError, OverflowError):  # OverflowError: duration * rate beyond a float
+            self.send_error(400, "Malformed Encoding-Rate-kbps, Start-Time or Stop-Time")
+            return
+        if not 0 <= size <= MAX_CHUNK_SIZE:
+            self.send_error(400, f"Chunk size must be between 0 and {MAX_CHUNK_SIZE} bytes")
+            return
+
+        try:
+            byte_range = parse_range(self.headers.get("Range"), size)
+        except ValueError:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        first, last = byte_range if byte_range else (0, size - 1)
+        self.send_response(206 if byte_range else 200)
         self.send_header("Content-type", "application/stream")
-
         self.send_header("Connection", "keep-alive")
-
-        #self.send_header("keep-alive", "timeout=10, max=30")
-
-        self.send_header("Content-Length", size)
-
+        self.send_header("Accept-Ranges", "bytes")
+        if byte_range:
+            self.send_header("Content-Range", f"bytes {first}-{last}/{size}")
+        self.send_header("Content-Length", str(last - first + 1))
         self.end_headers()
-
-        self.wfile.write(randbytes(size))
-
- 
-
- 
-
-with socketserver.TCPServer(('', port), SimpleHTTPRequestHandler) as httpd:
-
-    print("serving at port", port)
-
-    httpd.serve_forever()
\ No newline at end of file
+        if send_body:
+            self.send_pool(chunk_offset(self.path, self.headers) + first, last - first + 1)
+
+    def send_pool(self, offset, count):
+        # Send `count` pool bytes from `offset` on, wrapping around the end of the pool.
+        # The connection has a timeout (so a non-blocking descriptor), which socket.sendfile
+        # handles by waiting for the socket between its os.sendfile calls.
+        offset %= POOL_SIZE
+        while count > 0:
+            length = min(count, POOL_SIZE - offset)
+            if POOL_FILE is not None:
+                self.connection.sendfile(POOL_FILE, offset, length)
+            else:
+                self.connection.sendall(POOL_VIEW[offset:offset + length])
+            count -= length
+            offset = 0
+
+    def log_message(self, format, *log_args):
+        if args.verbose:
+            super().log_message(format, *log_args)
+
+
+class ChunkServer(ThreadingHTTPServer):
+    daemon_threads = True  # Viewers left connected do not keep the server from exiting
+    request_queue_size = LISTEN_BACKLOG
+
+
+with ChunkServer(('', args.port), ChunkRequestHandler) as httpd:
+    print(f"serving at port {args.port}, {args.pool_size} MB payload pool" + (", sendfile" if POOL_FD is not None else ""))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("Server stopped.")
@@ -108,6 +108,14 @@ int main(int argc, char *argv[]) {
     struct sockaddr_in server_addr, client_addr;
     socklen_t client_addr_len = sizeof(client_addr);
     char mode;
+    int server_port = SERVER_PORT;
+
+    // Parse command-line arguments
+    for (int i = 1; i < argc; i++) {
+        if (strcmp(argv[i], "-p") == 0 && i + 1 < argc) {
+            server_port = atoi(argv[++i]);
+        }
+    }
 
     // Server socket setup
     if ((server_socket = socket(AF_INET, SOCK_STREAM, 0)) < 0) {
@@ -116,7 +124,7 @@ int main(int argc, char *argv[]) {
 
     server_addr.sin_family = AF_INET;
     server_addr.sin_addr.s_addr = INADDR_ANY;
-    server_addr.sin_port = htons(SERVER_PORT);
+    server_addr.sin_port = htons(server_port);
 
     if (bind(server_socket, (struct sockaddr *)&server_addr, sizeof(server_addr)) < 0) {
         handle_error("bind failed");
@@ -126,7 +134,7 @@ int main(int argc, char *argv[]) {
         handle_error("listen failed");
     }
 
-    printf("Server is listening on port %d\n", SERVER_PORT);
+    printf("Server is listening on port %d\n", server_port);
 
     // Accept client connection
     if ((client_socket = accept(server_socket, (struct sockaddr *)&client_addr, &client_addr_len)) < 0) {
@@ -12,6 +12,7 @@ SERVER_HOST = '0.0.0.0'
 SERVER_PORT = args.port
 BUFFER_SIZE = 128 * 1024  # 128 KB buffer size
 DATA = b'X' * BUFFER_SIZE  # The data to be sent
+RECV_BUFFER = memoryview(bytearray(BUFFER_SIZE))  # Preallocated receive buffer reused by recv_into
 LOG_INTERVAL = 1  # Log every 1 second
 
 # Create a TCP socket
@@ -35,10 +36,10 @@ if mode == 'N':  # Normal mode: client sends data to server
     
     try:
         while True:
-            data = client_socket.recv(BUFFER_SIZE)
-            if not data:
+            received = client_socket.recv_into(RECV_BUFFER)
+            if not received:
                 break
-            total_data_received += len(data)
+            total_data_received += received
             
             # Log transfer progress
             if time.time() - log_time >= LOG_INTERVAL:
@@ -51,6 +52,7 @@ if mode == 'N':  # Normal mode: client sends data to server
         print("Client disconnected.")
     finally:
         print(f"Total data received from client: {total_data_received / (1024 * 1024):.2f} MB")
+        print(f"Receiver CPU time: {time.process_time():.2f} s")
         client_socket.close()
 
 else:  # Reverse mode: server sends data to client
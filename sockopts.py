@@ -0,0 +1,137 @@
+import socket
+import sys
+
+from tcp_info import read_tcp_info
+
+# Socket buffer and TCP option tuning shared by advanced_client.py and advanced_server.py.
+# The client's tuning travels in the test spec, so both ends of every data connection
+# get the same options; the server's own options fill in what the client leaves unset.
+# Setting SO_SNDBUF or SO_RCVBUF pins the buffer and turns off the kernel's
+# autotuning for that socket, so the buffers are only touched when asked to. After
+# setting them, the effective values are always read back with getsockopt and reported,
+# because the kernel silently clamps the buffers to net.core.wmem_max/rmem_max.
+
+TCP_NOTSENT_LOWAT = getattr(socket, 'TCP_NOTSENT_LOWAT', 25)
+TCP_CONGESTION = getattr(socket, 'TCP_CONGESTION', 13)
+SO_SNDBUFFORCE = getattr(socket, 'SO_SNDBUFFORCE', 32)  # Ignore wmem_max, needs CAP_NET_ADMIN (Linux)
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+CONGESTION_NAME_SIZE = 16  # TCP_CA_NAME_MAX
+
+TUNING_KEYS = ['sndbuf', 'rcvbuf', 'nodelay', 'notsent_lowat', 'congestion']  # Spec keys, applied to both ends
+AUTO = 'auto'
+AUTO_HEADROOM = 2  # Auto-sized buffers hold twice the bandwidth-delay product
+MIN_AUTO_BUFFER = 256 * 1024  # Smallest auto-sized buffer, LAN and loopback RTTs give tiny products
+
+# Linux doubles a requested buffer size to leave room for its bookkeeping and reports the doubled value
+BUFFER_FACTOR = 2 if sys.platform.startswith('linux') else 1
+
+# (option, FORCE option, sysctl cap) of the two buffers
+BUFFERS = {
+    'sndbuf': (socket.SO_SNDBUF, SO_SNDBUFFORCE, 'net.core.wmem_max'),
+    'rcvbuf': (socket.SO_RCVBUF, SO_RCVBUFFORCE, 'net.core.rmem_max'),
+}
+
+
+def buffer_size_arg(text):
+    # argparse type of --sndbuf/--rcvbuf: bytes with an optional K/M suffix, or 'auto'
+    if text == AUTO:
+        return AUTO
+    scale = {'K': 1024, 'M': 1024 * 1024}.get(text[-1:].upper(), 1)
+    try:
+        size = int(text[:-1] if scale > 1 else text) * scale
+    except ValueError:
+        raise ValueError(f"invalid buffer size {text!r}")
+    if size < 1:
+        raise ValueError("buffer size must be positive")
+    return size
+
+
+def handshake_rtt(sock, connect_time):
+    # RTT of a freshly connected socket in seconds: the kernel's SYN/ACK sample from
+    # TCP_INFO, else the time connect() took
+    info = read_tcp_info(sock)
+    if info and info.get('rtt'):
+        return info['rtt'] / 1e6
+    return connect_time
+
+
+def bdp_buffer(rate_mbps, rtt):
+    # Socket buffer for `rate_mbps` over a path of `rtt` seconds
+    bdp = rate_mbps * 1024 * 1024 / 8 * rtt
+    return max(MIN_AUTO_BUFFER, int(bdp * AUTO_HEADROOM))
+
+
+def set_buffer(sock, name, size):
+    # Set the send or receive buffer, past the sysctl cap when privileged; returns a note when clamped
+    option, force_option, cap = BUFFERS[name]
+    sock.setsockopt(socket.SOL_SOCKET, option, size)
+    if sock.getsockopt(socket.SOL_SOCKET, option) >= size * BUFFER_FACTOR:
+        return None
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, force_option, size)
+    except OSError:
+        pass
+    effective = sock.getsockopt(socket.SOL_SOCKET, option)
+    if effective < size * BUFFER_FACTOR:
+        return f"{name} {size} B clamped to {effective // BUFFER_FACTOR} B by {cap}"
+    return None
+
+
+def apply_options(sock, options, tcp=True):
+    # Apply the tuning in `options` (TUNING_KEYS plus 'mss', None = leave alone) to `sock`;
+    # returns notes on what the kernel refused or clamped. The MSS and the receive buffer's
+    # window scale only take effect when set before connect() or on the listening socket.
+    notes = []
+    for name in BUFFERS:
+        if options.get(name):
+            note = set_buffer(sock, name, options[name])
+            if note:
+                notes.append(note)
+    if not tcp:
+        return notes
+
+    settings = [('nodelay', socket.TCP_NODELAY, 1 if options.get('nodelay') else None),
+                ('notsent_lowat', TCP_NOTSENT_LOWAT, options.get('notsent_lowat')),
+                ('mss', socket.TCP_MAXSEG, options.get('mss'))]
+    if options.get('congestion'):
+        settings.append(('congestion', TCP_CONGESTION, options['congestion'].encode()))
+    for name, option, value in settings:
+        if value is None:
+            continue
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, option, value)
+        except OSError as e:
+            notes.append(f"{name} {value.decode() if isinstance(value, bytes) else value} not set: {e.strerror}")
+    return notes
+
+
+def read_options(sock, tcp=True):
+    # Effective buffer sizes and TCP options of `sock`, as the kernel reports them
+    values = {'sndbuf': sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+              'rcvbuf': sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)}
+    if not tcp:
+        return values
+    for name, option in (('nodelay', socket.TCP_NODELAY), ('notsent_lowat', TCP_NOTSENT_LOWAT), ('mss', socket.TCP_MAXSEG)):
+        try:
+            values[name] = sock.getsockopt(socket.IPPROTO_TCP, option)
+        except OSError:
+            pass
+    try:
+        values['congestion'] = sock.getsockopt(socket.IPPROTO_TCP, TCP_CONGESTION, CONGESTION_NAME_SIZE).split(b'\0', 1)[0].decode()
+    except OSError:
+        pass
+    return values
+
+
+def format_options(values):
+    parts = [f"sndbuf {values['sndbuf']} B", f"rcvbuf {values['rcvbuf']} B"]
+    if 'nodelay' in values:
+        parts.append(f"nodelay {'on' if values['nodelay'] else 'off'}")
+    if 'notsent_lowat' in values:
+        # 0: the socket follows net.ipv4.tcp_notsent_lowat
+        parts.append(f"notsent_lowat {values['notsent_lowat']} B" if values['notsent_lowat'] else "notsent_lowat sysctl")
+    if 'congestion' in values:
+        parts.append(f"congestion {values['congestion']}")
+    if 'mss' in values:
+        parts.append(f"mss {values['mss']} B")
+    return "Socket options: " + ", ".join(parts)
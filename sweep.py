@@ -0,0 +1,105 @@
+import math
+
+from histogram import Histogram
+from tcp_info import stream_stats
+
+# Congestion control sweep for advanced_client.py (--sweep_congestion).
+# The client runs its test spec once per algorithm and repeat. The runs are
+# interleaved (every algorithm once, then the next repeat), so drift in the path
+# or on the hosts spreads evenly over the algorithms. The algorithm is set per
+# socket with TCP_CONGESTION on both ends, so the sysctl stays untouched. Every
+# run yields the goodput the server received on the client's sending streams,
+# plus the retransmits and the RTT distribution that the client's sampler polled
+# from TCP_INFO. The table shows the mean of the repeats with a Student's t 95%
+# confidence interval.
+
+AVAILABLE_CONGESTION = '/proc/sys/net/ipv4/tcp_available_congestion_control'
+
+# Two-sided 95% Student's t quantiles for 1..30 degrees of freedom; beyond that the normal 1.96
+T_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.201, 2.179, 2.160, 2.145, 2.131,
+        2.120, 2.110, 2.101, 2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+COLUMNS = [('throughput_mbps', "Throughput Mbps", 1), ('retransmits', "Retransmits", 0),
+           ('rtt_mean_ms', "RTT avg ms", 3), ('rtt_p99_ms', "RTT p99 ms", 3)]
+
+
+def available_congestion():
+    # Congestion control algorithms the kernel offers, [] when unknown (not Linux)
+    try:
+        with open(AVAILABLE_CONGESTION) as f:
+            return f.read().split()
+    except OSError:
+        return []
+
+
+def congestion_list(text):
+    # argparse type of --sweep_congestion: comma-separated names, or 'all' for every available one
+    if text == 'all':
+        names = available_congestion()
+        if not names:
+            raise ValueError(f"cannot read {AVAILABLE_CONGESTION}")
+        return names
+    names = [name for name in text.split(',') if name]
+    if not names:
+        raise ValueError("no congestion control given")
+    return names
+
+
+def mean_interval(values):
+    # (mean, half width of the 95% confidence interval); no interval from a single run
+    n = len(values)
+    mean = sum(values) / n
+    if n < 2:
+        return mean, None
+    deviation = math.sqrt(sum((v - mean) ** 2 for v in values) / (n - 1))
+    t = T_95[n - 2] if n - 1 <= len(T_95) else 1.96
+    return mean, t * deviation / math.sqrt(n)
+
+
+def run_metrics(sending, client_results, server_results, sampler):
+    # Metrics of one run over the client's sending streams (indexes in `sending`)
+    streams = {}  # Stream index -> [bytes, seconds] as received by the server
+    for i, total_bytes, elapsed_time, index in (tuple(r) for r in server_results.get('results', [])):
+        if index in sending and i is None:
+            streams[index] = [total_bytes, elapsed_time]
+    if not streams:
+        # No server totals (e.g. a UDP test): fall back to what the client sent
+        for i, total_bytes, elapsed_time, index in client_results:
+            if index in sending:
+                stream = streams.setdefault(index, [0, 0])
+                stream[0] += total_bytes
+                stream[1] += elapsed_time
+    throughput_mbps = sum(b * 8 / (1024 * 1024) / s for b, s in streams.values() if s > 0)
+
+    rtt = None
+    for stream in sampler.streams:
+        if stream.name - 1 in sending:
+            stream_rtt = stream_stats(stream.counter).rtt
+            if rtt is None:
+                rtt = stream_rtt
+            else:
+                rtt.add(stream_rtt)
+    rtt = rtt or Histogram()
+    retransmits = sum(sampler.retransmits(index + 1) for index in sending)
+    return {'throughput_mbps': throughput_mbps, 'retransmits': retransmits,
+            'rtt_mean_ms': rtt.mean / 1e6, 'rtt_p99_ms': rtt.percentile(99) / 1e6}
+
+
+def format_table(runs, repeats):
+    # Comparison table of {algorithm: [run metrics]}
+    header = ["Congestion"] + [title for _, title, _ in COLUMNS]
+    rows = []
+    for algorithm, metrics in runs.items():
+        row = [algorithm]
+        for key, _, digits in COLUMNS:
+            if not metrics:
+                row.append("-")
+                continue
+            mean, half_width = mean_interval([m[key] for m in metrics])
+            row.append(f"{mean:.{digits}f}" + (f" ± {half_width:.{digits}f}" if half_width is not None else ""))
+        rows.append(row)
+    widths = [max(len(row[c]) for row in [header] + rows) for c in range(len(header))]
+    lines = [f"Congestion control sweep, {repeats} repeat(s) per algorithm, mean ± 95% confidence interval:"]
+    for row in [header] + rows:
+        lines.append("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+    return "\n".join(lines)
@@ -0,0 +1,131 @@
+import socket
+import struct
+
+from histogram import Histogram
+
+# TCP_INFO parsing (Linux struct tcp_info) for advanced_client.py and advanced_server.py.
+# The sampler thread polls every data socket and feeds IterationStats, so the send
+# and receive loops never call getsockopt themselves.
+
+TCP_INFO = getattr(socket, 'TCP_INFO', 11)
+TCP_INFO_LENGTH = 256
+
+# (name, byte offset, struct format) of the fields we report
+TCP_INFO_FIELDS = [
+    ('rtt', 68, 'I'),  # Smoothed RTT in microseconds
+    ('rttvar', 72, 'I'),  # RTT variance in microseconds
+    ('snd_ssthresh', 76, 'I'),
+    ('snd_cwnd', 80, 'I'),  # Congestion window in segments
+    ('total_retrans', 100, 'I'),
+    ('pacing_rate', 104, 'Q'),  # Bytes per second
+    ('bytes_acked', 120, 'Q'),
+    ('min_rtt', 148, 'I'),  # Lowest RTT seen on the connection in microseconds
+    ('data_segs_out', 156, 'I'),
+    ('delivery_rate', 160, 'Q'),  # Bytes per second
+]
+TCP_INFO_STRUCTS = [(name, offset, struct.Struct('=' + fmt)) for name, offset, fmt in TCP_INFO_FIELDS]
+
+RTT_MAX_NS = 1 << 36  # ~69 s, the RTT histograms are kept per iteration so they stay small
+RTT_SUB_BUCKET_BITS = 7  # RTT percentiles within 1/64
+
+# Columns added to the interval samples
+SAMPLE_FIELDS = ['rtt_us', 'rttvar_us', 'snd_cwnd', 'snd_ssthresh', 'pacing_rate_mbps', 'delivery_rate_mbps']
+
+
+def read_tcp_info(sock):
+    # Parsed TCP_INFO of `sock` as a dict, None when unavailable (closed socket, not Linux)
+    try:
+        raw = sock.getsockopt(socket.IPPROTO_TCP, TCP_INFO, TCP_INFO_LENGTH)
+    except OSError:
+        return None
+    info = {}
+    for name, offset, fmt in TCP_INFO_STRUCTS:
+        # Older kernels return a shorter struct; missing fields stay absent
+        if len(raw) >= offset + fmt.size:
+            info[name] = fmt.unpack_from(raw, offset)[0]
+    return info if 'total_retrans' in info else None
+
+
+def tcp_total_retrans(sock):
+    # Retransmitted segments so far, 0 when TCP_INFO is unavailable
+    info = read_tcp_info(sock)
+    return info['total_retrans'] if info else 0
+
+
+def bytes_to_mbps(rate):
+    return rate * 8 / (1024 * 1024)
+
+
+def sample_fields(info):
+    # TCP_INFO columns of one interval sample
+    return {
+        'rtt_us': info['rtt'],
+        'rttvar_us': info['rttvar'],
+        'snd_cwnd': info['snd_cwnd'],
+        'snd_ssthresh': info['snd_ssthresh'],
+        'pacing_rate_mbps': round(bytes_to_mbps(info.get('pacing_rate', 0)), 3),
+        'delivery_rate_mbps': round(bytes_to_mbps(info.get('delivery_rate', 0)), 3),
+    }
+
+
+class IterationStats:
+    # Min/avg/max of RTT and cwnd plus the RTT distribution (ns) over the polls of one
+    # iteration (written by the sampler thread)
+
+    def __init__(self):
+        self.polls = 0
+        self.rtt_sum = self.cwnd_sum = 0
+        self.rtt_min = self.cwnd_min = None
+        self.rtt_max = self.cwnd_max = 0
+        self.rtt = Histogram(RTT_MAX_NS, RTT_SUB_BUCKET_BITS)
+
+    def add(self, info):
+        rtt, cwnd = info['rtt'], info['snd_cwnd']
+        self.rtt.record(rtt * 1000)
+        self.polls += 1
+        self.rtt_sum += rtt
+        self.cwnd_sum += cwnd
+        self.rtt_min = rtt if self.rtt_min is None else min(self.rtt_min, rtt)
+        self.cwnd_min = cwnd if self.cwnd_min is None else min(self.cwnd_min, cwnd)
+        self.rtt_max = max(self.rtt_max, rtt)
+        self.cwnd_max = max(self.cwnd_max, cwnd)
+
+    def merge(self, other):
+        # Fold the polls of another iteration into this one (e.g. a whole receiving stream)
+        if not other.polls:
+            return
+        self.rtt.add(other.rtt)
+        self.polls += other.polls
+        self.rtt_sum += other.rtt_sum
+        self.cwnd_sum += other.cwnd_sum
+        self.rtt_min = other.rtt_min if self.rtt_min is None else min(self.rtt_min, other.rtt_min)
+        self.cwnd_min = other.cwnd_min if self.cwnd_min is None else min(self.cwnd_min, other.cwnd_min)
+        self.rtt_max = max(self.rtt_max, other.rtt_max)
+        self.cwnd_max = max(self.cwnd_max, other.cwnd_max)
+
+
+def stream_stats(counter):
+    # IterationStats over all iterations of a stream
+    stats = IterationStats()
+    for iteration_stats in list(counter.tcp_stats.values()):
+        stats.merge(iteration_stats)
+    return stats
+
+
+def iteration_summary(sock, stats, retrans_at_start):
+    # One-line TCP summary of an iteration: polled RTT/cwnd ranges plus the current state
+    info = read_tcp_info(sock)
+    if info is None:
+        return "TCP_INFO: unavailable"
+
+    if stats is None or not stats.polls:
+        stats = IterationStats()
+        stats.add(info)
+
+    return (f"TCP_INFO: rtt min/avg/max {stats.rtt_min / 1000:.3f}/{stats.rtt_sum / stats.polls / 1000:.3f}/{stats.rtt_max / 1000:.3f} ms, "
+            f"p50/p99 {stats.rtt.percentile(50) / 1e6:.3f}/{stats.rtt.percentile(99) / 1e6:.3f} ms, "
+            f"rttvar {info['rttvar'] / 1000:.3f} ms, "
+            f"cwnd min/avg/max {stats.cwnd_min}/{stats.cwnd_sum / stats.polls:.0f}/{stats.cwnd_max}, "
+            f"retransmits {info['total_retrans'] - retrans_at_start}, "
+            f"pacing_rate {bytes_to_mbps(info.get('pacing_rate', 0)):.2f} Mbps, "
+            f"delivery_rate {bytes_to_mbps(info.get('delivery_rate', 0)):.2f} Mbps ({stats.polls} polls)")
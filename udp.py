@@ -0,0 +1,555 @@
+import ctypes
+import errno
+import os
+import selectors
+import socket
+import struct
+import sys
+import time
+from array import array
+
+from pacer import Pacer
+
+# UDP test engine shared by advanced_client.py and advanced_server.py.
+# Every datagram starts with a sequence number and the sender's send time. The
+# sender paces datagrams with the userspace Pacer; the receiver scatters the
+# headers of a whole batch of datagrams into one contiguous array (payloads all
+# land in the same scratch buffer) and parses the batch at once, so no bytes
+# object is created per datagram.
+# On Linux both sides move a whole batch per system call with sendmmsg/recvmmsg
+# (through ctypes). The sender lets the kernel split large writes into datagrams
+# with UDP_SEGMENT (GSO) and the receiver takes runs of datagrams back as one
+# message with UDP_GRO, where the kernel supports them. make_udp_sender() and
+# make_udp_receiver() pick the best engine and fall back to one call per datagram.
+
+UDP_HEADER = struct.Struct('!QQ')  # Sequence number, send time in ns (time.time_ns)
+END_SEQUENCE = 0xFFFFFFFFFFFFFFFF  # Sequence number of the datagrams that end a stream
+END_DATAGRAMS = 3  # End datagrams sent per stream (they may be lost like any other)
+DEFAULT_DATAGRAM_SIZE = 1460  # --buffer_size default in UDP mode
+MAX_DATAGRAM_SIZE = 65507
+DEFAULT_RATE = 1  # Mbps when no --target_rate is given, as in iperf
+RECV_BATCH = 64  # Datagrams read before a batch is parsed
+IDLE_TIMEOUT = 0.25  # Seconds without datagrams after which a stopped receiver gives up
+RECV_BUFFER = 4 * 1024 * 1024  # Receive buffer asked for, so bursts survive while the receiver is descheduled
+
+SWAP_HEADERS = sys.byteorder == 'little'  # array('Q') is native order, the header is network order
+
+SEND_BATCH = 64  # Datagrams per sendmmsg call
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)  # Linux GSO: segment size of a large send
+UDP_MAX_SEGMENTS = 64  # Kernel limit of segments per GSO send
+UDP_GRO = getattr(socket, 'UDP_GRO', 104)  # Linux GRO: coalesced datagrams arrive as one message
+GRO_MESSAGE_SIZE = 65536  # Receive buffer per message when GRO is on
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)  # Kernel receive time of every datagram
+CONTROL_WORDS = 8  # Control buffer per message in 64-bit words: timestamp (32 bytes) + GRO segment size (24 bytes)
+TIMESTAMP_CONTROL_SIZE = 32  # cmsghdr + timespec: the control data of a message that only has a timestamp
+# Second word of a cmsghdr (cmsg_level, cmsg_type) read as one little-endian 64-bit word
+TIMESTAMP_CMSG = socket.SOL_SOCKET | SO_TIMESTAMPNS << 32
+GRO_CMSG = socket.SOL_UDP | UDP_GRO << 32
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0x40)
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+# mmsghdr fields read through a uint32 view of the array (64-bit little-endian layout only)
+MMSG_WORDS = ctypes.sizeof(mmsghdr) // 4
+MSG_LEN_WORD = mmsghdr.msg_len.offset // 4
+CONTROLLEN_WORD = msghdr.msg_controllen.offset // 4
+
+libc = None
+if sys.platform.startswith('linux') and sys.byteorder == 'little' and ctypes.sizeof(ctypes.c_void_p) == 8:
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    except (OSError, AttributeError):
+        libc = None
+
+
+def buffer_address(buffer):
+    # Address of a bytearray or array; the buffer must never be resized afterwards
+    if isinstance(buffer, array):
+        return buffer.buffer_info()[0]
+    return ctypes.addressof(ctypes.c_char.from_buffer(buffer))
+
+
+def make_udp_sender(sock, size, counter):
+    # sendmmsg (+ UDP_SEGMENT) sender when available, otherwise one send() per datagram
+    if libc is not None:
+        return MmsgSender(sock, size, counter)
+    return UdpSender(sock, size, counter)
+
+
+def make_udp_receiver(sock, counter, tag, interval=1.0):
+    # recvmmsg (+ UDP_GRO) receiver when available, otherwise one recvmsg_into() per datagram
+    if libc is not None:
+        return MmsgReceiver(sock, counter, tag, interval)
+    return UdpReceiver(sock, counter, tag, interval)
+
+
+class UdpSender:
+
+    backend = 'send'
+
+    def __init__(self, sock, size, counter):
+        self.sock = sock
+        self.size = size
+        self.counter = counter
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.seq = 0
+        self.errors = 0  # Datagrams dropped by the local stack (ENOBUFS)
+
+    def send(self, count):
+        # Send `count` datagrams with consecutive sequence numbers
+        send, view, buffer, pack_into, time_ns = self.sock.send, self.view, self.buffer, UDP_HEADER.pack_into, time.time_ns
+        seq = self.seq
+        for _ in range(count):
+            pack_into(buffer, 0, seq, time_ns())
+            try:
+                send(view)
+            except OSError as e:
+                if e.errno not in (errno.ENOBUFS, errno.EAGAIN):
+                    raise
+                self.errors += 1
+            seq += 1
+        self.seq = seq
+        self.counter.bytes += count * self.size
+
+    def send_paced(self, rate, duration=None, nbytes=None):
+        # Send at `rate` bytes per second for `duration` seconds or until `nbytes` are sent;
+        # returns (datagrams sent, pacer)
+        pacer = Pacer(rate, self.size * SEND_BATCH)
+        limit = -(-nbytes // self.size) if nbytes else None
+        end_time = time.perf_counter() + duration if duration else None
+        credit = 0  # Bytes granted by the pacer but not yet sent as whole datagrams
+        sent = 0
+        while (end_time is None or time.perf_counter() < end_time) and (limit is None or sent < limit):
+            credit += pacer.acquire(self.size * SEND_BATCH)
+            count = credit // self.size
+            if limit is not None:
+                count = min(count, limit - sent)
+            if count:
+                self.send(count)
+                credit -= count * self.size
+                sent += count
+        pacer.close()
+        return sent, pacer
+
+    def finish(self):
+        # Tell the receiver the stream is over
+        UDP_HEADER.pack_into(self.buffer, 0, END_SEQUENCE, time.time_ns())
+        for _ in range(END_DATAGRAMS):
+            try:
+                self.sock.send(self.view[:UDP_HEADER.size])
+            except OSError:
+                break
+
+
+def format_report(r):
+    return f"lost {r['lost']}/{r['packets'] + r['lost']} ({r['loss_pct']:.2f}%), jitter {r['jitter_ms']:.3f} ms, out-of-order {r['out_of_order']}"
+
+
+class UdpStats:
+    # Loss, RFC 3550 interarrival jitter and reordering of one stream (total or one interval)
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.lost = 0
+        self.out_of_order = 0
+
+    def add(self, other):
+        self.packets += other.packets
+        self.bytes += other.bytes
+        self.lost += other.lost
+        self.out_of_order += other.out_of_order
+
+    def report(self, jitter_ns):
+        expected = self.packets + self.lost
+        return {
+            'packets': self.packets,
+            'lost': self.lost,
+            'loss_pct': self.lost / expected * 100 if expected else 0.0,
+            'jitter_ms': jitter_ns / 1e6,
+            'out_of_order': self.out_of_order,
+        }
+
+
+class UdpReceiver:
+    # Receives one stream until its end datagrams arrive, or until `stop` is set and
+    # the socket stays idle; prints one line per `interval` seconds
+
+    backend = 'recvmsg_into'
+
+    def __init__(self, sock, counter, tag, interval=1.0):
+        self.sock = sock
+        self.counter = counter
+        self.tag = tag
+        self.interval = interval
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)  # Capped by net.core.rmem_max
+        except OSError:
+            pass
+        self.headers = bytearray(UDP_HEADER.size * RECV_BATCH)
+        headers_view = memoryview(self.headers)
+        payload = memoryview(bytearray(MAX_DATAGRAM_SIZE))
+        # Datagram i of a batch: header into slot i of self.headers, the rest into the shared payload buffer
+        self.buffers = [[headers_view[i * UDP_HEADER.size:(i + 1) * UDP_HEADER.size], payload] for i in range(RECV_BATCH)]
+        # Per datagram of the last batch: size, sequence number, send time and arrival time (ns)
+        self.sizes = array('q', [0]) * RECV_BATCH
+        self.arrivals = array('q', [0]) * RECV_BATCH
+        self.seqs = self.stamps = array('Q')
+        self.expected = 0  # Next sequence number in order
+        self.transit = None  # Transit time of the first datagram of the previous send (ns)
+        self.sent = None  # Send time of the previous send
+        self.jitter = 0.0  # RFC 3550 jitter estimate (ns)
+        self.total = UdpStats()
+        self.current = UdpStats()
+        self.ended = False
+        self.selector = None
+
+    def parse_headers(self, count):
+        # Sequence numbers and send times of the first `count` header slots
+        headers = array('Q')
+        headers.frombytes(self.headers[:count * UDP_HEADER.size])
+        if SWAP_HEADERS:
+            headers.byteswap()
+        self.seqs, self.stamps = headers[0::2], headers[1::2]
+
+    def receive_batch(self, timeout):
+        # Wait up to `timeout` seconds for datagrams, then take whatever is queued; returns the count
+        if not self.selector.select(timeout):
+            return 0
+        recvmsg_into, buffers, sizes, arrivals, time_ns = self.sock.recvmsg_into, self.buffers, self.sizes, self.arrivals, time.time_ns
+        count = 0
+        while count < RECV_BATCH:
+            try:
+                sizes[count] = recvmsg_into(buffers[count])[0]
+            except (BlockingIOError, InterruptedError):
+                break
+            arrivals[count] = time_ns()
+            count += 1
+        self.parse_headers(count)
+        return count
+
+    def process(self, count):
+        stats, sizes, arrivals, seqs, stamps = self.current, self.sizes, self.arrivals, self.seqs, self.stamps
+        expected, transit, jitter, sent = self.expected, self.transit, self.jitter, self.sent
+        received = 0
+        for i in range(count):
+            size = sizes[i]
+            if size < UDP_HEADER.size:
+                continue  # Registration datagram of the handshake
+            seq = seqs[i]
+            if seq == END_SEQUENCE:
+                self.ended = True
+                continue
+
+            received += size
+            stats.packets += 1
+            # RFC 3550: J += (|D(i-1, i)| - J) / 16 with D the change in transit time.
+            # The datagrams of one sendmmsg call carry its send time, and GRO segments
+            # the arrival time of their message, so D is taken between the first
+            # datagrams of successive sends only: zero D within a batch is no signal.
+            stamp = stamps[i]
+            if stamp != sent:
+                sent = stamp
+                arrival_transit = arrivals[i] - stamp
+                if transit is not None:
+                    jitter += (abs(arrival_transit - transit) - jitter) / 16
+                transit = arrival_transit
+
+            if seq == expected:
+                expected += 1
+            elif seq > expected:
+                stats.lost += seq - expected
+                expected = seq + 1
+            else:
+                # A late datagram was counted as lost when the gap opened
+                stats.out_of_order += 1
+                stats.lost -= 1
+
+        stats.bytes += received
+        self.counter.bytes += received
+        self.expected, self.transit, self.jitter, self.sent = expected, transit, jitter, sent
+
+    def print_interval(self, start, end, stats):
+        r = stats.report(self.jitter)
+        elapsed = max(end - start, 1e-9)
+        print(f"{self.tag} {start:.2f}-{end:.2f} s: {stats.bytes / (1024 * 1024):.2f} MB, "
+              f"{stats.bytes * 8 / (1024 * 1024) / elapsed:.2f} Mbps, {stats.packets / elapsed:.0f} pps, {format_report(r)}")
+
+    def run(self, stop):
+        # Returns (total UdpStats report, receiver thread CPU seconds, seconds between the first and last datagram)
+        self.sock.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        cpu_start = time.thread_time()
+        first = last = None  # Arrival of the first and the latest data (monotonic)
+        interval_start = 0.0
+        idle_since = time.monotonic()
+
+        while not self.ended:
+            try:
+                count = self.receive_batch(0.1)
+            except ConnectionRefusedError:
+                count = 0  # ICMP port unreachable caused by an earlier send, not fatal for the receiver
+            now = time.monotonic()
+
+            if count:
+                idle_since = now
+                self.process(count)
+                if self.current.packets or self.total.packets:
+                    first = now if first is None else first
+                    last = now
+            elif stop.is_set() and now - idle_since > IDLE_TIMEOUT:
+                break
+
+            if first is not None and now - first - interval_start >= self.interval:
+                self.print_interval(interval_start, now - first, self.current)
+                self.total.add(self.current)
+                self.current = UdpStats()
+                interval_start = now - first
+
+        self.selector.close()
+        if self.current.packets:
+            self.print_interval(interval_start, last - first, self.current)
+        self.total.add(self.current)
+        elapsed = max(last - first, 1e-9) if first is not None else 1e-9
+        return self.total.report(self.jitter), time.thread_time() - cpu_start, elapsed
+
+
+class MmsgSender(UdpSender):
+    # Sends up to SEND_BATCH datagrams per sendmmsg call. Every datagram is two iovecs:
+    # its header slot in one array and the payload shared by all datagrams. With
+    # UDP_SEGMENT one message carries several datagrams that the kernel splits up.
+
+    def __init__(self, sock, size, counter):
+        super().__init__(sock, size, counter)
+        self.fd = sock.fileno()
+        self.header_words = array('Q', [0]) * (2 * SEND_BATCH)
+        self.payload = bytearray(max(1, size - UDP_HEADER.size))
+        self.iovecs = (iovec * (2 * SEND_BATCH))()
+        header_address, payload_address = buffer_address(self.header_words), buffer_address(self.payload)
+        for i in range(SEND_BATCH):
+            self.iovecs[2 * i].iov_base = header_address + i * UDP_HEADER.size
+            self.iovecs[2 * i].iov_len = UDP_HEADER.size
+            self.iovecs[2 * i + 1].iov_base = payload_address
+            self.iovecs[2 * i + 1].iov_len = size - UDP_HEADER.size
+        self.msgs = (mmsghdr * SEND_BATCH)()
+
+        segments = min(UDP_MAX_SEGMENTS, MAX_DATAGRAM_SIZE // size, SEND_BATCH)
+        self.per_message = 1
+        if segments > 1 and self.set_segment_size(size):
+            self.per_message = segments
+        self.backend = 'sendmmsg + UDP_SEGMENT' if self.per_message > 1 else 'sendmmsg'
+
+    def set_segment_size(self, size):
+        try:
+            self.sock.setsockopt(socket.SOL_UDP, UDP_SEGMENT, size)
+        except OSError:
+            return False
+        return True
+
+    def send(self, count):
+        sendmmsg, msgs, iovecs, words = libc.sendmmsg, self.msgs, self.iovecs, self.header_words
+        message_size = ctypes.sizeof(mmsghdr)
+        done = 0
+        while done < count:
+            n = min(count - done, SEND_BATCH)
+            words[0:2 * n:2] = array('Q', range(self.seq, self.seq + n))
+            words[1:2 * n:2] = array('Q', [time.time_ns()]) * n
+            if SWAP_HEADERS:
+                words.byteswap()
+
+            per_message = self.per_message
+            messages = -(-n // per_message)
+            for m in range(messages):
+                datagrams = min(per_message, n - m * per_message)
+                msgs[m].msg_hdr.msg_iov = ctypes.pointer(iovecs[2 * m * per_message])
+                msgs[m].msg_hdr.msg_iovlen = 2 * datagrams
+
+            sent = 0
+            while sent < messages:
+                result = sendmmsg(self.fd, ctypes.addressof(msgs) + sent * message_size, messages - sent, 0)
+                if result >= 0:
+                    sent += result
+                    continue
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err in (errno.ENOBUFS, errno.EAGAIN):
+                    self.errors += min(per_message, n - sent * per_message)
+                    sent += 1
+                    continue
+                if per_message > 1 and err in (errno.EINVAL, errno.EMSGSIZE, errno.EIO):
+                    # The path cannot take GSO sends (e.g. datagrams larger than the MTU): resend singly
+                    self.set_segment_size(0)
+                    self.per_message = 1
+                    self.backend = 'sendmmsg'
+                    for m in range(n - sent * per_message):
+                        msgs[m].msg_hdr.msg_iov = ctypes.pointer(iovecs[2 * (sent * per_message + m)])
+                        msgs[m].msg_hdr.msg_iovlen = 2
+                    messages, sent, per_message = n - sent * per_message, 0, 1
+                    continue
+                raise OSError(err, os.strerror(err))
+
+            self.seq += n
+            done += n
+        self.counter.bytes += count * self.size
+
+
+class MmsgReceiver(UdpReceiver):
+    # Reads up to RECV_BATCH messages per recvmmsg call. Headers are scattered into
+    # self.headers as in UdpReceiver, and the kernel's receive timestamp of every
+    # message (SO_TIMESTAMPNS) lands in a control array, which gives the jitter the
+    # real arrival times instead of the time of the batch. With UDP_GRO a message
+    # may hold a run of equal-sized datagrams; the headers after the first one are
+    # then read from the message's own buffer with one struct call per message.
+
+    backend = 'recvmmsg'
+
+    def __init__(self, sock, counter, tag, interval=1.0):
+        super().__init__(sock, counter, tag, interval)
+        self.fd = sock.fileno()
+        self.timestamps = self.enable(socket.SOL_SOCKET, SO_TIMESTAMPNS)
+        self.gro = self.enable(socket.SOL_UDP, UDP_GRO)
+        if self.gro:
+            self.backend = 'recvmmsg + UDP_GRO'
+
+        # Without GRO every payload lands in one scratch buffer, with GRO each message needs its own
+        self.message_size = GRO_MESSAGE_SIZE - UDP_HEADER.size if self.gro else MAX_DATAGRAM_SIZE
+        self.payload = bytearray(self.message_size * (RECV_BATCH if self.gro else 1))
+        self.control = array('q', [0]) * (CONTROL_WORDS * RECV_BATCH)
+        self.iovecs = (iovec * (2 * RECV_BATCH))()
+        self.msgs = (mmsghdr * RECV_BATCH)()
+        self.segment_structs = {}  # (segment size, datagrams) -> struct reading the following headers
+        header_address, payload_address = buffer_address(self.headers), buffer_address(self.payload)
+        control_address = buffer_address(self.control)
+        for i in range(RECV_BATCH):
+            self.iovecs[2 * i].iov_base = header_address + i * UDP_HEADER.size
+            self.iovecs[2 * i].iov_len = UDP_HEADER.size
+            self.iovecs[2 * i + 1].iov_base = payload_address + (i * self.message_size if self.gro else 0)
+            self.iovecs[2 * i + 1].iov_len = self.message_size
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_iov = ctypes.pointer(self.iovecs[2 * i])
+            hdr.msg_iovlen = 2
+            if self.timestamps or self.gro:
+                hdr.msg_control = control_address + i * CONTROL_WORDS * 8
+                hdr.msg_controllen = CONTROL_WORDS * 8
+        # recvmmsg overwrites msg_len, msg_controllen and msg_flags: restore them from a copy before every call
+        self.template = bytes(self.msgs)
+        self.words = memoryview(self.msgs).cast('B').cast('I')
+
+    def enable(self, level, option):
+        try:
+            self.sock.setsockopt(level, option, 1)
+        except OSError:
+            return False
+        return True
+
+    def read_control(self, message, length, now):
+        # (arrival time, GRO segment size or 0) from the control messages of one message
+        control, base = self.control, CONTROL_WORDS * message
+        arrival, segment = now, 0
+        offset = 0
+        while offset + 16 <= length:
+            word = base + offset // 8
+            kind = control[word + 1]
+            if kind == TIMESTAMP_CMSG:
+                arrival = control[word + 2] * 1_000_000_000 + control[word + 3]
+            elif kind == GRO_CMSG:
+                segment = control[word + 2] & 0xFFFFFFFF
+            offset += (control[word] + 7) & ~7
+        return arrival, segment
+
+    def segment_struct(self, segment, count):
+        key = (segment, count)
+        fmt = self.segment_structs.get(key)
+        if fmt is None:
+            # The header of every datagram after the first, skipping the payloads in between
+            fmt = self.segment_structs[key] = struct.Struct('!' + f'{segment - UDP_HEADER.size}xQQ' * count)
+        return fmt
+
+    def receive_batch(self, timeout):
+        if not self.selector.select(timeout):
+            return 0
+        ctypes.memmove(self.msgs, self.template, len(self.template))
+        count = libc.recvmmsg(self.fd, ctypes.addressof(self.msgs), RECV_BATCH, MSG_DONTWAIT, None)
+        now = time.time_ns()
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EINTR):
+                return 0
+            if err == errno.ECONNREFUSED:
+                raise ConnectionRefusedError(err, os.strerror(err))
+            raise OSError(err, os.strerror(err))
+
+        words = self.words
+        self.parse_headers(count)
+        self.sizes = sizes = words[MSG_LEN_WORD:MMSG_WORDS * count:MMSG_WORDS].tolist()
+        if not (self.timestamps or self.gro):
+            self.arrivals = [now] * count
+            return count
+
+        controllens = words[CONTROLLEN_WORD:MMSG_WORDS * count:MMSG_WORDS].tolist()
+        control = self.control
+        arrivals = []
+        coalesced = []  # (message, segment size) of the messages holding several datagrams
+        for i in range(count):
+            length = controllens[i]
+            if length == TIMESTAMP_CONTROL_SIZE:
+                arrivals.append(control[CONTROL_WORDS * i + 2] * 1_000_000_000 + control[CONTROL_WORDS * i + 3])
+            elif not length:
+                arrivals.append(now)  # No timestamp: fall back to the batch time
+            else:
+                arrival, segment = self.read_control(i, length, now)
+                arrivals.append(arrival)
+                if segment and sizes[i] > segment:
+                    coalesced.append((i, segment))
+        self.arrivals = arrivals
+        if not coalesced:
+            return count
+        return self.split_messages(count, coalesced)
+
+    def split_messages(self, count, coalesced):
+        # Expand the per-message lists into per-datagram lists
+        seqs, stamps, sizes, arrivals = [], [], [], []
+        done = 0
+        for message, segment in coalesced:
+            seqs.extend(self.seqs[done:message + 1])
+            stamps.extend(self.stamps[done:message + 1])
+            sizes.extend(self.sizes[done:message])
+            arrivals.extend(self.arrivals[done:message + 1])
+            done = message + 1
+
+            length = self.sizes[message]
+            full, rest = divmod(length, segment)
+            following = full - 1 + (rest >= UDP_HEADER.size)  # A short last datagram still has a header
+            values = self.segment_struct(segment, following).unpack_from(self.payload, message * self.message_size)
+            seqs.extend(values[0::2])
+            stamps.extend(values[1::2])
+            sizes.extend([segment] * full)
+            if rest >= UDP_HEADER.size:
+                sizes.append(rest)
+            arrivals.extend([arrivals[-1]] * following)
+
+        seqs.extend(self.seqs[done:count])
+        stamps.extend(self.stamps[done:count])
+        sizes.extend(self.sizes[done:count])
+        arrivals.extend(self.arrivals[done:count])
+        self.seqs, self.stamps, self.sizes, self.arrivals = seqs, stamps, sizes, arrivals
+        return len(seqs)
@@ -0,0 +1,307 @@
+import asyncio
+import json
+import time
+
+from abr import DEFAULT_WINDOW, ThroughputEstimator
+from histogram import Histogram
+
+# Viewer engine of the HTTP streaming emulator (client_Feng.py --viewers N).
+# One asyncio event loop runs every emulated viewer, so thousands of them fit in
+# a single process. A viewer keeps one HTTP/1.1 keep-alive connection to the
+# chunk server (server_Feng.py) and walks its encoding ladder chunk by chunk. A
+# playback buffer model decides when the next chunk is requested. Playback starts
+# once the first chunk has arrived. From then on the buffer drains in real time,
+# and a new chunk is only requested while less than --max_buffer seconds are
+# buffered. A buffer that runs dry is a rebuffer (stall) event, and it lasts until
+# the next chunk arrives. With an ABR algorithm (abr.py) the ladder only supplies
+# the available rates and, unless given apart, the video length, and the ABR picks
+# every chunk's rate.
+# Chunk bodies are counted and discarded as they arrive.
+# The per-chunk and per-viewer numbers go into a fixed set of histograms, so
+# memory does not grow with the number of viewers or the length of the run.
+
+READ_SIZE = 256 * 1024  # Largest read of a chunk body
+CONNECT_TIMEOUT = 10
+MBPS = 1024 * 1024  # Throughput histograms count bits per second
+
+# The segments of the original single-viewer client: 12 s at 5 Mbps, then 12 s at 10 Mbps
+DEFAULT_LADDER = [(5000, 12), (10000, 12)]
+
+
+def ladder_arg(text):
+    # argparse type of --ladder: comma-separated RATE:SECONDS steps, RATE in kbps
+    ladder = []
+    for step in text.split(','):
+        try:
+            rate, seconds = step.split(':')
+            rate, seconds = int(rate), float(seconds)
+        except ValueError:
+            raise ValueError(f"invalid ladder step {step!r}, expected RATE:SECONDS")
+        if rate < 1 or seconds <= 0:
+            raise ValueError(f"invalid ladder step {step!r}, rate and seconds must be positive")
+        ladder.append((rate, seconds))
+    return ladder
+
+
+def chunk_schedule(ladder, chunk_duration):
+    # (start time, stop time, rate kbps) of every chunk: each step is cut into
+    # chunks of `chunk_duration` seconds, the last one of a step may be shorter
+    now = 0
+    for rate, seconds in ladder:
+        stop = now + seconds
+        while now < stop:
+            yield now, min(now + chunk_duration, stop), rate
+            now = min(now + chunk_duration, stop)
+
+
+def raise_open_files(needed):
+    # Raise the soft RLIMIT_NOFILE towards the hard limit so `needed` connections fit
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+
+
+class PlaybackBuffer:
+    # Seconds of video buffered by one viewer, drained in real time while playing
+
+    def __init__(self, joined):
+        self.joined = joined  # When the viewer started, for the startup delay
+        self.level = 0.0  # Seconds of video buffered at `updated`
+        self.updated = joined
+        self.playing = False
+        self.startup_delay = None  # Seconds from joining to the start of playback
+        self.stall_start = None  # When the current stall began
+        self.stalls = 0
+        self.stall_time = 0.0
+
+    def update(self, now):
+        # Play until `now`; a buffer that ran dry on the way starts a stall
+        if self.playing:
+            played = now - self.updated
+            if played >= self.level:
+                self.stall_start = self.updated + self.level
+                self.stalls += 1
+                self.playing = False
+                self.level = 0.0
+            else:
+                self.level -= played
+        self.updated = now
+
+    def add(self, seconds, now):
+        # A chunk of `seconds` arrived at `now`: it starts or resumes playback;
+        # returns the seconds of the stall the chunk ended, 0 if there was none
+        self.update(now)
+        self.level += seconds
+        stall = 0.0
+        if not self.playing:
+            if self.startup_delay is None:
+                self.startup_delay = now - self.joined
+            else:
+                stall = now - self.stall_start
+                self.stall_time += stall
+                self.stall_start = None
+            self.playing = True
+        return stall
+
+    def wait_time(self, now, max_buffer):
+        # Seconds until the buffer drops below `max_buffer`
+        self.update(now)
+        return max(0.0, self.level - max_buffer)
+
+
+class ViewerStats:
+    # Results of all viewers: per-chunk and per-viewer histograms plus totals
+
+    def __init__(self):
+        self.download_ns = Histogram()  # Per chunk: request to last byte
+        self.throughput = Histogram()  # Per chunk, bits/s
+        self.startup_ns = Histogram()  # Per viewer: join to start of playback
+        self.rebuffers = Histogram()  # Per viewer: number of stalls
+        self.rebuffer_ns = Histogram()  # Per viewer: total stall time
+        self.viewer_download_ns = Histogram()  # Per viewer: mean chunk download time
+        self.viewer_throughput = Histogram()  # Per viewer: mean chunk throughput, bits/s
+        self.viewer_bitrate = Histogram()  # Per viewer: mean encoding rate over the video, bits/s
+        self.switches = Histogram()  # Per viewer: number of encoding rate changes
+        self.viewers = 0  # Viewers that played their whole ladder
+        self.failed_viewers = 0
+        self.chunks = 0
+        self.bytes = 0
+        self.errors = 0  # Failed chunk requests
+
+    def record_chunk(self, size, elapsed):
+        self.chunks += 1
+        self.bytes += size
+        self.download_ns.record(int(elapsed * 1e9))
+        self.throughput.record(int(size * 8 / elapsed))
+
+    def record_viewer(self, viewer):
+        if viewer.failed:
+            self.failed_viewers += 1
+            return
+        playback = viewer.playback
+        self.viewers += 1
+        self.startup_ns.record(int(playback.startup_delay * 1e9))
+        self.rebuffers.record(playback.stalls)
+        self.rebuffer_ns.record(int(playback.stall_time * 1e9))
+        self.viewer_download_ns.record(int(viewer.download_time / viewer.chunks * 1e9))
+        self.viewer_throughput.record(int(viewer.bytes * 8 / viewer.download_time))
+        self.viewer_bitrate.record(int(viewer.bitrate_seconds * 1024 / viewer.video_seconds))
+        self.switches.record(viewer.switches)
+
+    def report(self, elapsed, prefix="[Viewers]"):
+        print(f"{prefix} {self.viewers} viewer(s) finished, {self.failed_viewers} failed; {self.chunks} chunks, "
+              f"{self.bytes / (1024 * 1024):.1f} MB in {elapsed:.2f} s ({self.bytes * 8 / MBPS / elapsed:.2f} Mbps), "
+              f"{self.errors} failed request(s)")
+        print(f"{prefix} Chunk download time: {self.download_ns.summary(1e6, 'ms', 3)}")
+        print(f"{prefix} Chunk throughput: {self.throughput.summary(MBPS, 'Mbps', 2)}")
+        print(f"{prefix} Per viewer startup delay: {self.startup_ns.summary(1e6, 'ms', 3)}")
+        print(f"{prefix} Per viewer rebuffer events: {self.rebuffers.summary(1, 'stalls', 0)}")
+        print(f"{prefix} Per viewer rebuffer time: {self.rebuffer_ns.summary(1e6, 'ms', 3)}")
+        print(f"{prefix} Per viewer mean download time: {self.viewer_download_ns.summary(1e6, 'ms', 3)}")
+        print(f"{prefix} Per viewer mean throughput: {self.viewer_throughput.summary(MBPS, 'Mbps', 2)}")
+        print(f"{prefix} Per viewer mean bitrate: {self.viewer_bitrate.summary(MBPS, 'Mbps', 2)}")
+        print(f"{prefix} Per viewer bitrate switches: {self.switches.summary(1, 'switches', 0)}")
+
+
+class Viewer:
+    # One emulated viewer playing `ladder` over its own keep-alive connection; with an
+    # ABR class the rates come from abr(rates, chunk_duration, max_buffer).choose()
+
+    def __init__(self, number, address, path, ladder, chunk_duration, max_buffer, stats, verbose,
+                 abr=None, window=None, timeline=None, video_length=None):
+        self.number = number
+        self.address = address
+        self.path = path
+        self.ladder = ladder
+        self.chunk_duration = chunk_duration
+        self.max_buffer = max_buffer
+        self.stats = stats
+        self.verbose = verbose
+        self.abr = None if abr is None else abr(sorted({rate for rate, _ in ladder}), chunk_duration, max_buffer)
+        self.estimator = ThroughputEstimator(window or DEFAULT_WINDOW)
+        self.video_length = video_length or sum(seconds for _, seconds in ladder)  # Seconds of video, with an ABR
+        self.timeline = timeline  # File the per-chunk timeline is written to as JSON Lines, or None
+        self.playback = None
+        self.chunks = 0
+        self.bytes = 0
+        self.download_time = 0.0
+        self.rate = None  # Encoding rate of the last chunk
+        self.switches = 0
+        self.bitrate_seconds = 0.0  # Sum of rate * duration over the chunks, for the mean bitrate
+        self.video_seconds = 0.0
+        self.failed = False
+        self.reader = self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(*self.address), CONNECT_TIMEOUT)
+
+    def disconnect(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def fetch(self, start, stop, rate):
+        # GET one chunk; returns its size in bytes
+        if self.writer is None:
+            await self.connect()
+        request = (f"GET {self.path} HTTP/1.1\r\nHost: {self.address[0]}\r\n"
+                   f"Encoding-Rate-kbps: {rate}\r\nStart-Time: {start:g}\r\nStop-Time: {stop:g}\r\n\r\n")
+        self.writer.write(request.encode())
+        header = await self.reader.readuntil(b"\r\n\r\n")
+        lines = header.decode('latin-1').split("\r\n")
+        status = lines[0].split(None, 2)
+        if len(status) < 2 or status[1] != "200":
+            raise ConnectionError(f"unexpected response {lines[0]!r}")
+        fields = dict(line.split(":", 1) for line in lines[1:] if ":" in line)
+        fields = {name.strip().lower(): value.strip() for name, value in fields.items()}
+        remaining = size = int(fields['content-length'])
+        while remaining:
+            data = await self.reader.read(min(remaining, READ_SIZE))
+            if not data:
+                raise ConnectionError("server closed the connection")
+            remaining -= len(data)
+        if fields.get('connection', '').lower() == 'close':
+            self.disconnect()
+        return size
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.playback = PlaybackBuffer(loop.time())
+        schedule = self.ladder if self.abr is None else [(None, self.video_length)]
+        try:
+            for start, stop, rate in chunk_schedule(schedule, self.chunk_duration):
+                await asyncio.sleep(self.playback.wait_time(loop.time(), self.max_buffer))
+                if self.abr is not None:
+                    rate = self.abr.choose(self.estimator, self.playback.level, self.rate)
+                begin = loop.time()
+                try:
+                    size = await self.fetch(start, stop, rate)
+                except (OSError, EOFError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError, KeyError) as e:
+                    # One retry on a fresh connection, then the viewer gives up
+                    self.stats.errors += 1
+                    self.disconnect()
+                    if self.verbose:
+                        print(f"[Viewer {self.number}] Chunk {start:g}-{stop:g} s failed ({e!r}), reconnecting")
+                    begin = loop.time()
+                    size = await self.fetch(start, stop, rate)
+                end = loop.time()
+                stall = self.playback.add(stop - start, end)
+                elapsed = max(end - begin, 1e-9)
+                self.record_chunk(size, elapsed, rate, stop - start)
+                if self.verbose:
+                    print(f"[Viewer {self.number}] Time: {end - self.playback.joined:.6f}, received: #{self.chunks} chunk, "
+                          f"{size} bytes, encoding-rate-kbps: {rate}, in {elapsed:.6f} sec, "
+                          f"thrput-mbps: {size * 8 / (MBPS * elapsed):.6}, buffer: {self.playback.level:.3f} s, "
+                          f"stall: {stall:.3f} s, stalls: {self.playback.stalls}.")
+                if self.timeline is not None:
+                    self.timeline.write(json.dumps({
+                        'viewer': self.number, 'time': round(end - self.playback.joined, 6), 'chunk': self.chunks,
+                        'start': start, 'stop': stop, 'rate_kbps': rate, 'bytes': size, 'download_s': round(elapsed, 6),
+                        'throughput_mbps': round(size * 8 / (MBPS * elapsed), 3),
+                        'estimate_mbps': round(self.estimator.estimate() / 1024, 3),
+                        'buffer_s': round(self.playback.level, 3), 'stall_s': round(stall, 6),
+                        'stalls': self.playback.stalls}) + '\n')
+        except (OSError, EOFError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError, KeyError) as e:
+            self.stats.errors += 1
+            self.failed = True
+            print(f"[Viewer {self.number}] Failed after {self.chunks} chunk(s): {e!r}")
+        finally:
+            self.disconnect()
+        self.stats.record_viewer(self)
+
+    def record_chunk(self, size, elapsed, rate, seconds):
+        self.chunks += 1
+        self.bytes += size
+        self.download_time += elapsed
+        self.estimator.update(size, elapsed)
+        if self.rate is not None and rate != self.rate:
+            self.switches += 1
+        self.rate = rate
+        self.bitrate_seconds += rate * seconds
+        self.video_seconds += seconds
+        self.stats.record_chunk(size, elapsed)
+
+
+async def run_viewers(count, address, path, ladders, chunk_duration, max_buffer, stagger, verbose,
+                      abr=None, window=None, timeline=None, video_length=None):
+    # Start `count` viewers `stagger` seconds apart, viewer i on ladders[i % len(ladders)];
+    # returns (stats, elapsed seconds)
+    stats = ViewerStats()
+    running = set()
+    start = time.perf_counter()
+    for number in range(count):
+        if number and stagger:
+            await asyncio.sleep(stagger)
+        viewer = Viewer(number + 1, address, path, ladders[number % len(ladders)], chunk_duration, max_buffer, stats, verbose,
+                        abr, window, timeline, video_length)
+        task = asyncio.create_task(viewer.run())
+        running.add(task)
+        task.add_done_callback(running.discard)
+    while running:
+        await asyncio.gather(*running)
+    return stats, time.perf_counter() - start
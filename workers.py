@@ -0,0 +1,375 @@
+import ctypes
+import json
+import mmap
+import multiprocessing
+import os
+import queue
+import selectors
+import signal
+import socket
+import sys
+import threading
+import time
+
+from churn import answer_churn
+from control import CHURN_CONNECTION
+
+# Multi-process stream workers for advanced_server.py.
+# Python threads share one GIL, so with --workers the server forks its workers at
+# startup (before it starts any thread) and hands every data socket of a session to
+# one of them, round-robin, over a Unix socket (SCM_RIGHTS). The byte counter and
+# iteration of every stream live in a slot of an anonymous shared mmap; each field
+# has exactly one writer, so the parent's sampler, iteration trackers and reports
+# read exact values without any locking in the hot loop. Only low-rate events go
+# through the Unix socket: the markers a sender announces, the stop signal of UDP
+# receivers and the results once a stream is over.
+# With a listen address every worker also opens its own SO_REUSEPORT listener on
+# the server port, so the kernel spreads incoming connections over all of them.
+# A worker answers connection churn tests itself and hands every other
+# connection to the parent, which runs the handshakes and sessions.
+
+SLOT_WORDS = 2  # bytes, iteration
+MAX_MESSAGE_SIZE = 1024 * 1024  # Largest message between the parent and a worker
+HANDSHAKE_TIMEOUT = 5  # Seconds a connection accepted by a worker gets to send its first byte
+
+
+class SharedCounter:
+    # sampler.StreamCounter backed by a shared memory slot: the worker running the
+    # stream writes bytes (and iteration on the sending side), the parent reads them.
+    # tcp_stats stays per process, it is filled by the parent's sampler. `cell` aliases
+    # bytes for the libfastpump loops, which add to it on every call.
+    __slots__ = ('words', 'slot', 'word', 'cell', 'tcp_stats')
+
+    def __init__(self, words, slot):
+        self.words = words
+        self.slot = slot
+        self.word = slot * SLOT_WORDS
+        self.cell = ctypes.c_longlong.from_buffer(words, self.word * 8)
+        self.tcp_stats = {}
+
+    @property
+    def bytes(self):
+        return self.words[self.word]
+
+    @bytes.setter
+    def bytes(self, value):
+        self.words[self.word] = value
+
+    @property
+    def iteration(self):
+        return self.words[self.word + 1]
+
+    @iteration.setter
+    def iteration(self, value):
+        self.words[self.word + 1] = value
+
+
+class CounterSlots:
+    # Fixed pool of shared counters, created before the workers are forked
+
+    def __init__(self, count):
+        self.memory = mmap.mmap(-1, count * SLOT_WORDS * 8)  # MAP_SHARED | MAP_ANONYMOUS, inherited by fork
+        self.words = memoryview(self.memory).cast('q')
+        self.free = list(range(count - 1, -1, -1))
+        self.lock = threading.Lock()
+
+    def allocate(self):
+        with self.lock:
+            if not self.free:
+                raise RuntimeError("out of shared stream counters")
+            slot = self.free.pop()
+        counter = SharedCounter(self.words, slot)
+        counter.bytes = counter.iteration = 0
+        return counter
+
+    def release(self, counter):
+        with self.lock:
+            self.free.append(counter.slot)
+
+
+class WorkerChannel:
+    # JSON messages (plus file descriptors) over a SOCK_SEQPACKET socketpair, one message per packet
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()  # Stream threads of a worker send concurrently
+
+    def send(self, msg_type, fds=(), **fields):
+        fields['type'] = msg_type
+        payload = json.dumps(fields).encode()
+        with self.lock:
+            socket.send_fds(self.sock, [payload], list(fds))
+
+    def recv(self):
+        # (message, file descriptors), (None, []) once the other side is gone
+        try:
+            data, fds, _, _ = socket.recv_fds(self.sock, MAX_MESSAGE_SIZE, 4)
+        except OSError:
+            return None, []
+        if not data:
+            return None, []
+        return json.loads(data), fds
+
+
+class RemoteControl:
+    # Stands in for the session's ControlChannel inside a worker: markers are relayed by the parent
+
+    def __init__(self, channel, job):
+        self.channel = channel
+        self.job = job
+
+    def send(self, msg_type, **fields):
+        fields['type'] = msg_type
+        self.channel.send('control', job=self.job, message=fields)
+
+
+class RemoteStream:
+    # Parent side of a stream running in a worker; start() and join() like a thread.
+    # The worker's results are appended to `results` and its UDP report stored in
+    # session.udp_stats before join() returns.
+
+    def __init__(self, pool, worker, job, session, index, sock, tag, results, counter, stop):
+        self.pool = pool
+        self.worker = worker
+        self.job = job
+        self.session = session
+        self.index = index
+        self.sock = sock
+        self.tag = tag
+        self.results = results
+        self.counter = counter
+        self.stop = stop
+        self.done = threading.Event()
+
+    def start(self):
+        self.pool.submit(self)
+
+    def join(self):
+        self.done.wait()
+
+    def finish(self, results, udp):
+        self.results.extend(tuple(r) for r in results)
+        if udp is not None:
+            self.session.udp_stats[self.index] = udp
+        self.sock.close()  # The worker has closed its copy; the connection ends with the parent's
+        self.done.set()
+
+
+def pin_cpus(workers):
+    # CPU of every worker: the CPUs this process may run on, round-robin
+    cpus = sorted(os.sched_getaffinity(0))
+    return [cpus[w % len(cpus)] for w in range(workers)]
+
+
+class WorkerPool:
+
+    def __init__(self, workers, slots, run, pin=False, listen=None, tune=None):
+        # run(job, sock, counter, control, stop) runs one stream inside a worker and
+        # returns (results, UDP report or None); `job` is the message built in stream().
+        # listen=(host, port) gives every worker a SO_REUSEPORT listener on that address,
+        # tune(listener), if given, sets its options before it starts listening.
+        self.slots = slots
+        self.listen = listen
+        self.cpus = pin_cpus(workers) if pin else [None] * workers
+        self.channels = []
+        self.processes = []
+        self.jobs = {}  # Job ID -> RemoteStream
+        self.lock = threading.Lock()
+        self.next_job = 0
+        self.next_worker = 0
+        self.closing = False  # Set by close(), the workers' exits are expected from then on
+
+        context = multiprocessing.get_context('fork')
+        parent_ends = []
+        for w in range(workers):
+            parent_end, child_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            process = context.Process(target=worker_main, args=(w, child_end, self.cpus[w], slots, run, parent_ends + [parent_end], listen, tune),
+                                      name=f"worker-{w}", daemon=True)
+            process.start()
+            child_end.close()
+            parent_ends.append(parent_end)
+            self.channels.append(WorkerChannel(parent_end))
+            self.processes.append(process)
+
+        # Connections the workers' listeners hand over; `wakeup` turns readable when there are some
+        self.handoffs = queue.Queue()
+        self.wakeup, self.notify = socket.socketpair()
+        self.wakeup.setblocking(False)
+
+        # Threads only after the last fork
+        for w, channel in enumerate(self.channels):
+            threading.Thread(target=self.read, args=(w, channel), daemon=True).start()
+
+    def close(self):
+        # Stop the workers at the end of the server
+        self.closing = True
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+
+    def describe(self):
+        for w, process in enumerate(self.processes):
+            print(f"Worker {w}: pid {process.pid}" + (f", pinned to CPU {self.cpus[w]}" if self.cpus[w] is not None else "")
+                  + (f", listening on port {self.listen[1]} (SO_REUSEPORT)." if self.listen else "."))
+
+    def take_connections(self):
+        # (socket, address) of every connection handed over since the last call
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        connections = []
+        while True:
+            try:
+                connections.append(self.handoffs.get_nowait())
+            except queue.Empty:
+                return connections
+
+    def stream(self, session, index, sock, tag, results, counter, stop=None):
+        # RemoteStream for one data socket of `session`; `stop` (UDP receivers) is forwarded once set
+        with self.lock:
+            job = self.next_job
+            worker = self.next_worker
+            self.next_job += 1
+            self.next_worker = (self.next_worker + 1) % len(self.channels)
+        return RemoteStream(self, worker, job, session, index, sock, tag, results, counter, stop)
+
+    def submit(self, stream):
+        with self.lock:
+            self.jobs[stream.job] = stream
+        session = stream.session
+        self.channels[stream.worker].send('stream', fds=[stream.sock.fileno()], job=stream.job, session=session.id, spec=vars(session.spec),
+                                          index=stream.index, tag=stream.tag, slot=stream.counter.slot, control=session.control is not None)
+        if stream.stop is not None:
+            threading.Thread(target=self.forward_stop, args=(stream,), daemon=True).start()
+
+    def forward_stop(self, stream):
+        stream.stop.wait()
+        if not stream.done.is_set():
+            try:
+                self.channels[stream.worker].send('stop', job=stream.job)
+            except OSError:
+                pass
+
+    def read(self, worker, channel):
+        # Relay markers to the session's control channel and collect the results of finished streams
+        while True:
+            message, fds = channel.recv()
+            if message is None:
+                break
+            if message['type'] == 'connection':
+                self.handoffs.put((socket.socket(fileno=fds[0]), tuple(message['address'])))
+                self.notify.send(b'\0')
+                continue
+            with self.lock:
+                stream = self.jobs.get(message.get('job'))
+            if stream is None:
+                continue
+            if message['type'] == 'control' and stream.session.control is not None:
+                fields = dict(message['message'])
+                try:
+                    stream.session.control.send(fields.pop('type'), **fields)
+                except OSError:
+                    pass  # The client is gone; the stream notices on its own
+            elif message['type'] == 'done':
+                with self.lock:
+                    del self.jobs[stream.job]
+                stream.finish(message['results'], message.get('udp'))
+
+        # The worker died: fail its streams instead of leaving their sessions hanging
+        if not self.closing:
+            process = self.processes[worker]
+            process.join(1)
+            print(f"Worker {worker} exited unexpectedly (exit code {process.exitcode}).")
+        with self.lock:
+            lost = [stream for stream in self.jobs.values() if stream.worker == worker]
+            for stream in lost:
+                del self.jobs[stream.job]
+        for stream in lost:
+            stream.finish([], None)
+
+
+def worker_main(worker, sock, cpu, slots, run, inherited, listen, tune):
+    # Worker process: run every stream it is handed in its own thread until the parent goes away
+    for parent_end in inherited:
+        parent_end.close()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C stops the parent, which takes the workers down
+    sys.stdout.reconfigure(line_buffering=True)  # Daemon workers are terminated without flushing
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+
+    channel = WorkerChannel(sock)
+    if listen:
+        threading.Thread(target=listen_loop, args=(channel, listen, tune), daemon=True).start()
+    stops = {}  # Job ID -> stop event of the job's stream
+    while True:
+        message, fds = channel.recv()
+        if message is None:
+            return
+        if message['type'] == 'stream':
+            stream_socket = socket.socket(fileno=fds[0])
+            stop = stops[message['job']] = threading.Event()
+            counter = SharedCounter(slots.words, message['slot'])
+            thread = threading.Thread(target=run_job, args=(channel, message, stream_socket, counter, stop, run, stops), daemon=True)
+            thread.start()
+        elif message['type'] == 'stop' and message['job'] in stops:
+            stops[message['job']].set()
+
+
+def run_job(channel, job, sock, counter, stop, run, stops):
+    results, udp = [], None
+    try:
+        results, udp = run(job, sock, counter, RemoteControl(channel, job['job']), stop)
+    except Exception as e:
+        print(f"{job['tag']} Worker stream failed: {e}")
+        sock.close()
+    finally:
+        del stops[job['job']]
+        channel.send('done', job=job['job'], results=results, udp=udp)
+
+
+def listen_loop(channel, address, tune=None):
+    # SO_REUSEPORT listener of a worker: answer churn connections, hand the others to the parent
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if tune is not None:
+        tune(listener)
+    listener.bind(address)
+    listener.listen(socket.SOMAXCONN)
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    accepted = {}  # Connection -> time it was accepted, until its first byte arrives
+
+    while True:
+        for key, _ in selector.select(timeout=1):
+            if key.fileobj is listener:
+                try:
+                    conn, peer = listener.accept()
+                except OSError:
+                    continue
+                selector.register(conn, selectors.EVENT_READ, peer)
+                accepted[conn] = time.monotonic()
+                continue
+
+            conn, peer = key.fileobj, key.data
+            selector.unregister(conn)
+            del accepted[conn]
+            try:
+                # Peek, so a handed-over connection still starts with its first byte
+                kind = conn.recv(1, socket.MSG_PEEK)
+                if kind == CHURN_CONNECTION:
+                    conn.recv(1)
+                    answer_churn(conn)
+                    continue
+                if kind:
+                    channel.send('connection', fds=[conn.fileno()], address=list(peer))
+            except OSError:
+                pass
+            conn.close()
+
+        for conn in [c for c, since in accepted.items() if time.monotonic() - since > HANDSHAKE_TIMEOUT]:
+            selector.unregister(conn)
+            del accepted[conn]
+            conn.close()
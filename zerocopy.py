@@ -0,0 +1,60 @@
+import os
+import tempfile
+
+from profiler import make_profiled_sender
+
+# Zero-copy transmit helpers shared by advanced_client.py and advanced_server.py.
+# The payload lives in a memfd (or a tmpfs file) and is pushed to the socket with
+# os.sendfile, so the sender never copies or allocates the payload per send.
+# Without a payload file the sender falls back to sendall() over memoryview
+# slices of the payload, which also avoids the per-call bytes copy.
+
+
+def open_payload_file(data):
+    # Return a file descriptor holding `data`, or None when no in-memory file is available
+    if not hasattr(os, 'sendfile'):
+        return None
+
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create('netperf-payload')
+    elif os.path.isdir('/dev/shm'):
+        fd, path = tempfile.mkstemp(dir='/dev/shm')
+        os.unlink(path)
+    else:
+        return None
+
+    view = memoryview(data)
+    written = 0
+    while written < len(view):
+        written += os.write(fd, view[written:])
+    return fd
+
+
+def make_sender(sock, data, payload_fd, counter, profile=None):
+    # Return send(size) which transmits the first `size` bytes of the payload on `sock`
+    # and adds them to counter.bytes; with a profiler.CallProfile every call goes through it
+    if profile is not None:
+        return make_profiled_sender(sock, data, payload_fd, counter, profile)
+    if payload_fd is None:
+        view = memoryview(data)
+        full_size = len(view)
+        sendall = sock.sendall
+
+        def send(size):
+            sendall(view if size == full_size else view[:size])
+            counter.bytes += size
+
+        return send
+
+    out_fd = sock.fileno()
+    sendfile = os.sendfile
+
+    def send(size):
+        # The explicit offset keeps the shared payload file position untouched, so
+        # several streams can send from the same descriptor concurrently
+        offset = 0
+        while offset < size:
+            offset += sendfile(out_fd, payload_fd, offset, size - offset)
+        counter.bytes += size
+
+    return send